@@ -0,0 +1,221 @@
+"""
+Fair allocation of stock for oversubscribed order periods.
+
+Once a period is closed, ``allocate_period`` splits each product's stock
+(``Inventory.quantity``) between the period's orders. Products whose total
+demand fits in stock are allocated in full. For the others the policy
+decides:
+
+* ``proportional``: every order gets the same share of what it asked for,
+  rounded down; the units left over by rounding go to the largest
+  remainders (Hamilton's method), earlier orders first on ties;
+* ``first_come``: orders are served in full in the order they were first
+  placed (``Order.created_at``) until the stock runs out;
+* ``capped``: no order gets more than ``cap`` units of a short product, and
+  the capped requests are then shared proportionally. If the capped
+  requests fit in stock, the rest of the stock is left unallocated.
+
+Allocations are computed with numpy over all (order, product) lines of the
+period at once and stored in ``order_allocation``, replacing the period's
+previous allocation.
+"""
+import numpy as np
+from sqlalchemy import delete, insert, select
+
+from models import Inventory, Order, OrderItem, OrderAllocation
+from events import record_event
+
+POLICIES = ('proportional', 'first_come', 'capped')
+
+def _group_starts(groups, group_count):
+    """
+    Returns the index at which each group begins in a ``groups`` array sorted by group.
+    """
+    counts = np.bincount(groups, minlength=group_count)
+    return np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+def allocate_proportional(demand, groups, supply):
+    """
+    Largest remainder allocation of each group's supply.
+
+    Args:
+        demand (ndarray): Units requested per line (int64)
+        groups (ndarray): Product index of each line, 0..len(supply)-1
+        supply (ndarray): Units available per product (int64)
+
+    Returns:
+        ndarray: Units allocated per line
+    """
+    total = np.bincount(groups, weights=demand, minlength=len(supply)).astype(np.int64)
+    short = total > supply
+
+    # Exact integer shares: demand * supply / total, split into quotient and remainder
+    line_supply = supply[groups]
+    line_total = np.maximum(total[groups], 1)
+    quotient, remainder = np.divmod(demand * line_supply, line_total)
+    allocated = np.where(short[groups], quotient, demand)
+
+    # Units left over by rounding down, per product
+    leftover = supply - np.bincount(groups, weights=allocated, minlength=len(supply)).astype(np.int64)
+    leftover[~short] = 0
+
+    # Within each product, largest remainder first, then earliest line
+    order = np.lexsort((np.arange(len(demand)), -remainder, groups))
+    sorted_groups = groups[order]
+    rank = np.arange(len(order)) - _group_starts(sorted_groups, len(supply))[sorted_groups]
+    allocated[order[rank < leftover[sorted_groups]]] += 1
+    return allocated
+
+def allocate_first_come(demand, groups, supply):
+    """
+    Serves lines in full, in array order, until each product's supply runs out.
+    """
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    running = np.cumsum(demand[order])
+
+    # Units requested by earlier lines of the same product
+    group_offset = np.concatenate(([0], running))[_group_starts(sorted_groups, len(supply))]
+    before = running - demand[order] - group_offset[sorted_groups]
+
+    allocated = np.empty_like(demand)
+    allocated[order] = np.clip(supply[sorted_groups] - before, 0, demand[order])
+    return allocated
+
+def allocate_capped(demand, groups, supply, cap):
+    """
+    Caps the lines of products short of supply at ``cap`` units, then shares
+    proportionally. Lines of the other products are allocated in full.
+    """
+    total = np.bincount(groups, weights=demand, minlength=len(supply)).astype(np.int64)
+    short = total > supply
+    return allocate_proportional(np.where(short[groups], np.minimum(demand, cap), demand), groups, supply)
+
+def solve(demand, product_ids, stock, policy, cap=None):
+    """
+    Computes the allocation of a set of order lines.
+
+    Args:
+        demand (ndarray): Units requested per line, lines in arrival order
+        product_ids (ndarray): Product of each line
+        stock (dict): product_id -> units available
+        policy (str): One of POLICIES
+        cap (int, optional): Per-order cap for the capped policy
+
+    Returns:
+        ndarray: Units allocated per line
+    """
+    products, groups = np.unique(product_ids, return_inverse=True)
+    supply = np.array([max(stock.get(int(p)) or 0, 0) for p in products], dtype=np.int64)
+    demand = demand.astype(np.int64)
+
+    if policy == 'proportional':
+        return allocate_proportional(demand, groups, supply)
+    if policy == 'first_come':
+        return allocate_first_come(demand, groups, supply)
+    return allocate_capped(demand, groups, supply, cap)
+
+_ALLOCATION_COLUMNS = ('order_id', 'product_id', 'guild_id', 'order_period_id', 'requested', 'allocated', 'policy')
+
+def _insert_allocations(rows):
+    """
+    Inserts allocation rows given as tuples in _ALLOCATION_COLUMNS order.
+    """
+    from app import db
+
+    if db.engine.dialect.name == 'sqlite':
+        # sqlite3's own executemany is several times faster than a Core
+        # executemany, which builds a parameter dict per row
+        placeholders = ", ".join("?" for _ in _ALLOCATION_COLUMNS)
+        db.session.connection().exec_driver_sql(
+            f"INSERT INTO order_allocation ({', '.join(_ALLOCATION_COLUMNS)}) VALUES ({placeholders})", rows)
+    else:
+        # Batched into multi-row INSERTs by SQLAlchemy's insertmanyvalues
+        db.session.execute(insert(OrderAllocation.__table__),
+                           [dict(zip(_ALLOCATION_COLUMNS, row)) for row in rows])
+
+def allocate_period(period, policy='proportional', cap=None):
+    """
+    Allocates a closed period's orders and stores the result. The caller commits.
+
+    Args:
+        period (OrderPeriod): A closed order period
+        policy (str): One of POLICIES
+        cap (int, optional): Maximum units of a product per order, for the capped policy
+
+    Returns:
+        list: Per-product summaries (product_id, requested, stock, allocated, short)
+        str: Error message if any
+    """
+    from app import db
+
+    if period.is_open:
+        return None, "Close the order period before allocating it"
+    if policy not in POLICIES:
+        return None, f"Unknown policy, expected one of: {', '.join(POLICIES)}"
+    if policy == 'capped':
+        if not isinstance(cap, int) or isinstance(cap, bool) or cap < 1:
+            return None, "The capped policy needs a positive integer cap"
+
+    in_period = (Order.guild_id == period.guild_id, Order.order_period_id == period.id)
+    arrival = np.array(db.session.execute(
+        select(Order.id).where(*in_period).order_by(Order.created_at, Order.id)
+    ).scalars().all(), dtype=np.int64)
+
+    # Sorting the lines in numpy is cheaper than having the database sort the join
+    rows = db.session.execute(
+        select(OrderItem.order_id, OrderItem.product_id, OrderItem.quantity)
+        .join(Order, Order.id == OrderItem.order_id)
+        .where(*in_period)
+    ).all()
+
+    stock = dict(db.session.execute(
+        select(Inventory.product_id, Inventory.quantity).where(Inventory.guild_id == period.guild_id)
+    ).all())
+
+    db.session.execute(delete(OrderAllocation).where(OrderAllocation.order_period_id == period.id))
+    if not rows:
+        record_event('period.allocated', period.id, period.guild_id, policy=policy, lines=0)
+        return [], None
+
+    order_ids, product_ids, demand = (np.array(column, dtype=np.int64) for column in zip(*rows))
+
+    # Lines in the order their orders were first placed
+    by_id = np.argsort(arrival)
+    rank = by_id[np.searchsorted(arrival[by_id], order_ids)]
+    order = np.lexsort((product_ids, rank))
+    order_ids, product_ids, demand = order_ids[order], product_ids[order], demand[order]
+
+    allocated = solve(demand, product_ids, stock, policy, cap)
+    guild_id, period_id = period.guild_id, period.id
+    _insert_allocations([
+        (order_id, product_id, guild_id, period_id, requested, units, policy)
+        for order_id, product_id, requested, units in zip(
+            order_ids.tolist(), product_ids.tolist(), demand.tolist(), allocated.tolist())
+    ])
+
+    products, groups = np.unique(product_ids, return_inverse=True)
+    requested_totals = np.bincount(groups, weights=demand, minlength=len(products)).astype(np.int64)
+    allocated_totals = np.bincount(groups, weights=allocated, minlength=len(products)).astype(np.int64)
+
+    summary = [{
+        'product_id': product_id,
+        'requested': requested,
+        'stock': stock.get(product_id) or 0,
+        'allocated': units,
+        'short': requested - units,
+    } for product_id, requested, units in zip(
+        products.tolist(), requested_totals.tolist(), allocated_totals.tolist())]
+
+    record_event('period.allocated', period.id, period.guild_id, policy=policy, lines=len(rows),
+                 short_products=sum(1 for s in summary if s['short'] > 0))
+    return summary, None
+
+def get_allocations(period_id):
+    """
+    Returns the stored allocations of an order period, by order then product.
+    """
+    return (OrderAllocation.query
+            .filter_by(order_period_id=period_id)
+            .order_by(OrderAllocation.order_id, OrderAllocation.product_id)
+            .all())
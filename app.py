@@ -1,11 +1,20 @@
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, stream_with_context, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
+from db_engine import normalize_database_uri, engine_options, configure_engine
+from db_routing import RoutingSession, replica_binds, replica_reads
+from tenancy import current_guild_id, remember_request_guild
+from ratelimit import rate_limited, limiter
+from assets import init_assets
+from batch import parse_batch, run_batch
+from serialization import NegotiatingJSONProvider
+import profiling
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -13,23 +22,30 @@ logging.basicConfig(level=logging.DEBUG)
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 # Create Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
 
+# API responses in JSON, or MessagePack for clients that ask for it
+app.json = NegotiatingJSONProvider(app)
+
 # Configure database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///inventory.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+app.config["SQLALCHEMY_DATABASE_URI"] = normalize_database_uri(os.environ.get("DATABASE_URL", "sqlite:///inventory.db"))
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+app.config["SQLALCHEMY_BINDS"] = replica_binds()
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Initialize app with the extension
 db.init_app(app)
 
+# Fingerprinted, precompressed static files and gzip for large responses
+init_assets(app)
+
+# Per-request profiling, only when PROFILE_TOKEN is set
+profiling.init_profiling(app)
+
 # Add context processors
 @app.context_processor
 def utility_processor():
@@ -39,24 +55,119 @@ def utility_processor():
 
 # Import routes after app is created to avoid circular imports
 with app.app_context():
+    # Per-backend connection settings (SQLite WAL, busy timeout, ...)
+    for engine in db.engines.values():
+        configure_engine(engine)
+        profiling.install_sql_capture(engine)
+    
     # Import models to ensure tables are created
     from models import Product, Inventory, OrderPeriod, Order, OrderItem
     db.create_all()
     
+    # Columns and indexes that tables created by older versions lack
+    from migrations import upgrade_database
+    upgrade_database(db)
+    
     # Import utility functions
-    from utils import get_current_inventory, get_current_order_period, get_orders_for_period, toggle_delivery_status
+    from utils import (
+        get_current_inventory,
+        get_current_order_period,
+        get_order_period,
+        get_orders_for_period,
+        get_order,
+        get_user_orders,
+        decode_order_cursor,
+        normalize_order_items,
+        delete_order as remove_order,
+        create_order_period as open_order_period,
+        toggle_order_period as switch_order_period,
+        update_inventory as set_inventory,
+        set_inventory_levels,
+        adjust_inventory,
+        toggle_delivery_status
+    )
+    from inventory_ledger import (
+        ensure_opening_balances,
+        inventory_snapshot,
+        period_stock,
+        get_movements,
+        serialize_movement
+    )
+    
+    # Stock that predates the ledger gets an opening movement
+    ensure_opening_balances()
+    from write_coalescer import coalesced_add_order as save_order
+    import queries
+    from events import record_event, stream_events, wait_for_events, latest_event_id, visible_to
+    from product_search import search_products
+    from fulltext import ensure_search_index, search_orders, serialize_search_result
+    
+    # Order search index (FTS5 / tsvector) and the triggers keeping it in sync
+    ensure_search_index(db)
+    from allocation import allocate_period, get_allocations
+    from picklist import get_picklist, picklist_csv
+    from jobs import Job, submit_job, cancel_job, serialize_job, export_path
+
+@app.before_request
+def remember_guild():
+    # Pages opened with ?guild_id=X keep showing that guild's data
+    remember_request_guild()
+
+def period_or_404(period_id):
+    """
+    Returns an order period of the current guild, or aborts with a 404.
+    """
+    period = get_order_period(period_id)
+    if not period:
+        abort(404)
+    return period
+
+def order_or_404(order_id):
+    """
+    Returns an order of the current guild, or aborts with a 404.
+    """
+    order = get_order(order_id)
+    if not order:
+        abort(404)
+    return order
+
+def job_or_404(job_id):
+    """
+    Returns a job of the current guild, or aborts with a 404.
+    """
+    job = Job.query.filter_by(id=job_id, guild_id=current_guild_id()).first()
+    if not job:
+        abort(404)
+    return job
+
+def guild_periods():
+    """
+    Returns the current guild's order periods, newest first.
+    """
+    return (OrderPeriod.query
+            .filter_by(guild_id=current_guild_id())
+            .order_by(OrderPeriod.year.desc(), OrderPeriod.month.desc())
+            .all())
+
+# Upper bound on the products set by one PUT /api/inventory
+MAX_BULK_INVENTORY_ITEMS = 5000
 
 # Routes
 @app.route('/')
+@replica_reads
 def index():
-    return render_template('index.html')
+    # Replay the last few changes into the activity feed, then stream new ones
+    live_cursor = max(latest_event_id() - 10, 0)
+    return render_template('index.html', live_cursor=live_cursor)
 
 @app.route('/products')
+@replica_reads
 def products():
     products_list = Product.query.all()
     return render_template('products.html', products=products_list)
 
 @app.route('/products/add', methods=['POST'])
+@rate_limited('forms', redirect_to='products')
 def add_product():
     name = request.form.get('name')
     description = request.form.get('description', '')
@@ -66,7 +177,7 @@ def add_product():
         return redirect(url_for('products'))
     
     # Check if product already exists
-    existing = Product.query.filter_by(name=name).first()
+    existing = queries.product_by_name(name)
     if existing:
         flash(f'A product with the name "{name}" already exists', 'danger')
         return redirect(url_for('products'))
@@ -74,12 +185,15 @@ def add_product():
     # Create new product
     product = Product(name=name, description=description)
     db.session.add(product)
+    db.session.flush()
+    record_event('product.created', product_id=product.id, name=name, description=description)
     db.session.commit()
     
     flash(f'Product "{name}" added successfully', 'success')
     return redirect(url_for('products'))
 
 @app.route('/products/update', methods=['POST'])
+@rate_limited('forms', redirect_to='products')
 def update_product():
     product_id = request.form.get('editing_product_id', type=int)
     name = request.form.get('name')
@@ -99,35 +213,39 @@ def update_product():
     
     product.name = name
     product.description = description
+    record_event('product.updated', product_id=product.id, name=name, description=description)
     db.session.commit()
     
     flash(f'Product "{name}" updated successfully', 'success')
     return redirect(url_for('products'))
 
 @app.route('/products/<int:product_id>/delete', methods=['POST'])
+@rate_limited('forms', redirect_to='products')
 def delete_product(product_id):
     product = Product.query.get_or_404(product_id)
     
-    # Delete associated inventory items
-    Inventory.query.filter_by(product_id=product_id).delete()
-    
-    # Delete associated order items
-    OrderItem.query.filter_by(product_id=product_id).delete()
-    
-    # Delete the product
-    db.session.delete(product)
-    db.session.commit()
+    # Order items are removed across all history, which runs as a background job
+    job, error = submit_job('purge_product', product_id=product_id)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('products'))
     
-    flash(f'Product "{product.name}" and all related inventory/order items have been deleted', 'success')
+    flash(f'Deletion of product "{product.name}" and all related inventory/order items has started (job #{job.id})', 'info')
     return redirect(url_for('products'))
 
 @app.route('/inventory')
+@replica_reads
 def inventory():
+    # Taken before the page's data so no change can fall between the two
+    live_cursor = latest_event_id()
     inventory_items = get_current_inventory()
-    products = Product.query.all()
-    return render_template('inventory.html', inventory=inventory_items, products=products)
+    products = Product.query.order_by(Product.name).all()
+    stock = {item.product_id: item.quantity for item in inventory_items}
+    return render_template('inventory.html', inventory=inventory_items, products=products, stock=stock,
+                           live_cursor=live_cursor)
 
 @app.route('/inventory/update', methods=['POST'])
+@rate_limited('forms', redirect_to='inventory')
 def update_inventory():
     product_id = request.form.get('product_id', type=int)
     quantity = request.form.get('quantity', type=int)
@@ -136,26 +254,25 @@ def update_inventory():
         flash('Invalid input data', 'danger')
         return redirect(url_for('inventory'))
     
-    inventory_item = Inventory.query.filter_by(product_id=product_id).first()
+    inventory_item, error = set_inventory(product_id, quantity)
     
-    if inventory_item:
-        inventory_item.quantity = quantity
-    else:
-        inventory_item = Inventory(product_id=product_id, quantity=quantity)
-        db.session.add(inventory_item)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('inventory'))
     
-    db.session.commit()
     flash('Inventory updated successfully', 'success')
     return redirect(url_for('inventory'))
 
 @app.route('/order_periods')
+@replica_reads
 def order_periods():
-    periods = OrderPeriod.query.order_by(OrderPeriod.year.desc(), OrderPeriod.month.desc()).all()
+    periods = guild_periods()
     current_period = get_current_order_period()
     
     return render_template('order_periods.html', periods=periods, current_period=current_period)
 
 @app.route('/order_periods/create', methods=['POST'])
+@rate_limited('forms', redirect_to='order_periods')
 def create_order_period():
     month = request.form.get('month', type=int)
     year = request.form.get('year', type=int)
@@ -164,54 +281,53 @@ def create_order_period():
         flash('Invalid month or year', 'danger')
         return redirect(url_for('order_periods'))
     
-    # Check if this period already exists
-    existing = OrderPeriod.query.filter_by(month=month, year=year).first()
-    if existing:
-        flash('This order period already exists', 'danger')
+    new_period, error = open_order_period(month, year)
+    if error:
+        flash(error, 'danger')
         return redirect(url_for('order_periods'))
     
-    # Close all currently open periods
-    open_periods = OrderPeriod.query.filter_by(is_open=True).all()
-    for period in open_periods:
-        period.is_open = False
-    
-    # Create new period
-    new_period = OrderPeriod(month=month, year=year, is_open=True)
-    db.session.add(new_period)
-    db.session.commit()
-    
     flash(f'Order period for {month}/{year} created and opened', 'success')
     return redirect(url_for('order_periods'))
 
 @app.route('/order_periods/<int:period_id>/toggle', methods=['POST'])
+@rate_limited('forms', redirect_to='order_periods')
 def toggle_order_period(period_id):
-    period = OrderPeriod.query.get_or_404(period_id)
+    period_or_404(period_id)
     
-    if period.is_open:
-        # Close this period
-        period.is_open = False
-        action = "closed"
-    else:
-        # Close all open periods
-        open_periods = OrderPeriod.query.filter_by(is_open=True).all()
-        for p in open_periods:
-            p.is_open = False
-        
-        # Open this period
-        period.is_open = True
-        action = "opened"
+    period, error = switch_order_period(period_id)
+    action = "opened" if period.is_open else "closed"
     
-    db.session.commit()
     flash(f'Order period {period.month}/{period.year} has been {action}', 'success')
     return redirect(url_for('order_periods'))
 
+@app.route('/order_periods/<int:period_id>/picklist')
+@replica_reads
+def order_period_picklist(period_id):
+    period = period_or_404(period_id)
+    picklist = get_picklist(period)
+    output = request.args.get('format', 'html')
+    
+    if output == 'csv':
+        return Response(
+            stream_with_context(picklist_csv(picklist)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename=picklist-{period.year}-{period.month:02d}.csv'}
+        )
+    
+    if output == 'print':
+        return render_template('picklist_print.html', period=period, picklist=picklist)
+    
+    return render_template('picklist.html', period=period, picklist=picklist)
+
 @app.route('/orders')
+@replica_reads
 def orders():
+    live_cursor = latest_event_id()
     period_id = request.args.get('period_id', type=int)
     current_period = get_current_order_period()
     
     if period_id:
-        period = OrderPeriod.query.get_or_404(period_id)
+        period = period_or_404(period_id)
     else:
         period = current_period
     
@@ -219,7 +335,7 @@ def orders():
     if period:
         orders = get_orders_for_period(period.id)
     
-    periods = OrderPeriod.query.order_by(OrderPeriod.year.desc(), OrderPeriod.month.desc()).all()
+    periods = guild_periods()
     products = Product.query.all()
     
     return render_template('orders.html', 
@@ -227,9 +343,12 @@ def orders():
                           period=period,
                           periods=periods, 
                           products=products, 
-                          current_period=current_period)
+                          product_names={p.id: p.name for p in products},
+                          current_period=current_period,
+                          live_cursor=live_cursor)
 
 @app.route('/orders/add', methods=['POST'])
+@rate_limited('forms', redirect_to='orders')
 def add_order():
     current_period = get_current_order_period()
     
@@ -246,58 +365,41 @@ def add_order():
         flash('Missing required fields', 'danger')
         return redirect(url_for('orders'))
     
-    # Check if user already has an order for this period
-    existing_order = Order.query.filter_by(
-        user_id=user_id, 
-        order_period_id=current_period.id
-    ).first()
+    try:
+        items = [
+            {'product_id': int(product_ids[i]), 'quantity': int(quantities[i])}
+            for i in range(min(len(product_ids), len(quantities)))
+        ]
+    except ValueError:
+        flash('Products and quantities must be whole numbers', 'danger')
+        return redirect(url_for('orders'))
+    
+    order, error = save_order(user_id, user_name, items)
     
-    if existing_order:
-        # Delete existing order items
-        OrderItem.query.filter_by(order_id=existing_order.id).delete()
-        order = existing_order
-    else:
-        # Create new order
-        order = Order(
-            user_id=user_id,
-            user_name=user_name,
-            order_period_id=current_period.id
-        )
-        db.session.add(order)
-        db.session.flush()  # To get the order.id
-    
-    # Add order items
-    for i in range(len(product_ids)):
-        if i < len(quantities) and int(quantities[i]) > 0:
-            item = OrderItem(
-                order_id=order.id,
-                product_id=int(product_ids[i]),
-                quantity=int(quantities[i])
-            )
-            db.session.add(item)
+    if error:
+        flash(error, 'danger')
+        return redirect(url_for('orders'))
     
-    db.session.commit()
     flash('Order saved successfully', 'success')
     return redirect(url_for('orders'))
 
 @app.route('/orders/<int:order_id>/delete', methods=['POST'])
+@rate_limited('forms', redirect_to='orders')
 def delete_order(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = order_or_404(order_id)
     current_period = get_current_order_period()
     
     if not current_period or order.order_period_id != current_period.id:
         flash('Can only delete orders from the current open period', 'danger')
         return redirect(url_for('orders'))
     
-    # Delete order items first
-    OrderItem.query.filter_by(order_id=order.id).delete()
-    db.session.delete(order)
-    db.session.commit()
+    remove_order(order.id)
     
     flash('Order deleted successfully', 'success')
     return redirect(url_for('orders'))
 
 @app.route('/orders/<int:order_id>/toggle-delivery', methods=['POST'])
+@rate_limited('forms', redirect_to='orders')
 def toggle_order_delivery(order_id):
     order, error = toggle_delivery_status(order_id)
     
@@ -316,7 +418,14 @@ def toggle_order_delivery(order_id):
 
 # API endpoints
 @app.route('/api/inventory', methods=['GET'])
+@replica_reads
 def api_inventory():
+    at = request.args.get('at')
+    period_id = request.args.get('period_id', type=int)
+    
+    if at or period_id:
+        return api_inventory_history(at, period_id)
+    
     inventory_items = get_current_inventory()
     result = []
     
@@ -329,7 +438,96 @@ def api_inventory():
     
     return jsonify(result)
 
+def api_inventory_history(at, period_id):
+    """
+    Stock levels at a point in time (?at=ISO datetime, UTC) or when an
+    order period closed (?period_id=X).
+    """
+    if period_id:
+        period = period_or_404(period_id)
+        balances = period_stock(period_id)
+        if not balances and period.is_open:
+            return jsonify({'error': 'This order period has not been closed yet'}), 409
+    else:
+        try:
+            moment = datetime.fromisoformat(at)
+        except ValueError:
+            return jsonify({'error': 'Invalid datetime for at'}), 400
+        if moment.tzinfo:
+            # Timestamps are stored as naive UTC
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        balances = inventory_snapshot(current_guild_id(), moment)
+    
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(balances)))
+    result = [
+        {'product_id': product_id, 'product_name': names[product_id], 'quantity': quantity}
+        for product_id, quantity in sorted(balances.items())
+        if product_id in names
+    ]
+    
+    return jsonify(result)
+
+@app.route('/api/inventory', methods=['PUT'])
+@rate_limited('inventory')
+def api_set_inventory():
+    data = request.json
+    
+    # Either a bare list of {product_id, quantity} or {"items": [...], "note": "..."}
+    if isinstance(data, dict):
+        items, note = data.get('items'), data.get('note')
+    else:
+        items, note = data, None
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Expected a non-empty list of {product_id, quantity}'}), 400
+    if len(items) > MAX_BULK_INVENTORY_ITEMS:
+        return jsonify({'error': f'At most {MAX_BULK_INVENTORY_ITEMS} items per request'}), 400
+    
+    changes, error = set_inventory_levels(items, note=note or 'Stock count')
+    
+    if error:
+        status = 404 if error.startswith('Products not found') else 400
+        return jsonify({'error': error}), status
+    
+    return jsonify({'updated': changes, 'unchanged': len(items) - len(changes)})
+
+@app.route('/api/inventory/<int:product_id>/movements', methods=['GET'])
+@replica_reads
+def api_inventory_movements(product_id):
+    Product.query.get_or_404(product_id)
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    
+    movements = get_movements(current_guild_id(), product_id, before=before, limit=limit)
+    
+    return jsonify({
+        'movements': [serialize_movement(m) for m in movements],
+        'next_before': movements[-1].id if len(movements) == limit else None
+    })
+
+@app.route('/api/inventory/<int:product_id>/movements', methods=['POST'])
+@rate_limited('inventory')
+def api_add_inventory_movement(product_id):
+    data = request.json
+    
+    if not data or 'delta' not in data or 'kind' not in data:
+        return jsonify({'error': 'Missing required fields: kind, delta'}), 400
+    
+    delta = data.get('delta')
+    if not isinstance(delta, int) or isinstance(delta, bool):
+        return jsonify({'error': 'delta must be an integer'}), 400
+    
+    movement, error = adjust_inventory(product_id, delta, data['kind'], note=data.get('note'))
+    
+    if error:
+        status = 404 if error == 'Product not found' else 400
+        return jsonify({'error': error}), status
+    
+    inventory_item = Inventory.query.get((current_guild_id(), product_id))
+    return jsonify({**serialize_movement(movement), 'quantity': inventory_item.quantity}), 201
+
 @app.route('/api/products', methods=['GET'])
+@replica_reads
 def api_products():
     products = Product.query.all()
     result = []
@@ -343,9 +541,46 @@ def api_products():
     
     return jsonify(result)
 
+@app.route('/api/products/search', methods=['GET'])
+@replica_reads
+def api_search_products():
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', 10, type=int)
+    
+    if not query:
+        return jsonify({"error": "Missing search query"}), 400
+    
+    results = search_products(query, max(1, min(limit, 50)))
+    
+    return jsonify([{
+        'id': product_id,
+        'name': name,
+        'description': description,
+        'score': score
+    } for product_id, name, description, score in results])
+
+@app.route('/api/search', methods=['GET'])
+@replica_reads
+def api_search():
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    if not query:
+        return jsonify({"error": "Missing search query"}), 400
+    
+    # One extra row tells whether there is a next page
+    results = search_orders(query, limit=limit + 1, offset=offset)
+    
+    return jsonify({
+        'results': [serialize_search_result(order, score) for order, score in results[:limit]],
+        'next_offset': offset + limit if len(results) > limit else None
+    })
+
 @app.route('/api/order_periods', methods=['GET'])
+@replica_reads
 def api_order_periods():
-    periods = OrderPeriod.query.order_by(OrderPeriod.year.desc(), OrderPeriod.month.desc()).all()
+    periods = guild_periods()
     result = []
     
     for period in periods:
@@ -359,6 +594,7 @@ def api_order_periods():
     return jsonify(result)
 
 @app.route('/api/order_periods/current', methods=['GET'])
+@replica_reads
 def api_current_order_period():
     period = get_current_order_period()
     
@@ -373,6 +609,7 @@ def api_current_order_period():
     })
 
 @app.route('/api/order_periods', methods=['POST'])
+@rate_limited('order_periods')
 def api_create_order_period():
     data = request.json
     
@@ -385,20 +622,9 @@ def api_create_order_period():
     if not isinstance(month, int) or not isinstance(year, int) or month < 1 or month > 12:
         return jsonify({"error": "Invalid month or year"}), 400
     
-    # Check if this period already exists
-    existing = OrderPeriod.query.filter_by(month=month, year=year).first()
-    if existing:
-        return jsonify({"error": "This order period already exists"}), 400
-    
-    # Close all currently open periods
-    open_periods = OrderPeriod.query.filter_by(is_open=True).all()
-    for period in open_periods:
-        period.is_open = False
-    
-    # Create new period
-    new_period = OrderPeriod(month=month, year=year, is_open=True)
-    db.session.add(new_period)
-    db.session.commit()
+    new_period, error = open_order_period(month, year)
+    if error:
+        return jsonify({"error": error}), 400
     
     return jsonify({
         'id': new_period.id,
@@ -408,22 +634,11 @@ def api_create_order_period():
     }), 201
 
 @app.route('/api/order_periods/<int:period_id>/toggle', methods=['POST'])
+@rate_limited('order_periods')
 def api_toggle_order_period(period_id):
-    period = OrderPeriod.query.get_or_404(period_id)
-    
-    if period.is_open:
-        # Close this period
-        period.is_open = False
-    else:
-        # Close all open periods
-        open_periods = OrderPeriod.query.filter_by(is_open=True).all()
-        for p in open_periods:
-            p.is_open = False
-        
-        # Open this period
-        period.is_open = True
+    period_or_404(period_id)
     
-    db.session.commit()
+    period, error = switch_order_period(period_id)
     
     return jsonify({
         'id': period.id,
@@ -432,12 +647,46 @@ def api_toggle_order_period(period_id):
         'is_open': period.is_open
     })
 
+@app.route('/api/order_periods/<int:period_id>/allocate', methods=['POST'])
+@rate_limited('order_periods')
+def api_allocate_order_period(period_id):
+    period = period_or_404(period_id)
+    data = request.get_json(silent=True) or {}
+    policy = data.get('policy', 'proportional')
+    
+    summary, error = allocate_period(period, policy, data.get('cap'))
+    
+    if error:
+        return jsonify({"error": error}), 400
+    
+    db.session.commit()
+    
+    return jsonify({
+        'order_period_id': period.id,
+        'policy': policy,
+        'products': summary
+    })
+
+@app.route('/api/order_periods/<int:period_id>/allocations', methods=['GET'])
+@replica_reads
+def api_order_period_allocations(period_id):
+    period_or_404(period_id)
+    
+    return jsonify([{
+        'order_id': allocation.order_id,
+        'product_id': allocation.product_id,
+        'requested': allocation.requested,
+        'allocated': allocation.allocated,
+        'policy': allocation.policy
+    } for allocation in get_allocations(period_id)])
+
 @app.route('/api/orders', methods=['GET'])
+@replica_reads
 def api_orders():
     period_id = request.args.get('period_id', type=int)
     
     if period_id:
-        period = OrderPeriod.query.get_or_404(period_id)
+        period = period_or_404(period_id)
     else:
         period = get_current_order_period()
         if not period:
@@ -466,17 +715,13 @@ def api_orders():
     return jsonify(result)
 
 @app.route('/api/orders', methods=['POST'])
+@rate_limited('orders')
 def api_add_order():
     data = request.json
     
     if not data:
         return jsonify({"error": "No data provided"}), 400
     
-    current_period = get_current_order_period()
-    
-    if not current_period:
-        return jsonify({"error": "No open order period available"}), 400
-    
     user_name = data.get('user_name')
     user_id = data.get('user_id', user_name)  # Default to username if no ID
     items = data.get('items', [])
@@ -484,40 +729,20 @@ def api_add_order():
     if not user_name or not items:
         return jsonify({"error": "Missing required fields"}), 400
     
-    # Check if user already has an order for this period
-    existing_order = Order.query.filter_by(
-        user_id=user_id, 
-        order_period_id=current_period.id
-    ).first()
+    # Malformed items are rejected without a database round trip
+    items, error = normalize_order_items(items)
+    if error:
+        return jsonify({"error": error}), 400
+    
+    current_period = get_current_order_period()
     
-    if existing_order:
-        # Delete existing order items
-        OrderItem.query.filter_by(order_id=existing_order.id).delete()
-        order = existing_order
-    else:
-        # Create new order
-        order = Order(
-            user_id=user_id,
-            user_name=user_name,
-            order_period_id=current_period.id
-        )
-        db.session.add(order)
-        db.session.flush()  # To get the order.id
+    if not current_period:
+        return jsonify({"error": "No open order period available"}), 400
     
-    # Add order items
-    for item in items:
-        product_id = item.get('product_id')
-        quantity = item.get('quantity')
-        
-        if product_id and quantity and quantity > 0:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=product_id,
-                quantity=quantity
-            )
-            db.session.add(order_item)
+    order, error = save_order(user_id, user_name, items)
     
-    db.session.commit()
+    if error:
+        return jsonify({"error": error}), 400
     
     return jsonify({
         'id': order.id,
@@ -528,21 +753,20 @@ def api_add_order():
     }), 201
 
 @app.route('/api/orders/<int:order_id>', methods=['DELETE'])
+@rate_limited('orders')
 def api_delete_order(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = order_or_404(order_id)
     current_period = get_current_order_period()
     
     if not current_period or order.order_period_id != current_period.id:
         return jsonify({"error": "Can only delete orders from the current open period"}), 400
     
-    # Delete order items first
-    OrderItem.query.filter_by(order_id=order.id).delete()
-    db.session.delete(order)
-    db.session.commit()
+    remove_order(order.id)
     
     return jsonify({"success": True}), 200
 
 @app.route('/api/orders/<int:order_id>/toggle-delivery', methods=['POST'])
+@rate_limited('orders')
 def api_toggle_order_delivery(order_id):
     order, error = toggle_delivery_status(order_id)
     
@@ -556,3 +780,215 @@ def api_toggle_order_delivery(order_id):
         'is_delivered': order.is_delivered,
         'order_period_id': order.order_period_id
     })
+
+@app.route('/api/users/<user_id>/orders', methods=['GET'])
+@replica_reads
+def api_user_orders(user_id):
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    cursor = request.args.get('cursor')
+    
+    after = None
+    if cursor:
+        after, error = decode_order_cursor(cursor)
+        if error:
+            return jsonify({"error": error}), 400
+    
+    orders, next_cursor = get_user_orders(user_id, limit=limit, after=after)
+    
+    return jsonify({
+        'orders': [{
+            'id': order.id,
+            'user_id': order.user_id,
+            'user_name': order.user_name,
+            'is_delivered': order.is_delivered,
+            'order_period': {
+                'id': order.order_period.id,
+                'month': order.order_period.month,
+                'year': order.order_period.year,
+            },
+            'items': [{
+                'product_id': item.product_id,
+                'product_name': item.product.name,
+                'quantity': item.quantity
+            } for item in order.items],
+            'created_at': order.created_at.isoformat()
+        } for order in orders],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    after = request.args.get('after', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    wait = max(0.0, min(request.args.get('wait', 0, type=float), 30.0))
+    
+    # With wait=N the request long-polls until an event arrives or N seconds pass
+    events = wait_for_events(after, wait, limit)
+    cursor = events[-1]['id'] if events else after
+    
+    # The cursor still moves past other guilds' events
+    guild_id = current_guild_id()
+    events = [e for e in events if visible_to(e, guild_id)]
+    
+    return jsonify({'cursor': cursor, 'events': events})
+
+@app.route('/api/events/stream', methods=['GET'])
+def api_event_stream():
+    # Browsers resend the last id they saw in Last-Event-ID when reconnecting
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', type=int)
+    if after is None:
+        # Without an offset, only changes from now on are streamed
+        after = latest_event_id()
+    
+    return Response(
+        stream_with_context(stream_events(after, current_guild_id())),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def job_accepted(job):
+    """
+    Returns the 202 response for a queued job, pointing at its status URL.
+    """
+    status_url = url_for('api_job', job_id=job.id)
+    response = jsonify({**serialize_job(job), 'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+@app.route('/api/products/<int:product_id>/purge', methods=['POST'])
+@rate_limited('jobs')
+def api_purge_product(product_id):
+    Product.query.get_or_404(product_id)
+    
+    job, error = submit_job('purge_product', product_id=product_id)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    return job_accepted(job)
+
+@app.route('/api/order_periods/<int:period_id>/close', methods=['POST'])
+@rate_limited('jobs')
+def api_close_order_period(period_id):
+    period_or_404(period_id)
+    
+    job, error = submit_job('close_period', period_id=period_id)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    return job_accepted(job)
+
+@app.route('/api/order_periods/<int:period_id>/totals', methods=['POST'])
+@rate_limited('jobs')
+def api_recompute_totals(period_id):
+    period_or_404(period_id)
+    
+    job, error = submit_job('recompute_totals', period_id=period_id)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    return job_accepted(job)
+
+@app.route('/api/order_periods/<int:period_id>/export', methods=['POST'])
+@rate_limited('jobs')
+def api_export_order_period(period_id):
+    period_or_404(period_id)
+    
+    job, error = submit_job('export_period', period_id=period_id)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    return job_accepted(job)
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs():
+    status = request.args.get('status')
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    
+    query = Job.query.filter_by(guild_id=current_guild_id())
+    if status:
+        query = query.filter_by(status=status)
+    jobs = query.order_by(Job.id.desc()).limit(limit).all()
+    
+    return jsonify([serialize_job(job) for job in jobs])
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def api_job(job_id):
+    job = job_or_404(job_id)
+    return jsonify(serialize_job(job))
+
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+@rate_limited('jobs')
+def api_cancel_job(job_id):
+    job_or_404(job_id)
+    
+    job, error = cancel_job(job_id)
+    if error:
+        return jsonify({'error': error}), 409
+    
+    return jsonify(serialize_job(job))
+
+@app.route('/api/jobs/<int:job_id>/download', methods=['GET'])
+def api_job_download(job_id):
+    job = job_or_404(job_id)
+    
+    if job.kind != 'export_period' or job.status != 'succeeded':
+        return jsonify({'error': 'No export available for this job'}), 404
+    
+    path = export_path(job.id)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Export file no longer exists'}), 410
+    
+    result = serialize_job(job)['result']
+    return send_file(os.path.abspath(path), mimetype='text/csv', as_attachment=True, download_name=result['filename'])
+
+@app.route('/api/rate_limits', methods=['GET'])
+def api_rate_limits():
+    # Counters are per worker process; pid tells the workers apart
+    return jsonify(limiter.metrics())
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    # Each sub-request is rate limited as if it had been sent on its own
+    sub_requests, transaction, error = parse_batch(request.get_json(silent=True))
+    
+    if error:
+        return jsonify({"error": error}), 400
+    
+    result = run_batch(app, sub_requests, transaction)
+    
+    # The transaction could not be kept or committed, whatever the sub-responses say
+    return jsonify(result), 500 if 'error' in result else 200
+
+@app.route('/admin/profiles')
+def admin_profiles():
+    if not profiling.request_is_admin():
+        abort(404)
+    
+    profiles = [profiling.load_profile(name) for name in profiling.list_profiles()]
+    return render_template('admin_profiles.html', profiles=[p for p in profiles if p])
+
+@app.route('/admin/profiles/<name>')
+def admin_profile(name):
+    if not profiling.request_is_admin():
+        abort(404)
+    
+    profile = profiling.load_profile(name)
+    if not profile:
+        abort(404)
+    
+    return render_template('admin_profiles.html', profile=profile)
+
+@app.route('/admin/profiles/<name>/download')
+def admin_profile_download(name):
+    if not profiling.request_is_admin():
+        abort(404)
+    
+    path = profiling.profile_path(name, '.prof')
+    if not path:
+        abort(404)
+    
+    return send_file(os.path.abspath(path), mimetype='application/octet-stream', as_attachment=True,
+                     download_name=name + '.prof')
@@ -0,0 +1,196 @@
+"""
+Static asset pipeline.
+
+``python assets.py`` copies every file under ``static/`` to
+``static/build/`` with a content hash in its name
+(``css/custom.3f2a9c1e.css``), writes gzip and brotli variants next to
+compressible files, renders downscaled icons from ``generated-icon.png``
+with Pillow, and records the mapping in ``static/build/manifest.json``.
+brotli and Pillow are only imported by the build, so serving does not need
+them.
+
+At runtime ``init_assets`` makes ``url_for('static', filename=...)`` return
+the fingerprinted name whenever the manifest has one. Fingerprinted files
+never change, so they are served with an immutable one-year cache lifetime
+and in the best precompressed encoding the browser accepts. Without a build
+everything is served from ``static/`` as before.
+
+Dynamic HTML, JSON, CSV and text responses above ``COMPRESS_MIN_SIZE`` bytes
+are gzipped on the fly. Streamed responses (the SSE feed, downloads) are
+left alone.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from io import BytesIO
+
+from flask import request, send_from_directory
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+BUILD_DIR = 'build'
+MANIFEST_NAME = 'manifest.json'
+ICON_SOURCE = os.path.join(BASE_DIR, 'generated-icon.png')
+ICON_SIZES = (32, 180, 192, 512)
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.map', '.html')
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/csv',
+                          'application/json', 'application/javascript', 'application/msgpack')
+
+# Below this size the gzip header and CPU time are not worth it
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def _fingerprint(logical_name, content):
+    root, ext = os.path.splitext(logical_name)
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    return f"{root}.{digest}{ext}"
+
+def _write_variants(path, content):
+    """
+    Writes the .gz (and .br) variants of a compressible file.
+    """
+    import brotli
+
+    with open(path + '.gz', 'wb') as f:
+        # mtime=0 keeps the output identical between builds
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(content, quality=11))
+
+def _add_asset(manifest, build_root, logical_name, content):
+    hashed = _fingerprint(logical_name, content)
+    target = os.path.join(build_root, hashed)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(content)
+    if logical_name.endswith(COMPRESSIBLE_EXTENSIONS):
+        _write_variants(target, content)
+    manifest[logical_name] = f"{BUILD_DIR}/{hashed}"
+
+def _render_icons():
+    """
+    Returns (logical name, PNG bytes) for each icon size.
+    """
+    from PIL import Image
+
+    with Image.open(ICON_SOURCE) as source:
+        source = source.convert('RGBA')
+        for size in ICON_SIZES:
+            icon = source.resize((size, size), Image.LANCZOS)
+            buffer = BytesIO()
+            icon.save(buffer, format='PNG', optimize=True)
+            yield f"icons/icon-{size}.png", buffer.getvalue()
+
+def build_assets(static_dir=STATIC_DIR):
+    """
+    Rebuilds ``static/build`` and its manifest.
+
+    Returns:
+        dict: Logical file name -> fingerprinted path under the static folder
+    """
+    build_root = os.path.join(static_dir, BUILD_DIR)
+    shutil.rmtree(build_root, ignore_errors=True)
+    manifest = {}
+
+    for directory, subdirs, files in os.walk(static_dir):
+        if directory == static_dir:
+            subdirs[:] = [d for d in subdirs if d != BUILD_DIR]
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            logical_name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                _add_asset(manifest, build_root, logical_name, f.read())
+
+    if os.path.exists(ICON_SOURCE):
+        for logical_name, content in _render_icons():
+            _add_asset(manifest, build_root, logical_name, content)
+
+    os.makedirs(build_root, exist_ok=True)
+    with open(os.path.join(build_root, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+def load_manifest(static_dir=STATIC_DIR):
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _accepts(encoding):
+    # Parsed with q-values, so "br;q=0" refuses brotli and "*" accepts it
+    return request.accept_encodings[encoding] > 0
+
+def init_assets(app):
+    """
+    Serves fingerprinted static files and compresses dynamic responses.
+    """
+    manifest = load_manifest(app.static_folder)
+    serve_static = app.view_functions['static']
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+
+    def static(filename):
+        if not filename.startswith(BUILD_DIR + '/'):
+            return serve_static(filename=filename)
+
+        response = None
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if _accepts(encoding) and os.path.exists(os.path.join(app.static_folder, filename + suffix)):
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=_mimetype(filename), conditional=True)
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = serve_static(filename=filename)
+
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.view_functions['static'] = static
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code >= 300
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if not _accepts('gzip'):
+            return response
+
+        content = response.get_data()
+        if len(content) < COMPRESS_MIN_SIZE:
+            return response
+
+        response.set_data(gzip.compress(content, compresslevel=COMPRESS_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        if response.headers.get('ETag'):
+            # The compressed body is a different representation
+            response.set_etag(response.get_etag()[0] + '-gzip', weak=True)
+        return response
+
+    def has_asset(name):
+        return name in manifest
+
+    app.jinja_env.globals['has_asset'] = has_asset
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+if __name__ == "__main__":
+    built = build_assets()
+    print(f"Built {len(built)} assets into {os.path.join(STATIC_DIR, BUILD_DIR)}")
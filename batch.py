@@ -0,0 +1,191 @@
+"""
+Several API calls in one HTTP request.
+
+``POST /api/batch`` takes an ordered list of sub-requests::
+
+    {"transaction": true,
+     "requests": [{"method": "GET", "path": "/api/order_periods/current"},
+                  {"method": "POST", "path": "/api/orders", "body": {...}}]}
+
+and answers with one ``{"status": ..., "body": ...}`` per sub-request, in
+order. Each sub-request is dispatched to the regular API view with the
+caller's headers and session, so guild selection, validation and rate limits
+apply as if it had been sent on its own. Sub-requests share the app context,
+so they share one database session and per-request caches such as the
+current order period.
+
+With ``"transaction": true`` the handlers' commits only flush and the batch
+commits once at the end. The first sub-request that fails rolls everything
+back and the remaining ones are not run. A sub-request that rolls back or
+replaces the session ends the batch the same way, with an error, since the
+earlier changes went with it. Endpoints that hand work to background jobs
+cannot be part of a transaction.
+"""
+import logging
+import os
+
+from flask import request, session as http_session
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", "50"))
+
+# Streams, downloads and batches cannot be nested in a batch
+EXCLUDED_ENDPOINTS = {'api_batch', 'api_event_stream', 'api_job_download'}
+
+# These start background jobs, which cannot see an uncommitted transaction
+NON_TRANSACTIONAL_ENDPOINTS = {
+    'api_purge_product',
+    'api_close_order_period',
+    'api_recompute_totals',
+    'api_export_order_period',
+    'api_cancel_job',
+}
+
+# The body and the session are passed on separately; sub-responses are not
+# compressed, and are JSON whatever the batch response's own encoding
+_DROPPED_HEADERS = {'content-length', 'content-type', 'accept', 'accept-encoding', 'cookie', 'x-profile'}
+
+# Response headers worth returning with a sub-response
+_KEPT_HEADERS = ('Location', 'Retry-After', 'ETag', 'X-Profile-Id')
+
+def parse_batch(data):
+    """
+    Validates a batch request body.
+
+    Returns:
+        list: The sub-requests as (method, path, body) tuples
+        bool: Whether to run them in one transaction
+        str: Error message if any
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('requests'), list):
+        return None, False, "Expected an object with a 'requests' list"
+
+    specs = data['requests']
+    if not specs:
+        return None, False, "No requests provided"
+    if len(specs) > MAX_BATCH_REQUESTS:
+        return None, False, f"At most {MAX_BATCH_REQUESTS} requests per batch"
+
+    requests = []
+    for index, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            return None, False, f"Request {index}: expected an object"
+        method = str(spec.get('method', 'GET')).upper()
+        path = spec.get('path')
+        if method not in ('GET', 'POST', 'PUT', 'DELETE'):
+            return None, False, f"Request {index}: unsupported method {method}"
+        if not isinstance(path, str) or not path.startswith('/api/'):
+            return None, False, f"Request {index}: path must start with /api/"
+        requests.append((method, path, spec.get('body')))
+
+    return requests, bool(data.get('transaction', False)), None
+
+def _result(status, body, headers=None):
+    result = {'status': status, 'body': body}
+    if headers:
+        result['headers'] = headers
+    return result
+
+def _run_one(app, method, path, body, headers, remote_addr, transaction):
+    parent_session = http_session._get_current_object()
+
+    with app.test_request_context(path, method=method, json=body, headers=headers,
+                                  environ_base={'REMOTE_ADDR': remote_addr}):
+        if request.endpoint in EXCLUDED_ENDPOINTS:
+            return _result(400, {'error': f"{path} cannot be part of a batch"})
+        if transaction and request.endpoint in NON_TRANSACTIONAL_ENDPOINTS:
+            return _result(400, {'error': f"{path} cannot be part of a transaction"})
+
+        # The guild choice and the replica lag marker carry over between sub-requests
+        http_session.update(parent_session)
+        response = app.full_dispatch_request()
+        parent_session.update(http_session)
+
+    if response.is_json:
+        content = response.get_json()
+    else:
+        content = response.get_data(as_text=True)
+    kept = {name: response.headers[name] for name in _KEPT_HEADERS if name in response.headers}
+    return _result(response.status_code, content, kept)
+
+def run_batch(app, requests, transaction=False):
+    """
+    Runs parsed sub-requests within the current request.
+
+    Args:
+        app (Flask): The application
+        requests (list): (method, path, body) tuples from parse_batch
+        transaction (bool): Run them all in one transaction
+
+    Returns:
+        dict: The sub-responses, and whether the transaction was committed
+    """
+    from app import db
+
+    headers = [(name, value) for name, value in request.headers.items()
+               if name.lower() not in _DROPPED_HEADERS]
+    remote_addr = request.remote_addr
+
+    results = []
+    failed = False
+    lost = False
+    session = db.session()  # The session the transaction is held in
+    held = None  # Its transaction, once a sub-request has begun one
+    if transaction:
+        session.info['hold_commits'] = True
+    try:
+        for method, path, body in requests:
+            try:
+                result = _run_one(app, method, path, body, headers, remote_addr, transaction)
+            except Exception:
+                logger.exception("Batch sub-request %s %s failed", method, path)
+                db.session.rollback()
+                result = _result(500, {'error': 'Internal server error'})
+            results.append(result)
+
+            if not transaction:
+                continue
+
+            # A handler that rolled back or replaced the session took the earlier
+            # sub-requests' changes with it, even if it answered with a success
+            current = session.get_transaction()
+            if (session.info.get('rolled_back') or db.session() is not session
+                    or (held is not None and current is not held)):
+                logger.error("Batch sub-request %s %s ended the transaction", method, path)
+                if result['status'] < 400:
+                    results[-1] = _result(500, {'error': 'The request ended the transaction'})
+                failed = lost = True
+                break
+            held = held or current
+
+            if result['status'] >= 400:
+                failed = True
+                break
+    finally:
+        if transaction:
+            session.info.pop('hold_commits', None)
+            session.info.pop('rolled_back', None)
+
+    if not transaction:
+        return {'responses': results}
+
+    skipped = len(requests) - len(results)
+    results.extend(_result(424, {'error': 'Not run, an earlier request in the transaction failed'})
+                   for _ in range(skipped))
+
+    if failed:
+        session.rollback()
+        db.session.rollback()
+        if lost:
+            return {'responses': results, 'committed': False, 'error': 'The transaction was ended by a request'}
+        return {'responses': results, 'committed': False}
+
+    try:
+        db.session.commit()
+    except Exception:
+        logger.exception("Batch transaction commit failed")
+        db.session.rollback()
+        return {'responses': results, 'committed': False, 'error': 'The transaction could not be committed'}
+
+    return {'responses': results, 'committed': True}
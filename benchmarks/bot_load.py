@@ -0,0 +1,247 @@
+"""
+Load test for the Discord bot's command handlers, without Discord.
+
+Simulated users run ``!order`` (and reply to its prompt through a fake
+gateway), ``!inventory`` and ``!current_orders`` against the real handlers in
+discord_bot.py. Concurrency is ramped up in stages, and each stage reports
+throughput, command latency percentiles, event-loop lag and time spent in
+the database. Optional web-writer processes add concurrent order writes to
+the same database to show lock contention.
+
+    python benchmarks/bot_load.py --stages 50,100,250,500 --web-writers 2
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def setup_database(products):
+    from app import app, db
+    from models import Product, Inventory, OrderPeriod
+    from tenancy import DEFAULT_GUILD_ID
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for i in range(products):
+            product = Product(name=f"Product {i}", description=f"Load test product {i}")
+            db.session.add(product)
+            db.session.flush()
+            db.session.add(Inventory(guild_id=DEFAULT_GUILD_ID, product_id=product.id, quantity=1000))
+        db.session.add(OrderPeriod(guild_id=DEFAULT_GUILD_ID, month=1, year=2000, is_open=True))
+        db.session.commit()
+        return [product_id for (product_id,) in db.session.query(Product.id).all()]
+
+def web_writer(database_url, product_ids, stop_at, results):
+    # Runs in a separate process, standing in for a gunicorn worker taking orders
+    os.environ['DATABASE_URL'] = database_url
+    from sqlalchemy.exc import OperationalError
+    from app import app
+    from utils import add_order
+
+    rng = random.Random(os.getpid())
+    writes = locked = 0
+    with app.app_context():
+        while time.time() < stop_at:
+            items = [{'product_id': rng.choice(product_ids), 'quantity': rng.randint(1, 3)}]
+            try:
+                add_order(f"web-{rng.randrange(1000)}", "web user", items)
+                writes += 1
+            except OperationalError:
+                from app import db
+                db.session.rollback()
+                locked += 1
+    results.put((writes, locked))
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task sleeping for ``interval``.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - started - self.interval)
+
+    def start(self):
+        self.lags = []
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+class DatabaseTimer:
+    """
+    Accumulates time spent executing SQL statements on an engine.
+    """
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.statements = 0
+        self.elapsed = 0.0
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['load_test_started'] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        self.elapsed += time.perf_counter() - conn.info.pop('load_test_started', time.perf_counter())
+
+    def reset(self):
+        self.statements = 0
+        self.elapsed = 0.0
+
+async def simulate_user(bot_module, gateway, user, channel, product_ids, think_time, rng, stats):
+    from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
+    from discord_stub import StubContext
+
+    ctx = StubContext(user, channel)
+    command = rng.choices(['order', 'inventory', 'current_orders'], weights=[6, 2, 2])[0]
+    started = time.perf_counter()
+
+    try:
+        if command == 'order':
+            handler = asyncio.create_task(bot_module.place_order.callback(ctx))
+            # Scripted reply to the product prompt, typed after some thinking
+            await asyncio.sleep(think_time)
+            picks = rng.sample(product_ids, k=min(3, len(product_ids)))
+            reply = " ".join(f"{pid}:{rng.randint(1, 5)}" for pid in picks)
+            await gateway.deliver(user, channel, reply)
+            await handler
+            elapsed = time.perf_counter() - started - think_time
+        elif command == 'inventory':
+            await bot_module.show_inventory.callback(ctx)
+            elapsed = time.perf_counter() - started
+        else:
+            await bot_module.show_current_orders.callback(ctx)
+            elapsed = time.perf_counter() - started
+    except OperationalError:
+        stats['locked'] += 1
+        return
+    except PoolTimeout:
+        # Every pooled connection was checked out by a handler parked on an await
+        stats['pool_timeouts'] += 1
+        return
+    except Exception:
+        stats['errors'] += 1
+        return
+
+    stats['latencies'].setdefault(command, []).append(elapsed)
+
+async def run_stage(bot_module, gateway, users, args, product_ids, db_timer, rng):
+    from discord_stub import StubHTTP, StubUser
+    from discord_outbound import OutboundDispatcher
+
+    scale = args.time_scale
+    http = StubHTTP(latency=args.latency, time_scale=scale)
+    channels = [http.channel() for _ in range(args.channels)]
+    bot_module.outbound = OutboundDispatcher(channel_rate=(5, 5.0 * scale), global_rate=(50, 1.0 * scale))
+
+    stats = {'latencies': {}, 'locked': 0, 'pool_timeouts': 0, 'errors': 0}
+    monitor = LoopLagMonitor()
+    db_timer.reset()
+    monitor.start()
+    started = time.perf_counter()
+
+    # Users arrive spread over the ramp window rather than all in the same tick
+    async def arrive(i):
+        await asyncio.sleep(rng.random() * args.ramp)
+        user = StubUser(10_000 + i)
+        await simulate_user(bot_module, gateway, user, rng.choice(channels), product_ids,
+                            args.think_time, rng, stats)
+
+    await asyncio.gather(*(arrive(i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    await bot_module.outbound.drain()
+    delivered = time.perf_counter() - started
+    monitor.stop()
+
+    completed = sum(len(values) for values in stats['latencies'].values())
+    print(f"\n== {users} users: {completed} commands in {elapsed:.2f}s "
+          f"({completed / elapsed:.1f}/s), {stats['locked']} lock errors, "
+          f"{stats['pool_timeouts']} pool timeouts, {stats['errors']} other errors")
+    for command, values in sorted(stats['latencies'].items()):
+        print(f"   {command:>15}: n={len(values):4d}  p50={percentile(values, 0.5) * 1000:8.1f}ms  "
+              f"p95={percentile(values, 0.95) * 1000:8.1f}ms  p99={percentile(values, 0.99) * 1000:8.1f}ms")
+    print(f"   {'loop lag':>15}: p50={percentile(monitor.lags, 0.5) * 1000:8.1f}ms  "
+          f"p99={percentile(monitor.lags, 0.99) * 1000:8.1f}ms  max={max(monitor.lags, default=0) * 1000:8.1f}ms")
+    print(f"   {'database':>15}: {db_timer.statements} statements, {db_timer.elapsed:.2f}s "
+          f"({db_timer.elapsed / elapsed * 100:.0f}% of wall time, all of it blocking the loop)")
+    print(f"   {'discord':>15}: {len(http.requests)} requests, {http.rate_limited} rate limited, "
+          f"{bot_module.outbound.stats['coalesced']} replies coalesced, all delivered after {delivered:.2f}s")
+
+async def main_async(args, product_ids):
+    import discord_bot
+    from app import db, app
+    from discord_stub import FakeGateway
+
+    rng = random.Random(args.seed)
+    gateway = FakeGateway(discord_bot.bot)
+    with app.app_context():
+        db_timer = DatabaseTimer(db.engine)
+
+    for users in args.stages:
+        await run_stage(discord_bot, gateway, users, args, product_ids, db_timer, rng)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--stages', default='50,100,250,500',
+                        type=lambda value: [int(v) for v in value.split(',')],
+                        help='Comma-separated number of concurrent users per stage')
+    parser.add_argument('--ramp', type=float, default=5.0, help='Seconds over which users arrive')
+    parser.add_argument('--think-time', type=float, default=0.5, help='Seconds before replying to the order prompt')
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated Discord API latency in seconds')
+    parser.add_argument('--time-scale', type=float, default=0.1,
+                        help='Multiplier applied to Discord rate limit windows and latency')
+    parser.add_argument('--web-writers', type=int, default=0,
+                        help='Processes writing orders to the same database concurrently')
+    parser.add_argument('--database-url', default=None,
+                        help='Database to load (default: a temporary SQLite file)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if database_url is None:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}"
+    os.environ['DATABASE_URL'] = database_url
+    product_ids = setup_database(args.products)
+
+    writers = []
+    results = multiprocessing.Queue()
+    if args.web_writers:
+        # Keep writing for as long as the stages could plausibly take
+        stop_at = time.time() + len(args.stages) * (args.ramp + args.think_time + 30)
+        for _ in range(args.web_writers):
+            process = multiprocessing.Process(target=web_writer, args=(database_url, product_ids, stop_at, results))
+            process.start()
+            writers.append(process)
+
+    try:
+        asyncio.run(main_async(args, product_ids))
+    finally:
+        for process in writers:
+            process.terminate()
+
+if __name__ == '__main__':
+    main()
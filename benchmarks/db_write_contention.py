@@ -0,0 +1,119 @@
+"""
+Multi-process write contention benchmark.
+
+Several processes, standing in for gunicorn workers and the bot, write to the
+same database at once through utils.add_order and utils.update_inventory.
+Each configuration reports completed writes per second, latency percentiles
+and how many writes failed with "database is locked".
+
+    python benchmarks/db_write_contention.py --processes 8 --writes 200
+    python benchmarks/db_write_contention.py --database-url postgresql://localhost/bench
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def prepare(database_url, tuning, products):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['DB_ENGINE_TUNING'] = tuning
+    sys.path.insert(0, ROOT)
+    from app import app, db
+    from models import Product, Inventory, OrderPeriod
+    from tenancy import DEFAULT_GUILD_ID
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for i in range(products):
+            product = Product(name=f"Product {i}")
+            db.session.add(product)
+            db.session.flush()
+            db.session.add(Inventory(guild_id=DEFAULT_GUILD_ID, product_id=product.id, quantity=100))
+        db.session.add(OrderPeriod(guild_id=DEFAULT_GUILD_ID, month=1, year=2000, is_open=True))
+        db.session.commit()
+
+def writer(database_url, tuning, worker, writes, products, start_at, results):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['DB_ENGINE_TUNING'] = tuning
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.CRITICAL)
+    from sqlalchemy.exc import OperationalError
+    from app import app, db
+    from utils import add_order, update_inventory
+
+    latencies = []
+    locked = 0
+    with app.app_context():
+        while time.time() < start_at:
+            time.sleep(0.001)
+
+        for i in range(writes):
+            started = time.perf_counter()
+            try:
+                if i % 2:
+                    update_inventory(1 + (worker + i) % products, i)
+                else:
+                    add_order(f"user-{worker}-{i % 20}", f"User {worker}",
+                              [{'product_id': 1 + i % products, 'quantity': 1 + i % 5}])
+                latencies.append(time.perf_counter() - started)
+            except OperationalError:
+                db.session.rollback()
+                locked += 1
+
+    results.put((latencies, locked))
+
+def run(database_url, tuning, args):
+    context = multiprocessing.get_context('spawn')
+    setup = context.Process(target=prepare, args=(database_url, tuning, args.products))
+    setup.start()
+    setup.join()
+
+    results = context.Queue()
+    start_at = time.time() + 3
+    processes = [
+        context.Process(target=writer, args=(database_url, tuning, worker, args.writes, args.products, start_at, results))
+        for worker in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    latencies, locked = [], 0
+    for _ in processes:
+        worker_latencies, worker_locked = results.get()
+        latencies.extend(worker_latencies)
+        locked += worker_locked
+    elapsed = time.time() - start_at
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    def pct(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000 if latencies else 0.0
+
+    label = "tuned" if tuning == "1" else "default"
+    print(f"{label:>8}: {len(latencies) / elapsed:8.1f} writes/s  locked={locked:5d}  "
+          f"p50={pct(0.5):7.1f}ms  p95={pct(0.95):7.1f}ms  p99={pct(0.99):7.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=200, help='Writes per process')
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--database-url', default=None,
+                        help='Database to benchmark (default: a fresh SQLite file per run)')
+    args = parser.parse_args()
+
+    for tuning in ("0", "1"):
+        database_url = args.database_url
+        if database_url is None:
+            database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'contention.db')}"
+        run(database_url, tuning, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Order write throughput with and without group commit.
+
+Several processes, each with many threads standing in for gunicorn worker
+threads and the bot, place orders for distinct users as fast as they can,
+as at the opening of an order period. The run is repeated with
+ORDER_WRITE_COALESCING off and on, and each run reports orders per second,
+latency percentiles and failed writes.
+
+    python benchmarks/order_coalescing.py --processes 4 --threads 16 --orders 50
+    python benchmarks/order_coalescing.py --database-url postgresql://localhost/bench
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def prepare(database_url, products):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    from app import app, db
+    from models import Product, OrderPeriod
+    from tenancy import DEFAULT_GUILD_ID
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for i in range(products):
+            db.session.add(Product(name=f"Product {i}"))
+        db.session.add(OrderPeriod(guild_id=DEFAULT_GUILD_ID, month=1, year=2000, is_open=True))
+        db.session.commit()
+
+def writer(database_url, coalescing, worker, threads, orders, products, start_at, results):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['ORDER_WRITE_COALESCING'] = coalescing
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.CRITICAL)
+    from app import app, db
+    from write_coalescer import coalesced_add_order, order_writer
+
+    latencies = []
+    failed = []
+
+    def place_orders(thread):
+        with app.app_context():
+            while time.time() < start_at:
+                time.sleep(0.001)
+            for i in range(orders):
+                items = [{'product_id': 1 + (thread + i) % products, 'quantity': 1 + i % 5}]
+                started = time.perf_counter()
+                try:
+                    order, error = coalesced_add_order(f"user-{worker}-{thread}-{i}", "Bench user", items)
+                except Exception:
+                    db.session.rollback()
+                    error = True
+                if error:
+                    failed.append(1)
+                else:
+                    latencies.append(time.perf_counter() - started)
+
+    pool = [threading.Thread(target=place_orders, args=(t,)) for t in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    results.put((latencies, len(failed), order_writer.batches))
+
+def run(database_url, coalescing, args):
+    context = multiprocessing.get_context('spawn')
+    setup = context.Process(target=prepare, args=(database_url, args.products))
+    setup.start()
+    setup.join()
+
+    results = context.Queue()
+    start_at = time.time() + 3
+    processes = [
+        context.Process(target=writer, args=(database_url, coalescing, worker, args.threads,
+                                             args.orders, args.products, start_at, results))
+        for worker in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    latencies, failed, batches = [], 0, 0
+    for _ in processes:
+        worker_latencies, worker_failed, worker_batches = results.get()
+        latencies.extend(worker_latencies)
+        failed += worker_failed
+        batches += worker_batches
+    elapsed = time.time() - start_at
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    def pct(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000 if latencies else 0.0
+
+    label = "grouped" if coalescing == "1" else "single"
+    commits = batches if coalescing == "1" else len(latencies)
+    print(f"{label:>8}: {len(latencies) / elapsed:8.1f} orders/s  commits={commits:6d}  failed={failed:4d}  "
+          f"p50={pct(0.5):7.1f}ms  p95={pct(0.95):7.1f}ms  p99={pct(0.99):7.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16, help='Writer threads per process')
+    parser.add_argument('--orders', type=int, default=50, help='Orders per thread')
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--database-url', default=None,
+                        help='Database to benchmark (default: a fresh SQLite file per run)')
+    args = parser.parse_args()
+
+    for coalescing in ("0", "1"):
+        database_url = args.database_url
+        if database_url is None:
+            database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'coalescing.db')}"
+        run(database_url, coalescing, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmarks a burst of bot replies against the stub Discord HTTP layer.
+
+Compares calling ``channel.send`` directly (retrying on 429 the way
+discord.py does) with routing every reply through the OutboundDispatcher.
+
+    python benchmarks/outbound_burst.py --users 300 --channels 3
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from discord_outbound import OutboundDispatcher, rate_limit_of
+from discord_stub import StubHTTP
+
+async def direct_send(channel, content=None, embed=None):
+    # What the library does for us today: sleep for retry_after and try again
+    while True:
+        try:
+            return await channel.send(content, embed=embed)
+        except Exception as e:
+            if getattr(e, 'status', None) != 429:
+                raise
+            await asyncio.sleep(rate_limit_of(e)[0])
+
+async def direct_edit(message, content):
+    while True:
+        try:
+            return await message.edit(content)
+        except Exception as e:
+            if getattr(e, 'status', None) != 429:
+                raise
+            await asyncio.sleep(rate_limit_of(e)[0])
+
+def build_workload(users, channels, edits, seed):
+    rng = random.Random(seed)
+    workload = []
+    for user in range(users):
+        channel = rng.randrange(channels)
+        command = rng.choice(['inventory', 'current_orders', 'order'])
+        if command == 'order':
+            reply = f"Order recorded for user {user}"
+        else:
+            # Listing commands produce the same reply for everyone in a channel
+            reply = f"{command} listing"
+        workload.append((channel, reply))
+    return workload, edits
+
+async def run(mode, args):
+    http = StubHTTP(time_scale=args.time_scale)
+    channels = [http.channel() for _ in range(args.channels)]
+    workload, edits = build_workload(args.users, args.channels, args.edits, args.seed)
+    board = await channels[0].send("inventory board")
+    http.requests.clear()
+
+    scale = args.time_scale
+    dispatcher = OutboundDispatcher(
+        channel_rate=(5, 5.0 * scale),
+        global_rate=(50, 1.0 * scale),
+    )
+
+    latencies = []
+
+    async def reply(channel, content):
+        started = time.perf_counter()
+        if mode == 'direct':
+            await direct_send(channel, content)
+        else:
+            await dispatcher.send(channel, content)
+        latencies.append(time.perf_counter() - started)
+
+    async def update_board(revision):
+        if mode == 'direct':
+            await direct_edit(board, f"inventory board rev {revision}")
+        else:
+            await dispatcher.edit(board, content=f"inventory board rev {revision}")
+
+    started = time.perf_counter()
+    tasks = [reply(channels[c], content) for c, content in workload]
+    tasks += [update_board(rev) for rev in range(edits)]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print(f"{mode:>10}: {elapsed:7.2f}s  requests={len(http.requests):5d}  "
+          f"429s={http.rate_limited:5d}  p50={p50:6.2f}s  p95={p95:6.2f}s  "
+          f"board='{board.content}'")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--edits', type=int, default=50, help='Rapid edits of one live message')
+    parser.add_argument('--time-scale', type=float, default=0.05,
+                        help='Multiplier applied to every rate limit window and latency')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    for mode in ('direct', 'dispatcher'):
+        asyncio.run(run(mode, args))
+
+if __name__ == '__main__':
+    main()
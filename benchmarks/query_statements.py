@@ -0,0 +1,109 @@
+"""
+Per-call CPU of the hot lookups, legacy Model.query versus queries.py.
+
+Every lookup that the web workers and the bot run on each request or
+command is timed both ways against the same data, in one process, with
+process CPU time (time.process_time) so that waiting on the database does
+not count. Both sides return the same rows, which is checked first.
+
+    python benchmarks/query_statements.py --calls 5000
+    python benchmarks/query_statements.py --database-url postgresql://localhost/bench
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def prepare(db, products, users):
+    from models import Product, Inventory, OrderPeriod, Order, OrderItem
+    from tenancy import DEFAULT_GUILD_ID
+
+    db.drop_all()
+    db.create_all()
+    for i in range(products):
+        product = Product(name=f"Product {i}")
+        db.session.add(product)
+        db.session.flush()
+        db.session.add(Inventory(guild_id=DEFAULT_GUILD_ID, product_id=product.id, quantity=100))
+
+    period = OrderPeriod(guild_id=DEFAULT_GUILD_ID, month=1, year=2000, is_open=True)
+    db.session.add(period)
+    db.session.flush()
+    for u in range(users):
+        order = Order(guild_id=DEFAULT_GUILD_ID, user_id=f"user-{u}", user_name=f"User {u}",
+                      order_period_id=period.id)
+        order.items = [OrderItem(product_id=1 + u % products, quantity=1)]
+        db.session.add(order)
+    db.session.commit()
+    return period.id
+
+def lookups(period_id):
+    """
+    Returns (name, callers, legacy, prebuilt) for every hot lookup.
+    """
+    import queries
+    from models import Product, Inventory, OrderPeriod, Order
+    from tenancy import DEFAULT_GUILD_ID as guild
+
+    return [
+        ("current period", "web, bot",
+         lambda: OrderPeriod.query.filter_by(guild_id=guild, is_open=True).first(),
+         lambda: queries.current_period(guild)),
+        ("period orders", "web, bot",
+         lambda: Order.query.filter_by(guild_id=guild, order_period_id=period_id).all(),
+         lambda: queries.period_orders(guild, period_id)),
+        ("user order", "add_order",
+         lambda: Order.query.filter_by(user_id="user-7", order_period_id=period_id).first(),
+         lambda: queries.user_order("user-7", period_id)),
+        ("inventory item", "update_inventory",
+         lambda: Inventory.query.filter_by(guild_id=guild, product_id=3).first(),
+         lambda: queries.inventory_item(guild, 3)),
+        ("inventory", "web",
+         lambda: Inventory.query.filter_by(guild_id=guild).all(),
+         lambda: queries.inventory(guild)),
+        ("product by name", "add_product",
+         lambda: Product.query.filter_by(name="Product 5").first(),
+         lambda: queries.product_by_name("Product 5")),
+    ]
+
+def cpu_per_call(fn, calls):
+    fn()  # warm up the compiled cache
+    started = time.process_time()
+    for _ in range(calls):
+        fn()
+    return (time.process_time() - started) / calls * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--calls', type=int, default=5000, help='Calls per lookup and variant')
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50, help='Orders in the period')
+    parser.add_argument('--database-url', default=None,
+                        help='Database to benchmark (default: a fresh SQLite file)')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'queries.db')}"
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.CRITICAL)
+    from app import app, db
+
+    with app.app_context():
+        period_id = prepare(db, args.products, args.users)
+
+        print(f"{'lookup':>16}  {'callers':<16} {'Model.query':>12} {'prebuilt':>10} {'saved':>6}")
+        for name, callers, legacy, prebuilt in lookups(period_id):
+            expected = legacy()
+            if prebuilt() != expected:
+                raise SystemExit(f"{name}: the prebuilt statement returned different rows")
+
+            before = cpu_per_call(legacy, args.calls)
+            after = cpu_per_call(prebuilt, args.calls)
+            print(f"{name:>16}  {callers:<16} {before:9.1f} us {after:7.1f} us {1 - after / before:6.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Payload size and encode/decode CPU of API responses, JSON versus MessagePack.
+
+Fills a period with orders and the inventory with products, fetches
+``/api/orders`` and ``/api/inventory`` once to get their payloads, then
+times for each encoding the server's encode (as done by the app's JSON
+provider) and a consumer's decode. MessagePack is measured both as decoded
+columns, which is what a consumer reading parallel arrays works with, and
+converted back to rows.
+
+    python benchmarks/response_encoding.py --orders 5000 --products 200
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MSGPACK = 'application/msgpack'
+
+def prepare(db, orders, products, items):
+    from models import Product, Inventory, OrderPeriod, Order, OrderItem
+    from tenancy import DEFAULT_GUILD_ID
+
+    db.drop_all()
+    db.create_all()
+    for i in range(products):
+        product = Product(name=f"Product {i}", description=f"Description of product {i}")
+        db.session.add(product)
+        db.session.flush()
+        db.session.add(Inventory(guild_id=DEFAULT_GUILD_ID, product_id=product.id, quantity=100 + i))
+
+    period = OrderPeriod(guild_id=DEFAULT_GUILD_ID, month=1, year=2000, is_open=True)
+    db.session.add(period)
+    db.session.flush()
+    for u in range(orders):
+        order = Order(guild_id=DEFAULT_GUILD_ID, user_id=f"{100000000000000000 + u}", user_name=f"User {u}",
+                      order_period_id=period.id)
+        order.items = [OrderItem(product_id=1 + (u + k) % products, quantity=1 + k) for k in range(items)]
+        db.session.add(order)
+    db.session.commit()
+    return period.id
+
+def timed(fn, repeat):
+    fn()
+    started = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - started) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--items', type=int, default=4, help='Items per order')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'encoding.db')}"
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.CRITICAL)
+    import msgpack
+    from app import app, db
+    from serialization import packb, unpackb, from_columns
+
+    with app.app_context():
+        period_id = prepare(db, args.orders, args.products, args.items)
+
+    client = app.test_client()
+    print(f"{'endpoint':>16} {'encoding':>9} {'bytes':>10} {'gzipped':>9} {'encode':>9} "
+          f"{'decode':>9} {'to rows':>9}")
+
+    for path in (f'/api/orders?period_id={period_id}', '/api/inventory'):
+        payload = client.get(path).get_json()
+        name = path.split('?')[0]
+
+        with app.test_request_context():
+            body = app.json.dumps(payload).encode()
+            encode = timed(lambda: app.json.dumps(payload), args.repeat)
+        decode = timed(lambda: json.loads(body), args.repeat)
+        print(f"{name:>16} {'json':>9} {len(body):10d} {len(gzip.compress(body)):9d} {encode:7.2f}ms "
+              f"{decode:7.2f}ms")
+
+        packed = packb(payload)
+        if from_columns(msgpack.unpackb(packed)) != payload:
+            raise SystemExit(f"{name}: MessagePack payload does not decode to the JSON one")
+        encode = timed(lambda: packb(payload), args.repeat)
+        decode = timed(lambda: msgpack.unpackb(packed), args.repeat)
+        to_rows = timed(lambda: from_columns(msgpack.unpackb(packed)), args.repeat)
+        if unpackb(client.get(path, headers={'Accept': MSGPACK}).data) != payload:
+            raise SystemExit(f"{name}: the API's MessagePack response does not match its JSON one")
+        print(f"{name:>16} {'msgpack':>9} {len(packed):10d} {len(gzip.compress(packed)):9d} {encode:7.2f}ms "
+              f"{decode:7.2f}ms {to_rows:7.2f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Backend-specific engine settings.
+
+The web workers and the bot share one database. On SQLite that means several
+processes writing the same file, so connections are switched to WAL mode
+with a busy timeout instead of failing immediately with "database is locked".
+On Postgres the pool size, statement timeout and prepared statement
+behaviour are made configurable.
+
+Every setting can be overridden through the environment, and
+``DB_ENGINE_TUNING=0`` falls back to SQLAlchemy's defaults.
+"""
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+def tuning_enabled():
+    return os.environ.get("DB_ENGINE_TUNING", "1") != "0"
+
+def normalize_database_uri(uri):
+    """
+    Rewrites the legacy ``postgres://`` scheme, which SQLAlchemy no longer
+    accepts, and points Postgres URLs without a driver at psycopg 3 rather
+    than SQLAlchemy's default, psycopg2.
+    """
+    for scheme in ("postgres://", "postgresql://"):
+        if uri.startswith(scheme):
+            return "postgresql+psycopg://" + uri[len(scheme):]
+    return uri
+
+def sqlite_pragmas():
+    """
+    Returns the PRAGMA statements run on every new SQLite connection.
+    """
+    return {
+        # Readers no longer block the writer and vice versa
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        # NORMAL is durable in WAL mode except against power loss
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        # Wait for the write lock instead of raising "database is locked"
+        "busy_timeout": _env_int("SQLITE_BUSY_TIMEOUT_MS", 10000),
+        "mmap_size": _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+        "temp_store": "MEMORY",
+        # Off by default in SQLite; rejects order items for deleted products
+        "foreign_keys": "ON",
+    }
+
+def engine_options(uri):
+    """
+    Returns the SQLALCHEMY_ENGINE_OPTIONS suited to the backend of ``uri``.
+
+    Args:
+        uri (str): Database URI
+
+    Returns:
+        dict: Keyword arguments for create_engine
+    """
+    options = {
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 300),
+        "pool_pre_ping": True,
+    }
+
+    if not tuning_enabled():
+        return options
+
+    url = make_url(uri)
+
+    if url.get_backend_name() == "sqlite":
+        # pysqlite's own lock timeout, in seconds; the busy_timeout pragma takes over once connected
+        options["connect_args"] = {"timeout": sqlite_pragmas()["busy_timeout"] / 1000}
+    elif url.get_backend_name() == "postgresql":
+        options.update({
+            "pool_size": _env_int("DB_POOL_SIZE", 10),
+            "max_overflow": _env_int("DB_MAX_OVERFLOW", 10),
+            "pool_timeout": _env_int("DB_POOL_TIMEOUT", 10),
+        })
+
+        connect_args = {
+            "application_name": os.environ.get("DB_APPLICATION_NAME", "stock-order-manager"),
+            # Runaway queries are cancelled by the server instead of holding a worker
+            "options": f"-c statement_timeout={_env_int('DB_STATEMENT_TIMEOUT_MS', 15000)}",
+        }
+
+        # psycopg 3 prepares statements server-side once they have run this many
+        # times on a connection; set to "none" behind a transaction-mode pgbouncer.
+        # Only URLs naming another driver explicitly (postgresql+psycopg2://) go without
+        if url.get_driver_name() == "psycopg":
+            threshold = os.environ.get("PG_PREPARE_THRESHOLD", "5")
+            connect_args["prepare_threshold"] = None if threshold.lower() == "none" else int(threshold)
+
+        options["connect_args"] = connect_args
+
+    return options
+
+def configure_engine(engine):
+    """
+    Installs per-connection settings on ``engine``. Must run before the
+    engine hands out its first connection.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    # Foreign keys are enforced even with tuning turned off
+    pragmas = sqlite_pragmas() if tuning_enabled() else {"foreign_keys": "ON"}
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
@@ -0,0 +1,137 @@
+"""
+Read/write routing between the primary database and an optional read replica.
+
+When ``DATABASE_REPLICA_URL`` is set, it is registered as the ``replica``
+bind. Read-only views (``@replica_reads``) and bot listing commands
+(``with use_replica():``) send their SELECTs there. Everything else,
+including every statement issued while flushing, stays on the primary.
+
+A session that has written is pinned to the primary until its transaction
+ends. Reads within ``DATABASE_REPLICA_MAX_LAG`` seconds of a write also go to
+the primary, so a redirect after a POST still shows the change. In a request
+the time of the last write is kept in the user's session cookie. Outside a
+request (the bot) it is tracked per process.
+
+While ``session.info["hold_commits"]`` is set, ``commit()`` only flushes and
+``close()`` does nothing, so that a batch of API calls can run in one
+transaction.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import has_request_context, session as http_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+REPLICA_BIND = "replica"
+
+# Seconds after a write during which the replica may not have caught up yet
+MAX_REPLICA_LAG = float(os.environ.get("DATABASE_REPLICA_MAX_LAG", "5"))
+
+_replica_reads = ContextVar("replica_reads", default=False)
+_process_last_write = 0.0
+
+def replica_binds():
+    """
+    Returns SQLALCHEMY_BINDS entries for the configured read replica, if any.
+    """
+    from db_engine import normalize_database_uri, engine_options
+
+    url = os.environ.get("DATABASE_REPLICA_URL")
+    if not url:
+        return {}
+
+    url = normalize_database_uri(url)
+    return {REPLICA_BIND: {"url": url, **engine_options(url)}}
+
+@contextmanager
+def use_replica():
+    """
+    Lets reads in this block go to the read replica.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+def replica_reads(view):
+    """
+    Marks a view as read-only, letting its queries go to the read replica.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+def _last_write():
+    if has_request_context():
+        return http_session.get("_db_write_at", 0.0)
+    return _process_last_write
+
+def _record_write():
+    global _process_last_write
+    if has_request_context():
+        http_session["_db_write_at"] = time.time()
+    else:
+        _process_last_write = time.time()
+
+class RoutingSession(Session):
+    """
+    Session that sends reads to the replica bind when it is safe to do so.
+    """
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self._wrote = False
+
+    def commit(self):
+        # Inside a batch transaction (batch.py) the handlers' commits only
+        # flush; the batch commits once at the end
+        if self.info.get("hold_commits"):
+            self.flush()
+            return
+        super().commit()
+
+    def close(self):
+        # Closing would end the batch's transaction and drop its changes
+        if self.info.get("hold_commits"):
+            return
+        super().close()
+
+    def rollback(self):
+        if self.info.get("hold_commits"):
+            # Earlier sub-requests' changes are gone too, so the batch must stop
+            self.info["rolled_back"] = True
+        super().rollback()
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._reads_from_replica(clause):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self, clause):
+        if self._flushing or (clause is not None and getattr(clause, "is_dml", False)):
+            # Anything read after this must see the uncommitted changes
+            self._wrote = True
+            return False
+
+        return (
+            _replica_reads.get()
+            and not self._wrote
+            and REPLICA_BIND in self._db.engines
+            and time.time() - _last_write() > MAX_REPLICA_LAG
+        )
+
+@event.listens_for(RoutingSession, "after_commit")
+def _after_commit(session):
+    if session._wrote and REPLICA_BIND in session._db.engines:
+        _record_write()
+    session._wrote = False
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _after_rollback(session):
+    session._wrote = False
@@ -1,5 +1,6 @@
 import os
 import discord
+from discord import app_commands
 from discord.ext import commands
 import asyncio
 from datetime import datetime
@@ -9,15 +10,29 @@ from dotenv import load_dotenv
 import app
 from models import Product, Inventory, OrderPeriod, Order, OrderItem
 from utils import (
-    get_current_inventory, 
     get_current_order_period, 
+    get_order_period_by_month,
     get_orders_for_period,
-    add_order,
+    get_user_orders,
+    decode_order_cursor,
     delete_order,
     create_order_period,
     toggle_order_period,
     update_inventory
 )
+from db_routing import use_replica
+import queries
+from tenancy import use_guild, guild_of
+from write_coalescer import coalesced_add_order_async
+from events import record_event
+from discord_outbound import OutboundDispatcher
+from discord_sessions import OrderSessionManager
+from discord_live import LiveBoards, MAX_EMBED_FIELDS
+from product_search import product_index, search_products
+from fulltext import search_orders
+from allocation import POLICIES, allocate_period
+from picklist import get_picklist
+import profiling
 
 load_dotenv()
 
@@ -25,51 +40,81 @@ load_dotenv()
 intents = discord.Intents.default()
 intents.message_content = True
 
-# Create bot
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Create bot; the sharded client lets one process serve many guilds
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents)
+
+# All replies are queued and paced per channel to stay within Discord's rate limits
+outbound = OutboundDispatcher()
+
+# Users waiting to reply to an !order prompt, keyed by (author, channel)
+order_sessions = OrderSessionManager(timeout=120.0)
+
+# Inventory and catalog embeds kept in memory and mirrored to pinned messages
+live_boards = LiveBoards(app.app, outbound, bot.get_partial_messageable)
+
+def jump_url(ctx, message_id):
+    guild = ctx.guild.id if ctx.guild is not None else '@me'
+    return f"https://discord.com/channels/{guild}/{ctx.channel.id}/{message_id}"
+
+async def respond(ctx, content=None, *, embed=None):
+    # Slash invocations must answer their interaction; everything else is queued
+    if ctx.interaction is not None:
+        await ctx.send(content, embed=embed)
+    else:
+        outbound.post(ctx.channel, content, embed=embed)
+
+@bot.event
+async def setup_hook():
+    # Register slash commands (e.g. /find with autocomplete)
+    await bot.tree.sync()
+    
+    # Follow inventory and product changes for the pinned boards
+    live_boards.start()
 
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user.name} ({bot.user.id})')
+    print(f'Serving {len(bot.guilds)} guilds over {bot.shard_count} shards')
     print('------')
 
+@bot.listen('on_message')
+async def route_order_replies(message):
+    # One dict lookup per message instead of running every pending wait_for check
+    if message.author.bot:
+        return
+    order_sessions.dispatch(message)
+
 @bot.command(name='inventory', help='Show current inventory')
 async def show_inventory(ctx):
+    guild_id = guild_of(ctx)
+    message_id = live_boards.board_in('inventory', guild_id, ctx.channel.id)
+    if message_id is not None:
+        outbound.post(ctx.channel, f"The inventory is pinned in this channel and kept up to date: {jump_url(ctx, message_id)}")
+        return
+    
+    # Served from memory while the live boards follow the change feed
     with app.app.app_context():
-        inventory_items = get_current_inventory()
-        
-        if not inventory_items:
-            await ctx.send("No inventory items found.")
-            return
-        
-        embed = discord.Embed(
-            title="Current Inventory",
-            color=discord.Color.blue(),
-            timestamp=datetime.utcnow()
-        )
-        
-        for item in inventory_items:
-            embed.add_field(
-                name=f"{item.product.name}",
-                value=f"Quantity: {item.quantity}",
-                inline=True
-            )
-        
-        await ctx.send(embed=embed)
+        embed = live_boards.embed('inventory', guild_id)
+    
+    if not embed.fields:
+        outbound.post(ctx.channel, "No inventory items found.")
+        return
+    
+    outbound.post(ctx.channel, embed=embed)
 
 @bot.command(name='current_orders', help='Show orders for the current open month')
 async def show_current_orders(ctx):
-    with app.app.app_context():
+    with app.app.app_context(), use_guild(guild_of(ctx)), use_replica():
         current_period = get_current_order_period()
         
         if not current_period:
-            await ctx.send("No open order period available.")
+            outbound.post(ctx.channel, "No open order period available.")
             return
         
         orders = get_orders_for_period(current_period.id)
         
         if not orders:
-            await ctx.send(f"No orders found for {current_period.month}/{current_period.year}.")
+            outbound.post(ctx.channel, f"No orders found for {current_period.month}/{current_period.year}.")
             return
         
         embed = discord.Embed(
@@ -89,34 +134,34 @@ async def show_current_orders(ctx):
                 inline=False
             )
         
-        await ctx.send(embed=embed)
+        outbound.post(ctx.channel, embed=embed)
 
 @bot.command(name='past_orders', help='Show orders for a past month (format: MM/YYYY)')
 async def show_past_orders(ctx, period_str=None):
     if not period_str:
-        await ctx.send("Please provide a month/year in MM/YYYY format.")
+        outbound.post(ctx.channel, "Please provide a month/year in MM/YYYY format.")
         return
     
     try:
         month, year = map(int, period_str.split('/'))
         if month < 1 or month > 12:
-            await ctx.send("Month must be between 1 and 12.")
+            outbound.post(ctx.channel, "Month must be between 1 and 12.")
             return
     except ValueError:
-        await ctx.send("Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
+        outbound.post(ctx.channel, "Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
         return
     
-    with app.app.app_context():
-        period = OrderPeriod.query.filter_by(month=month, year=year).first()
+    with app.app.app_context(), use_guild(guild_of(ctx)), use_replica():
+        period = get_order_period_by_month(month, year)
         
         if not period:
-            await ctx.send(f"No order period found for {month}/{year}.")
+            outbound.post(ctx.channel, f"No order period found for {month}/{year}.")
             return
         
         orders = get_orders_for_period(period.id)
         
         if not orders:
-            await ctx.send(f"No orders found for {month}/{year}.")
+            outbound.post(ctx.channel, f"No orders found for {month}/{year}.")
             return
         
         embed = discord.Embed(
@@ -136,249 +181,555 @@ async def show_past_orders(ctx, period_str=None):
                 inline=False
             )
         
-        await ctx.send(embed=embed)
+        outbound.post(ctx.channel, embed=embed)
+
+@bot.command(name='my_orders', help='Show your orders of every month, newest first')
+async def show_my_orders(ctx, cursor=None):
+    after = None
+    if cursor:
+        after, error = decode_order_cursor(cursor)
+        if error:
+            outbound.post(ctx.channel, "Invalid page. Use the command shown under the previous page.")
+            return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)), use_replica():
+        orders, next_cursor = get_user_orders(str(ctx.author.id), limit=10, after=after)
+        
+        if not orders:
+            outbound.post(ctx.channel, "You have no orders." if after is None else "You have no older orders.")
+            return
+        
+        embed = discord.Embed(
+            title=f"Orders by {ctx.author.display_name}",
+            color=discord.Color.gold(),
+            timestamp=datetime.utcnow()
+        )
+        
+        for order in orders:
+            value = ""
+            for item in order.items:
+                value += f"{item.product.name}: {item.quantity}\n"
+            status = "delivered" if order.is_delivered else "not delivered"
+            
+            embed.add_field(
+                name=f"{order.order_period.month}/{order.order_period.year} ({status})",
+                value=value[:1024] or "No items",
+                inline=False
+            )
+        
+        if next_cursor:
+            embed.set_footer(text=f"Older orders: !my_orders {next_cursor}")
+    
+    outbound.post(ctx.channel, embed=embed)
+
+@bot.command(name='search', help='Search orders of every month by user or product (e.g. !search alice coffee)')
+async def search_past_orders(ctx, *, query: str = None):
+    if not query:
+        outbound.post(ctx.channel, "Please provide something to search for.")
+        return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)), use_replica():
+        results = search_orders(query, limit=10)
+        
+        if not results:
+            outbound.post(ctx.channel, f"No orders found matching '{query}'.")
+            return
+        
+        embed = discord.Embed(
+            title=f"Orders matching '{query}'",
+            color=discord.Color.blue(),
+            timestamp=datetime.utcnow()
+        )
+        
+        for order, score in results:
+            value = ""
+            for item in order.items:
+                value += f"{item.product.name}: {item.quantity}\n"
+            
+            embed.add_field(
+                name=f"{order.order_period.month}/{order.order_period.year} - {order.user_name}",
+                value=value or "No items",
+                inline=False
+            )
+    
+    outbound.post(ctx.channel, embed=embed)
 
 @bot.command(name='order', help='Place an order for the current month')
 async def place_order(ctx):
-    with app.app.app_context():
+    with app.app.app_context(), use_guild(guild_of(ctx)):
         current_period = get_current_order_period()
         
         if not current_period:
-            await ctx.send("No open order period available for ordering.")
+            outbound.post(ctx.channel, "No open order period available for ordering.")
             return
         
-        products = Product.query.all()
+        # Show at most one embed's worth of products; the rest are reachable by name
+        products = Product.query.order_by(Product.name).limit(MAX_EMBED_FIELDS).all()
         
         if not products:
-            await ctx.send("No products available for ordering.")
+            outbound.post(ctx.channel, "No products available for ordering.")
             return
         
+        period_label = f"{current_period.month}/{current_period.year}"
+        
         # Create a message with available products
         embed = discord.Embed(
-            title=f"Available Products for {current_period.month}/{current_period.year}",
-            description="Reply with the product numbers and quantities as:\n1:5 2:3 ...",
+            title=f"Available Products for {period_label}",
+            description="Reply with product IDs (or names) and quantities as:\n1:5 coffee:3 ...",
             color=discord.Color.blue(),
             timestamp=datetime.utcnow()
         )
         
-        for i, product in enumerate(products, 1):
+        for product in products:
             embed.add_field(
-                name=f"{i}. {product.name}",
+                name=f"{product.id}. {product.name}",
                 value=product.description or "No description",
                 inline=True
             )
         
-        await ctx.send(embed=embed)
+        product_count = Product.query.count()
+        if product_count > len(products):
+            embed.set_footer(text=f"Showing {len(products)} of {product_count} products. Use !find to look up others.")
         
-        def check(m):
-            return m.author == ctx.author and m.channel == ctx.channel
+        # Only the ids are kept while waiting for the reply
+        product_ids = [product.id for product in products]
+    
+    # Register before prompting so that a fast reply cannot be missed
+    session = order_sessions.open(ctx.author.id, ctx.channel.id, product_ids)
+    outbound.post(ctx.channel, embed=embed)
+    
+    try:
+        response = await order_sessions.wait(session)
+    except asyncio.TimeoutError:
+        outbound.post(ctx.channel, "Order timed out. Please try again.")
+        return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)):
+        product_index.ensure_fresh()
         
-        try:
-            response = await bot.wait_for('message', check=check, timeout=120.0)
+        # Parse the response to get product IDs and quantities
+        items = []
+        unresolved = []
+        parts = response.content.split()
+        
+        for part in parts:
+            if ':' not in part:
+                continue
             
-            # Parse the response to get product IDs and quantities
-            items = []
-            parts = response.content.split()
+            try:
+                key, qty_str = part.rsplit(':', 1)
+                qty = int(qty_str)
+            except ValueError:
+                continue
             
-            for part in parts:
-                if ':' not in part:
+            if qty < 1:
+                continue
+            
+            if key.isdigit():
+                product_id = int(key)
+                if product_id not in session.product_ids and not product_index.get(product_id):
                     continue
-                
-                try:
-                    idx_str, qty_str = part.split(':')
-                    idx = int(idx_str)
-                    qty = int(qty_str)
-                    
-                    if idx < 1 or idx > len(products) or qty < 1:
-                        continue
-                    
-                    product_id = products[idx-1].id
-                    items.append({
-                        'product_id': product_id,
-                        'quantity': qty
-                    })
-                except ValueError:
+            else:
+                # Names must be exact or match a single product, use _ for spaces
+                name = key.replace('_', ' ')
+                product_id = product_index.resolve(name)
+                if product_id is None:
+                    unresolved.append((name, product_index.suggest(name)))
                     continue
             
-            if not items:
-                await ctx.send("No valid items specified. Order not placed.")
-                return
-            
-            # Add the order
-            user_id = str(ctx.author.id)
-            user_name = ctx.author.name
-            
-            order, error = add_order(user_id, user_name, items)
-            
-            if error:
-                await ctx.send(f"Error: {error}")
-                return
-            
-            # Confirm the order
-            embed = discord.Embed(
-                title="Order Placed Successfully",
-                description=f"Your order for {current_period.month}/{current_period.year} has been recorded.",
-                color=discord.Color.green(),
-                timestamp=datetime.utcnow()
+            items.append({
+                'product_id': product_id,
+                'quantity': qty
+            })
+    
+    # Guessing could order the wrong product, so ask again instead
+    if unresolved:
+        lines = []
+        for name, suggestions in unresolved:
+            if suggestions:
+                lines.append(f'"{name}" could be: {", ".join(suggestions)}')
+            else:
+                lines.append(f'"{name}" matches no product')
+        outbound.post(ctx.channel, "Order not placed, some products are unclear:\n" + "\n".join(lines) +
+                      "\nUse the product number or its full name, with _ for spaces.")
+        return
+    
+    if not items:
+        outbound.post(ctx.channel, "No valid items specified. Order not placed.")
+        return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)):
+        # Add the order
+        user_id = str(ctx.author.id)
+        user_name = ctx.author.name
+        
+        order, error = await coalesced_add_order_async(user_id, user_name, items)
+        
+        if error:
+            outbound.post(ctx.channel, f"Error: {error}")
+            return
+        
+        # Confirm the order
+        embed = discord.Embed(
+            title="Order Placed Successfully",
+            description=f"Your order for {period_label} has been recorded.",
+            color=discord.Color.green(),
+            timestamp=datetime.utcnow()
+        )
+        
+        for item in order.items:
+            embed.add_field(
+                name=item.product.name,
+                value=f"Quantity: {item.quantity}",
+                inline=True
             )
-            
-            for item in order.items:
-                embed.add_field(
-                    name=item.product.name,
-                    value=f"Quantity: {item.quantity}",
-                    inline=True
-                )
-            
-            await ctx.send(embed=embed)
-            
-        except asyncio.TimeoutError:
-            await ctx.send("Order timed out. Please try again.")
+    
+    outbound.post(ctx.channel, embed=embed)
 
 @bot.command(name='cancel_order', help='Cancel your order for the current month')
 async def cancel_order(ctx):
-    with app.app.app_context():
+    with app.app.app_context(), use_guild(guild_of(ctx)):
         current_period = get_current_order_period()
         
         if not current_period:
-            await ctx.send("No open order period available.")
+            outbound.post(ctx.channel, "No open order period available.")
             return
         
         user_id = str(ctx.author.id)
         
-        order = Order.query.filter_by(
-            user_id=user_id,
-            order_period_id=current_period.id
-        ).first()
+        order = queries.user_order(user_id, current_period.id)
         
         if not order:
-            await ctx.send("You don't have an order for the current period.")
+            outbound.post(ctx.channel, "You don't have an order for the current period.")
             return
         
         success, error = delete_order(order.id, user_id)
         
         if error:
-            await ctx.send(f"Error: {error}")
+            outbound.post(ctx.channel, f"Error: {error}")
             return
         
-        await ctx.send(f"Your order for {current_period.month}/{current_period.year} has been cancelled.")
+        outbound.post(ctx.channel, f"Your order for {current_period.month}/{current_period.year} has been cancelled.")
 
 @bot.command(name='open_month', help='Open a new order month (format: MM/YYYY)')
 @commands.has_permissions(administrator=True)
 async def open_month(ctx, period_str=None):
     if not period_str:
-        await ctx.send("Please provide a month/year in MM/YYYY format.")
+        outbound.post(ctx.channel, "Please provide a month/year in MM/YYYY format.")
         return
     
     try:
         month, year = map(int, period_str.split('/'))
         if month < 1 or month > 12:
-            await ctx.send("Month must be between 1 and 12.")
+            outbound.post(ctx.channel, "Month must be between 1 and 12.")
             return
     except ValueError:
-        await ctx.send("Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
+        outbound.post(ctx.channel, "Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
         return
     
-    with app.app.app_context():
+    with app.app.app_context(), use_guild(guild_of(ctx)):
         period, error = create_order_period(month, year)
         
         if error:
-            await ctx.send(f"Error: {error}")
+            outbound.post(ctx.channel, f"Error: {error}")
             return
         
-        await ctx.send(f"Order period for {month}/{year} has been opened for orders.")
+        outbound.post(ctx.channel, f"Order period for {month}/{year} has been opened for orders.")
 
 @bot.command(name='toggle_month', help='Open/close an order month (format: MM/YYYY)')
 @commands.has_permissions(administrator=True)
 async def toggle_month(ctx, period_str=None):
     if not period_str:
-        await ctx.send("Please provide a month/year in MM/YYYY format.")
+        outbound.post(ctx.channel, "Please provide a month/year in MM/YYYY format.")
         return
     
     try:
         month, year = map(int, period_str.split('/'))
         if month < 1 or month > 12:
-            await ctx.send("Month must be between 1 and 12.")
+            outbound.post(ctx.channel, "Month must be between 1 and 12.")
             return
     except ValueError:
-        await ctx.send("Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
+        outbound.post(ctx.channel, "Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
         return
     
-    with app.app.app_context():
-        period = OrderPeriod.query.filter_by(month=month, year=year).first()
+    with app.app.app_context(), use_guild(guild_of(ctx)):
+        period = get_order_period_by_month(month, year)
         
         if not period:
-            await ctx.send(f"No order period found for {month}/{year}.")
+            outbound.post(ctx.channel, f"No order period found for {month}/{year}.")
             return
         
         period, error = toggle_order_period(period.id)
         
         if error:
-            await ctx.send(f"Error: {error}")
+            outbound.post(ctx.channel, f"Error: {error}")
             return
         
         status = "opened" if period.is_open else "closed"
-        await ctx.send(f"Order period for {month}/{year} has been {status}.")
+        outbound.post(ctx.channel, f"Order period for {month}/{year} has been {status}.")
 
-@bot.command(name='update_stock', help='Update inventory (format: <product_id> <quantity>)')
+@bot.command(name='allocate', help='Share out stock for a closed month (format: MM/YYYY [proportional|first_come|capped CAP])')
 @commands.has_permissions(administrator=True)
-async def update_stock(ctx, product_id: int = None, quantity: int = None):
-    if product_id is None or quantity is None:
-        await ctx.send("Please provide both product ID and quantity.")
+async def allocate_month(ctx, period_str=None, policy='proportional', cap: int = None):
+    if not period_str:
+        outbound.post(ctx.channel, "Please provide a month/year in MM/YYYY format.")
         return
     
-    with app.app.app_context():
-        inventory_item, error = update_inventory(product_id, quantity)
+    try:
+        month, year = map(int, period_str.split('/'))
+        if month < 1 or month > 12:
+            outbound.post(ctx.channel, "Month must be between 1 and 12.")
+            return
+    except ValueError:
+        outbound.post(ctx.channel, "Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
+        return
+    
+    if policy not in POLICIES:
+        outbound.post(ctx.channel, f"Unknown policy. Use one of: {', '.join(POLICIES)}.")
+        return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)):
+        period = get_order_period_by_month(month, year)
+        
+        if not period:
+            outbound.post(ctx.channel, f"No order period found for {month}/{year}.")
+            return
+        
+        summary, error = allocate_period(period, policy, cap)
         
         if error:
-            await ctx.send(f"Error: {error}")
+            outbound.post(ctx.channel, f"Error: {error}")
             return
         
-        await ctx.send(f"Inventory updated: {inventory_item.product.name} now has {quantity} units.")
+        app.db.session.commit()
+        
+        short = [s for s in summary if s['short'] > 0]
+        names = dict(app.db.session.query(Product.id, Product.name)
+                     .filter(Product.id.in_([s['product_id'] for s in short])))
+        
+        embed = discord.Embed(
+            title=f"Allocation for {month}/{year} ({policy})",
+            description=(f"{len(short)} of {len(summary)} products were oversubscribed."
+                         if short else "Every order can be filled in full."),
+            color=discord.Color.orange() if short else discord.Color.green(),
+            timestamp=datetime.utcnow()
+        )
+        
+        for s in short[:MAX_EMBED_FIELDS]:
+            embed.add_field(
+                name=names.get(s['product_id'], f"Product {s['product_id']}"),
+                value=f"{s['allocated']} of {s['requested']} requested (stock {s['stock']})",
+                inline=True
+            )
+    
+    outbound.post(ctx.channel, embed=embed)
 
-@bot.command(name='products', help='List all available products')
-async def list_products(ctx):
-    with app.app.app_context():
-        products = Product.query.all()
+@bot.command(name='picklist', help='Show what is left to pick for a month, by product (format: MM/YYYY, default: the open month)')
+@commands.has_permissions(administrator=True)
+async def show_picklist(ctx, period_str=None):
+    month = year = None
+    if period_str:
+        try:
+            month, year = map(int, period_str.split('/'))
+            if month < 1 or month > 12:
+                outbound.post(ctx.channel, "Month must be between 1 and 12.")
+                return
+        except ValueError:
+            outbound.post(ctx.channel, "Invalid format. Please use MM/YYYY format (e.g., 01/2023).")
+            return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)), use_replica():
+        if period_str:
+            period = get_order_period_by_month(month, year)
+        else:
+            period = get_current_order_period()
         
-        if not products:
-            await ctx.send("No products found.")
+        if not period:
+            outbound.post(ctx.channel, f"No order period found for {month}/{year}." if period_str
+                          else "No open order period. Please provide a month/year in MM/YYYY format.")
+            return
+        
+        picklist = get_picklist(period)
+        
+        if not picklist['products']:
+            outbound.post(ctx.channel, f"Nothing left to pick for {period.month}/{period.year}.")
             return
         
         embed = discord.Embed(
-            title="Available Products",
+            title=f"Pick list for {period.month}/{period.year}",
+            description=f"{picklist['orders']} orders, {picklist['units']} units",
             color=discord.Color.blue(),
             timestamp=datetime.utcnow()
         )
         
-        for product in products:
+        for product in picklist['products'][:MAX_EMBED_FIELDS]:
+            value = ""
+            for line in product['lines']:
+                value += f"{line['user_name']}: {line['quantity']}\n"
+            
             embed.add_field(
-                name=f"{product.id}. {product.name}",
-                value=product.description or "No description",
+                name=f"{product['product_name']} ({product['quantity']})",
+                value=value[:1024],
                 inline=True
             )
         
-        await ctx.send(embed=embed)
+        if len(picklist['products']) > MAX_EMBED_FIELDS:
+            embed.set_footer(text=f"... and {len(picklist['products']) - MAX_EMBED_FIELDS} more products, see the web pick list")
+    
+    outbound.post(ctx.channel, embed=embed)
+
+@bot.command(name='update_stock', help='Update inventory (format: <product_id> <quantity>)')
+@commands.has_permissions(administrator=True)
+async def update_stock(ctx, product_id: int = None, quantity: int = None):
+    if product_id is None or quantity is None:
+        outbound.post(ctx.channel, "Please provide both product ID and quantity.")
+        return
+    
+    with app.app.app_context(), use_guild(guild_of(ctx)):
+        inventory_item, error = update_inventory(product_id, quantity)
+        
+        if error:
+            outbound.post(ctx.channel, f"Error: {error}")
+            return
+        
+        outbound.post(ctx.channel, f"Inventory updated: {inventory_item.product.name} now has {quantity} units.")
+
+@bot.command(name='products', help='List all available products')
+async def list_products(ctx):
+    message_id = live_boards.board_in('catalog', guild_of(ctx), ctx.channel.id)
+    if message_id is not None:
+        outbound.post(ctx.channel, f"The product list is pinned in this channel and kept up to date: {jump_url(ctx, message_id)}")
+        return
+    
+    with app.app.app_context():
+        embed = live_boards.embed('catalog')
+    
+    if not embed.fields:
+        outbound.post(ctx.channel, "No products found.")
+        return
+    
+    outbound.post(ctx.channel, embed=embed)
+
+@bot.command(name='pin_inventory', help='Pin inventory and product messages in this channel that update themselves')
+@commands.has_permissions(administrator=True)
+async def pin_inventory(ctx):
+    await live_boards.pin(ctx.channel, guild_of(ctx))
+
+@bot.command(name='unpin_inventory', help='Stop updating the pinned inventory and product messages in this channel')
+@commands.has_permissions(administrator=True)
+async def unpin_inventory(ctx):
+    removed = await live_boards.unpin(ctx.channel, guild_of(ctx))
+    
+    if not removed:
+        outbound.post(ctx.channel, "There are no pinned inventory messages in this channel.")
+        return
+    
+    outbound.post(ctx.channel, "The inventory and product messages are no longer updated.")
+
+@bot.hybrid_command(name='find', help='Search products by name or description')
+async def find_products(ctx, *, query: str = None):
+    if not query:
+        await respond(ctx, "Please provide something to search for.")
+        return
+    
+    with app.app.app_context(), use_replica():
+        results = search_products(query, limit=10)
+    
+    if not results:
+        await respond(ctx, f"No products found matching '{query}'.")
+        return
+    
+    embed = discord.Embed(
+        title=f"Products matching '{query}'",
+        color=discord.Color.blue(),
+        timestamp=datetime.utcnow()
+    )
+    
+    for product_id, name, description, score in results:
+        embed.add_field(
+            name=f"{product_id}. {name}",
+            value=description or "No description",
+            inline=True
+        )
+    
+    await respond(ctx, embed=embed)
+
+@find_products.autocomplete('query')
+async def find_products_autocomplete(interaction, current):
+    if not current:
+        return []
+    
+    with app.app.app_context(), use_replica():
+        results = search_products(current, limit=MAX_EMBED_FIELDS)
+    
+    # Choice names and values are limited to 100 characters
+    return [app_commands.Choice(name=name[:100], value=name[:100]) for _, name, _, _ in results]
 
 @bot.command(name='add_product', help='Add a new product (format: "name" "description")')
 @commands.has_permissions(administrator=True)
 async def add_product(ctx, name=None, *, description=None):
     if not name:
-        await ctx.send("Please provide a product name.")
+        outbound.post(ctx.channel, "Please provide a product name.")
         return
     
     with app.app.app_context():
         # Check if product already exists
-        existing = Product.query.filter_by(name=name).first()
+        existing = queries.product_by_name(name)
         if existing:
-            await ctx.send(f"A product with the name '{name}' already exists.")
+            outbound.post(ctx.channel, f"A product with the name '{name}' already exists.")
             return
         
         # Create new product
         product = Product(name=name, description=description or "")
         app.db.session.add(product)
+        app.db.session.flush()
+        record_event('product.created', product_id=product.id, name=name, description=product.description)
         app.db.session.commit()
         
-        await ctx.send(f"Product '{name}' added successfully with ID {product.id}.")
+        outbound.post(ctx.channel, f"Product '{name}' added successfully with ID {product.id}.")
+
+# Administrators who asked for their next commands to be profiled
+profiled_users = set()
+
+@bot.command(name='profile', help='Profile your next commands (admin only; toggles)')
+@commands.has_permissions(administrator=True)
+async def toggle_profiling(ctx):
+    if not profiling.enabled():
+        outbound.post(ctx.channel, "Profiling is disabled. Set PROFILE_TOKEN to enable it.")
+        return
+    
+    if ctx.author.id in profiled_users:
+        profiled_users.discard(ctx.author.id)
+        outbound.post(ctx.channel, "Profiling turned off for your commands.")
+    else:
+        profiled_users.add(ctx.author.id)
+        outbound.post(ctx.channel, "Your next commands will be profiled. Run !profile again to stop.")
+
+async def start_command_profile(ctx):
+    if ctx.author.id not in profiled_users or ctx.command.name == 'profile':
+        return
+    
+    profile = profiling.Profile('command', ctx.command.qualified_name)
+    if profile.start():
+        ctx.profile = profile
+    else:
+        outbound.post(ctx.channel, "Another profile is running; this command was not profiled.")
+
+async def finish_command_profile(ctx):
+    # The function stats cover the whole event loop meanwhile, see profiling.py
+    profile = getattr(ctx, 'profile', None)
+    if profile is not None:
+        del ctx.profile
+        profile.finish()
+        
+        # Writing the files would otherwise stall the event loop
+        name = await asyncio.get_running_loop().run_in_executor(None, profile.save)
+        outbound.post(ctx.channel, f"Profile saved as {name} (see /admin/profiles).")
+
+# The hooks are only installed when profiling can be turned on
+if profiling.enabled():
+    bot.before_invoke(start_command_profile)
+    bot.after_invoke(finish_command_profile)
 
 # Run the bot
 if __name__ == "__main__":
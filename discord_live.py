@@ -0,0 +1,314 @@
+"""
+Live inventory and catalog messages for the Discord bot.
+
+Instead of querying the database for every ``!inventory`` and ``!products``,
+the bot keeps the embeds in memory and maintains pinned "boards": messages
+that an administrator pinned with ``!pin_inventory`` and that are edited in
+place whenever the inventory or the catalog change.
+
+Changes are picked up from the change feed (see events.py). Inventory events
+invalidate their guild's inventory embed, product events invalidate the
+catalog and every inventory embed, since those show product names. Events
+are collected for ``LIVE_BOARD_DEBOUNCE`` seconds before the affected embeds
+are rebuilt, and a board is only edited if its embed actually changed.
+
+The cache is only used while the watcher is running; until then, or if it
+stops, embeds are built from the database on every call as before.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+import discord
+
+from models import Product, Inventory, PinnedBoard
+from events import latest_event_id, wait_for_events
+from discord_outbound import embed_key
+
+logger = logging.getLogger(__name__)
+
+# Discord rejects embeds with more fields than this
+MAX_EMBED_FIELDS = 25
+
+# How long to keep collecting changes before rebuilding, so that a stock
+# count or a product import results in one edit per board
+DEBOUNCE = float(os.environ.get("LIVE_BOARD_DEBOUNCE", "2"))
+
+# Long-poll timeout of the change feed; an idle watcher wakes up this often
+WAIT_TIMEOUT = 30.0
+
+KINDS = ('inventory', 'catalog')
+
+def _board_key(kind, guild_id):
+    # The catalog is shared by every guild
+    return (kind, guild_id if kind == 'inventory' else None)
+
+def _limit_fields(embed, entries):
+    """
+    Adds (name, value) fields up to Discord's limit and notes how many were left out.
+    """
+    for name, value in entries[:MAX_EMBED_FIELDS]:
+        embed.add_field(name=name, value=value, inline=True)
+    if len(entries) > MAX_EMBED_FIELDS:
+        embed.set_footer(text=f"... and {len(entries) - MAX_EMBED_FIELDS} more")
+    return embed
+
+def build_inventory_embed(guild_id):
+    """
+    Builds the inventory embed of a guild from the database.
+    """
+    items = (Inventory.query
+             .filter_by(guild_id=guild_id)
+             .join(Product)
+             .order_by(Product.name)
+             .all())
+
+    embed = discord.Embed(
+        title="Current Inventory",
+        color=discord.Color.blue(),
+        timestamp=datetime.utcnow()
+    )
+    return _limit_fields(embed, [(item.product.name, f"Quantity: {item.quantity}") for item in items])
+
+def build_catalog_embed():
+    """
+    Builds the product catalog embed from the database.
+    """
+    products = Product.query.order_by(Product.id).all()
+
+    embed = discord.Embed(
+        title="Available Products",
+        color=discord.Color.blue(),
+        timestamp=datetime.utcnow()
+    )
+    return _limit_fields(embed, [
+        (f"{product.id}. {product.name}", product.description or "No description")
+        for product in products
+    ])
+
+def _build(key):
+    kind, guild_id = key
+    if kind == 'inventory':
+        return build_inventory_embed(guild_id)
+    return build_catalog_embed()
+
+def affected_keys(changes, known_keys):
+    """
+    Returns the board keys whose embeds a batch of serialised events invalidates.
+
+    Args:
+        changes (list): Serialised events
+        known_keys (iterable): Keys currently cached or shown on a board
+    """
+    dirty = set()
+    for change in changes:
+        if change['kind'].startswith('inventory.'):
+            dirty.add(('inventory', change['guild_id']))
+        elif change['kind'].startswith('product.'):
+            dirty.add(('catalog', None))
+            dirty.update(key for key in known_keys if key[0] == 'inventory')
+    return dirty
+
+class LiveBoards:
+    """
+    The in-memory embed cache and the pinned messages that mirror it.
+    """
+    def __init__(self, app, outbound, resolve_channel, debounce=DEBOUNCE, wait_timeout=WAIT_TIMEOUT):
+        self.app = app
+        self.outbound = outbound
+        self.resolve_channel = resolve_channel  # channel id -> messageable with get_partial_message
+        self.debounce = debounce
+        self.wait_timeout = wait_timeout
+        self._embeds = {}  # board key -> (embed, embed key)
+        self._boards = {}  # board key -> {channel id: message id}
+        self._task = None
+        self.stats = {'builds': 0, 'hits': 0, 'edits': 0}
+
+    @property
+    def live(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """
+        Loads the pinned boards and starts following the change feed.
+        """
+        if self.live:
+            return
+        with self.app.app_context():
+            self._boards = {}
+            for board in PinnedBoard.query.all():
+                key = _board_key(board.kind, board.guild_id)
+                self._boards.setdefault(key, {})[board.channel_id] = board.message_id
+            cursor = latest_event_id()
+        self._embeds.clear()
+        self._task = asyncio.create_task(self._watch(cursor))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._embeds.clear()
+
+    def embed(self, kind, guild_id=None):
+        """
+        Returns the current embed for ``kind``, from the cache while it is live.
+        The caller must be inside an app context.
+        """
+        key = _board_key(kind, guild_id)
+        if self.live:
+            cached = self._embeds.get(key)
+            if cached is not None:
+                self.stats['hits'] += 1
+                return cached[0]
+
+        embed = _build(key)
+        self.stats['builds'] += 1
+        if self.live:
+            self._embeds[key] = (embed, embed_key(embed))
+        return embed
+
+    def board_in(self, kind, guild_id, channel_id):
+        """
+        Returns the id of the board of ``kind`` pinned in a channel, if any.
+        """
+        return self._boards.get(_board_key(kind, guild_id), {}).get(channel_id)
+
+    async def pin(self, channel, guild_id):
+        """
+        Posts and pins the inventory and catalog boards in a channel, replacing
+        boards previously pinned there.
+        """
+        with self.app.app_context():
+            embeds = {kind: self.embed(kind, guild_id) for kind in KINDS}
+
+        messages = {}
+        for kind in KINDS:
+            messages[kind] = await self.outbound.send(channel, embed=embeds[kind])
+            try:
+                await messages[kind].pin()
+            except discord.HTTPException as exc:
+                # The board is still kept up to date, just not pinned
+                logger.warning("Could not pin the %s board in channel %s: %s", kind, channel.id, exc)
+
+        replaced = []
+        with self.app.app_context():
+            from app import db
+            for kind in KINDS:
+                board = PinnedBoard.query.filter_by(channel_id=channel.id, kind=kind).first()
+                if board is None:
+                    board = PinnedBoard(channel_id=channel.id, kind=kind)
+                    db.session.add(board)
+                else:
+                    replaced.append(board.message_id)
+                board.guild_id = guild_id
+                board.message_id = messages[kind].id
+            db.session.commit()
+
+        for kind in KINDS:
+            self._boards.setdefault(_board_key(kind, guild_id), {})[channel.id] = messages[kind].id
+        await self._unpin(channel, replaced)
+        return messages
+
+    async def unpin(self, channel, guild_id):
+        """
+        Stops maintaining the boards of a channel and unpins them.
+
+        Returns:
+            int: The number of boards removed
+        """
+        with self.app.app_context():
+            from app import db
+            boards = PinnedBoard.query.filter_by(channel_id=channel.id).all()
+            message_ids = [board.message_id for board in boards]
+            for board in boards:
+                db.session.delete(board)
+            db.session.commit()
+
+        for kind in KINDS:
+            self._boards.get(_board_key(kind, guild_id), {}).pop(channel.id, None)
+        await self._unpin(channel, message_ids)
+        return len(message_ids)
+
+    async def _unpin(self, channel, message_ids):
+        for message_id in message_ids:
+            try:
+                await channel.get_partial_message(message_id).unpin()
+            except discord.HTTPException:
+                pass
+
+    def _wait(self, cursor, timeout, limit=100):
+        # Runs in an executor thread; a cursor behind the broadcaster's buffer is read from the database
+        with self.app.app_context():
+            return wait_for_events(cursor, timeout, limit)
+
+    async def _watch(self, cursor):
+        loop = asyncio.get_running_loop()
+
+        # Boards may have missed changes made while the bot was offline
+        await self.refresh(set(self._boards))
+
+        while True:
+            try:
+                changes = await loop.run_in_executor(None, self._wait, cursor, self.wait_timeout)
+                if not changes:
+                    continue
+
+                # Let the rest of a burst arrive before rebuilding anything
+                await asyncio.sleep(self.debounce)
+                more = await loop.run_in_executor(None, self._wait, changes[-1]['id'], 0, 1000)
+                changes.extend(more)
+                cursor = changes[-1]['id']
+
+                known = set(self._embeds) | set(self._boards)
+                await self.refresh(affected_keys(changes, known))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Live board update failed")
+                # Whatever is cached may now be stale
+                self._embeds.clear()
+                await asyncio.sleep(self.wait_timeout)
+
+    async def refresh(self, keys):
+        """
+        Rebuilds the given embeds and edits the boards whose content changed.
+        """
+        updates = []
+        with self.app.app_context():
+            for key in keys:
+                previous = self._embeds.pop(key, None)
+                if not self._boards.get(key):
+                    # Nobody is looking; the next command rebuilds it
+                    continue
+                embed = _build(key)
+                self.stats['builds'] += 1
+                content_key = embed_key(embed)
+                self._embeds[key] = (embed, content_key)
+                if previous is None or previous[1] != content_key:
+                    updates.append((key, embed))
+
+        edits = [
+            (key, channel_id, message_id, self.outbound.edit(
+                self.resolve_channel(channel_id).get_partial_message(message_id), embed=embed))
+            for key, embed in updates
+            for channel_id, message_id in list(self._boards[key].items())
+        ]
+        results = await asyncio.gather(*(edit for *_, edit in edits), return_exceptions=True)
+
+        for (key, channel_id, message_id, _), result in zip(edits, results):
+            if isinstance(result, discord.NotFound):
+                # The message was deleted; stop maintaining it
+                await self._forget(key, channel_id, message_id)
+            elif isinstance(result, Exception):
+                logger.warning("Could not update board %s in channel %s: %s", message_id, channel_id, result)
+            else:
+                self.stats['edits'] += 1
+
+    async def _forget(self, key, channel_id, message_id):
+        self._boards.get(key, {}).pop(channel_id, None)
+        with self.app.app_context():
+            from app import db
+            PinnedBoard.query.filter_by(channel_id=channel_id, message_id=message_id).delete()
+            db.session.commit()
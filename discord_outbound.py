@@ -0,0 +1,262 @@
+"""
+Rate-limit-aware outbound message queue for the Discord bot.
+
+Every reply the bot makes goes through an OutboundDispatcher instead of
+calling ``ctx.send`` directly. Messages are queued per channel and paced
+with token buckets that mirror Discord's limits, so a burst of commands is
+spread out instead of running into 429 responses. Identical replies that
+are still waiting in a channel's queue are sent once, and repeated edits of
+the same message are merged into a single edit.
+
+discord.py already waits out and retries 429 responses itself. One only
+reaches the dispatcher once the library has given up, and the dispatcher
+then holds the channel back for as long as the response's ``Retry-After``
+header says before trying again.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+# Discord allows 5 messages per 5 seconds per channel and 50 requests per
+# second globally per bot.
+CHANNEL_RATE = (5, 5.0)
+GLOBAL_RATE = (50, 1.0)
+
+# Seconds to back off when a 429 response does not say how long
+DEFAULT_RETRY_AFTER = 1.0
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """
+    Allows ``capacity`` operations per ``per`` seconds, refilling continuously.
+    """
+    def __init__(self, capacity, per, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """
+        Returns how many seconds to wait before a token is available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def penalize(self, retry_after):
+        """
+        Empties the bucket so that the next token becomes available only after
+        ``retry_after`` seconds, as instructed by a 429 response.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 1 - retry_after * self.rate)
+
+class OutboundMessage:
+    """
+    A pending send or edit, together with every caller waiting for it.
+    """
+    def __init__(self, action, target, key, kwargs):
+        self.action = action  # 'send' or 'edit'
+        self.target = target  # channel for 'send', message for 'edit'
+        self.key = key
+        self.kwargs = kwargs
+        self.futures = []
+
+    def resolve(self, result=None, error=None):
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+def embed_key(embed):
+    """
+    Returns a hashable representation of an embed, ignoring its timestamp so
+    that replies built a few milliseconds apart still compare equal.
+    """
+    if embed is None:
+        return None
+    data = embed.to_dict() if hasattr(embed, 'to_dict') else dict(embed)
+    data.pop('timestamp', None)
+    return repr(sorted(data.items()))
+
+def rate_limit_of(error):
+    """
+    Reads how long to back off from a 429 discord.HTTPException.
+
+    Returns:
+        float: Seconds to wait, from the Retry-After header
+        bool: Whether the limit is the bot's global one
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        retry_after = DEFAULT_RETRY_AFTER
+    is_global = str(headers.get('X-RateLimit-Global', '')).lower() == 'true'
+    return max(retry_after, 0.0), is_global
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Failed to deliver bot reply: %s", future.exception())
+
+class OutboundDispatcher:
+    """
+    Per-channel outbound queues paced by a per-channel and a global token bucket.
+    """
+    def __init__(self, channel_rate=CHANNEL_RATE, global_rate=GLOBAL_RATE, clock=time.monotonic):
+        self.channel_rate = channel_rate
+        self.clock = clock
+        self.global_bucket = TokenBucket(*global_rate, clock=clock)
+        self._buckets = {}
+        self._queues = {}
+        self._workers = {}
+        self.stats = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'sent': 0,
+            'edited': 0,
+            'rate_limited': 0,
+            'failed': 0,
+        }
+
+    async def send(self, channel, content=None, *, embed=None):
+        """
+        Queues a message for ``channel`` and returns the sent message.
+
+        If an identical message is already waiting in the channel's queue, the
+        caller shares its result instead of sending a duplicate.
+        """
+        key = ('send', content, embed_key(embed))
+        return await self._enqueue('send', channel, channel.id, key, {'content': content, 'embed': embed})
+
+    async def edit(self, message, *, content=None, embed=None):
+        """
+        Queues an edit of ``message`` and returns the edited message.
+
+        A pending edit of the same message is replaced with this one, so rapid
+        successive updates result in a single request carrying the latest content.
+        """
+        kwargs = {}
+        if content is not None:
+            kwargs['content'] = content
+        if embed is not None:
+            kwargs['embed'] = embed
+        key = ('edit', message.id)
+        return await self._enqueue('edit', message, message.channel.id, key, kwargs)
+
+    def post(self, channel, content=None, *, embed=None):
+        """
+        Queues a message for ``channel`` without waiting for it to be sent.
+
+        Command handlers use this while they hold a database session, so that
+        they never yield to the event loop with a pooled connection checked
+        out. Delivery failures are logged.
+        """
+        key = ('send', content, embed_key(embed))
+        future = self._enqueue('send', channel, channel.id, key, {'content': content, 'embed': embed})
+        future.add_done_callback(_log_failure)
+        return future
+
+    def pending(self, channel_id=None):
+        """
+        Returns the number of queued messages for a channel, or for all channels.
+        """
+        if channel_id is not None:
+            return len(self._queues.get(channel_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def drain(self):
+        """
+        Waits until every queued message has been delivered.
+        """
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def _enqueue(self, action, target, channel_id, key, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(channel_id, deque())
+        self.stats['enqueued'] += 1
+
+        # Merge into a pending message with the same key, keeping the newest payload
+        for pending in queue:
+            if pending.key == key:
+                pending.target = target
+                pending.kwargs.update(kwargs)
+                pending.futures.append(future)
+                self.stats['coalesced'] += 1
+                break
+        else:
+            outbound = OutboundMessage(action, target, key, kwargs)
+            outbound.futures.append(future)
+            queue.append(outbound)
+
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._run(channel_id))
+
+        return future
+
+    def _bucket(self, channel_id):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = TokenBucket(*self.channel_rate, clock=self.clock)
+        return bucket
+
+    async def _run(self, channel_id):
+        queue = self._queues[channel_id]
+        bucket = self._bucket(channel_id)
+
+        try:
+            while queue:
+                delay = max(bucket.delay(), self.global_bucket.delay())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                bucket.consume()
+                self.global_bucket.consume()
+                outbound = queue.popleft()
+
+                try:
+                    if outbound.action == 'send':
+                        result = await outbound.target.send(**outbound.kwargs)
+                        self.stats['sent'] += 1
+                    else:
+                        result = await outbound.target.edit(**outbound.kwargs)
+                        self.stats['edited'] += 1
+                except Exception as e:
+                    if getattr(e, 'status', None) == 429:
+                        # Back off for as long as Discord asks and retry first
+                        self.stats['rate_limited'] += 1
+                        retry_after, is_global = rate_limit_of(e)
+                        bucket.penalize(retry_after)
+                        if is_global:
+                            self.global_bucket.penalize(retry_after)
+                        queue.appendleft(outbound)
+                        continue
+
+                    self.stats['failed'] += 1
+                    outbound.resolve(error=e)
+                    continue
+
+                outbound.resolve(result)
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                self._queues.pop(channel_id, None)
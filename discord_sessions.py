@@ -0,0 +1,155 @@
+"""
+Pending-order sessions for the Discord bot.
+
+When a user runs ``!order`` the bot waits for their next message in the same
+channel. Instead of registering a ``wait_for`` check that every incoming
+message has to run through, sessions are stored in a dict keyed by
+(author id, channel id): routing a message is a single lookup, and timeouts
+are handled by a hashed timer wheel so expiring sessions costs O(1) each.
+"""
+import asyncio
+import time
+
+class TimerWheel:
+    """
+    Hashed timer wheel with ``slots`` buckets of ``tick`` seconds each.
+
+    Scheduling and cancelling are O(1); advancing only visits the buckets for
+    the ticks that elapsed.
+    """
+    def __init__(self, tick=1.0, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._slots = [dict() for _ in range(slots)]
+        self._where = {}
+        self._current = self._tick_of(clock())
+
+    def _tick_of(self, when):
+        return int(when / self.tick)
+
+    def __len__(self):
+        return len(self._where)
+
+    def schedule(self, key, delay):
+        """
+        Schedules ``key`` to expire ``delay`` seconds from now, replacing any
+        earlier schedule for the same key.
+        """
+        self.cancel(key)
+        deadline = max(self._tick_of(self.clock() + delay), self._current + 1)
+        slot = deadline % len(self._slots)
+        self._slots[slot][key] = deadline
+        self._where[key] = slot
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self):
+        """
+        Moves the wheel up to the current time and returns the expired keys.
+        """
+        now = self._tick_of(self.clock())
+        expired = []
+
+        # Never walk more than one full turn; later rounds stay in their slot
+        start = max(self._current + 1, now - len(self._slots) + 1)
+        for tick in range(start, now + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key in [k for k, deadline in slot.items() if deadline <= now]:
+                del slot[key]
+                del self._where[key]
+                expired.append(key)
+
+        self._current = max(self._current, now)
+        return expired
+
+class OrderSession:
+    """
+    A user waiting to reply to an order prompt.
+
+    Only the product ids shown in the prompt are kept, not the ORM objects.
+    """
+    __slots__ = ('key', 'product_ids', 'future')
+
+    def __init__(self, key, product_ids, future):
+        self.key = key
+        self.product_ids = product_ids
+        self.future = future
+
+class OrderSessionManager:
+    """
+    Routes replies to pending order prompts in constant time per message.
+    """
+    def __init__(self, timeout=120.0, tick=1.0):
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick=tick)
+        self._sessions = {}
+        self._ticker = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, author_id, channel_id, product_ids):
+        """
+        Starts waiting for the next message from ``author_id`` in ``channel_id``.
+
+        A session the same user already had in that channel is cancelled.
+        """
+        key = (author_id, channel_id)
+        previous = self._sessions.pop(key, None)
+        if previous is not None and not previous.future.done():
+            previous.future.cancel()
+
+        session = OrderSession(key, tuple(product_ids), asyncio.get_running_loop().create_future())
+        self._sessions[key] = session
+        self.wheel.schedule(key, self.timeout)
+
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._tick())
+
+        return session
+
+    def dispatch(self, message):
+        """
+        Hands ``message`` to the session waiting for it, if any.
+
+        Returns:
+            bool: True if the message was consumed by a pending session
+        """
+        key = (message.author.id, message.channel.id)
+        session = self._sessions.pop(key, None)
+        if session is None:
+            return False
+
+        self.wheel.cancel(key)
+        if not session.future.done():
+            session.future.set_result(message)
+        return True
+
+    async def wait(self, session):
+        """
+        Returns the reply for ``session``, or raises asyncio.TimeoutError once it expires.
+        """
+        try:
+            return await session.future
+        except asyncio.CancelledError:
+            if session.future.cancelled():
+                # Superseded by a newer prompt for the same user and channel
+                raise asyncio.TimeoutError()
+            raise
+
+    def expire(self):
+        for key in self.wheel.advance():
+            session = self._sessions.pop(key, None)
+            if session is not None and not session.future.done():
+                session.future.set_exception(asyncio.TimeoutError())
+
+    async def _tick(self):
+        try:
+            while self._sessions:
+                await asyncio.sleep(self.wheel.tick)
+                self.expire()
+        finally:
+            self._ticker = None
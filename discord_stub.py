@@ -0,0 +1,173 @@
+"""
+Offline stand-ins for the parts of Discord the bot talks to.
+
+StubHTTP behaves like Discord's REST API as seen by the bot: every request
+takes some latency, and requests beyond the per-channel or global rate limit
+are rejected with a 429 carrying a ``Retry-After`` header. Channels and messages
+created from it can be passed anywhere the bot expects a discord.py channel
+or message, which lets burst behaviour be measured without a connection.
+StubContext, StubUser and FakeGateway complete the picture so that the
+bot's real command handlers and message listeners can be driven offline.
+"""
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+from discord_outbound import TokenBucket, CHANNEL_RATE, GLOBAL_RATE
+
+class StubHTTPException(Exception):
+    """
+    Mirrors the attributes of discord.HTTPException the bot relies on:
+    ``status``, and the rate limit headers of ``response``.
+    """
+    def __init__(self, status, retry_after=None, is_global=False):
+        super().__init__(f"{status} (retry after {retry_after})")
+        self.status = status
+        headers = {}
+        if retry_after is not None:
+            headers['Retry-After'] = str(retry_after)
+        if is_global:
+            headers['X-RateLimit-Global'] = 'true'
+        self.response = SimpleNamespace(status=status, headers=headers)
+
+class StubHTTP:
+    """
+    Fake REST layer enforcing Discord-like rate limits.
+
+    ``time_scale`` shrinks every rate limit window and latency so that
+    benchmarks covering minutes of real traffic finish in seconds.
+    """
+    def __init__(self, latency=0.05, time_scale=1.0, channel_rate=CHANNEL_RATE, global_rate=GLOBAL_RATE):
+        self.latency = latency * time_scale
+        self.time_scale = time_scale
+        self.channel_rate = (channel_rate[0], channel_rate[1] * time_scale)
+        self.global_bucket = TokenBucket(global_rate[0], global_rate[1] * time_scale)
+        self._buckets = {}
+        self._ids = itertools.count(1)
+        self.requests = []
+        self.rate_limited = 0
+
+    def _check(self, channel_id):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = TokenBucket(*self.channel_rate)
+
+        global_delay = self.global_bucket.delay()
+        if global_delay > 0:
+            self.rate_limited += 1
+            raise StubHTTPException(429, global_delay, is_global=True)
+
+        delay = bucket.delay()
+        if delay > 0:
+            self.rate_limited += 1
+            raise StubHTTPException(429, delay)
+
+        bucket.consume()
+        self.global_bucket.consume()
+
+    async def request(self, method, channel_id, payload):
+        self._check(channel_id)
+        await asyncio.sleep(self.latency)
+        self.requests.append((time.monotonic(), method, channel_id, payload))
+
+    def channel(self, channel_id=None, name=None):
+        channel_id = channel_id or next(self._ids)
+        return StubChannel(self, channel_id, name)
+
+class StubChannel:
+    """
+    A text channel whose sends go through a StubHTTP.
+    """
+    def __init__(self, http, channel_id, name=None):
+        self.http = http
+        self.id = channel_id
+        self.name = name or f"channel-{channel_id}"
+        self.messages = []
+
+    async def send(self, content=None, *, embed=None):
+        await self.http.request('POST', self.id, {'content': content, 'embed': embed})
+        message = StubMessage(self, next(self.http._ids), content, embed)
+        self.messages.append(message)
+        return message
+
+    def __eq__(self, other):
+        return isinstance(other, StubChannel) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class StubMessage:
+    """
+    A message previously sent to a StubChannel.
+    """
+    def __init__(self, channel, message_id, content=None, embed=None):
+        self.channel = channel
+        self.id = message_id
+        self.content = content
+        self.embed = embed
+        self.edits = 0
+
+    async def edit(self, content=None, *, embed=None):
+        await self.channel.http.request('PATCH', self.channel.id, {'content': content, 'embed': embed})
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        self.edits += 1
+        return self
+
+class StubUser:
+    """
+    A Discord user as seen by command handlers.
+    """
+    def __init__(self, user_id, name=None, bot=False):
+        self.id = user_id
+        self.name = name or f"user{user_id}"
+        self.display_name = self.name
+        self.bot = bot
+
+    def __eq__(self, other):
+        return isinstance(other, StubUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class StubIncomingMessage:
+    """
+    A message typed by a user, as delivered by the gateway.
+    """
+    def __init__(self, author, channel, content):
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.guild = getattr(channel, 'guild', None)
+
+class StubContext:
+    """
+    The subset of commands.Context that the bot's command handlers use.
+    """
+    def __init__(self, author, channel, guild=None):
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.interaction = None
+
+    async def send(self, content=None, *, embed=None):
+        return await self.channel.send(content, embed=embed)
+
+class FakeGateway:
+    """
+    Delivers user messages to a bot's ``on_message`` listeners without a
+    websocket connection.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.delivered = 0
+
+    async def deliver(self, author, channel, content):
+        message = StubIncomingMessage(author, channel, content)
+        self.delivered += 1
+        for listener in self.bot.extra_events.get('on_message', []):
+            await listener(message)
+        return message
@@ -0,0 +1,293 @@
+"""
+Append-only change log with a Server-Sent Events feed.
+
+Every mutation of orders, inventory, order periods and products adds a
+ChangeEvent row in the same transaction as the change itself. Consumers
+read the log from an offset (the last event id they saw) instead of
+re-downloading full snapshots.
+
+Streams do not query the database themselves. One EventBroadcaster thread
+per process polls for new events and hands them to every waiting stream, so
+the number of queries follows the rate of changes, not the number of open
+dashboards.
+
+Consumers move their cursor past every id they have seen, so an event must
+never become visible after one with a higher id. Ids are allocated at
+INSERT time, so events are held in the session and only inserted while it
+commits. On Postgres the inserting transaction first takes an advisory lock
+that it keeps until COMMIT: event ids are then allocated in commit order.
+SQLite serialises writers on its own. The lock is taken after all of the
+transaction's other writes, so it cannot deadlock with row locks.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from models import ChangeEvent
+
+logger = logging.getLogger(__name__)
+
+# How long an SSE response stays open before the client reconnects, which
+# bounds how long a gunicorn worker is tied up by one consumer
+STREAM_DURATION = 55.0
+POLL_INTERVAL = 1.0
+KEEPALIVE_INTERVAL = 15.0
+
+# Recent events kept in memory for streams; older offsets are read from the database
+BROADCAST_BUFFER_SIZE = 1000
+# The broadcaster thread stops after this many seconds without a waiting stream
+BROADCAST_IDLE_TIMEOUT = 30.0
+
+# Key of the Postgres advisory lock that orders event inserts by commit
+EVENT_LOCK_KEY = 7302
+
+# Wakes up waiting streams in this process as soon as new events commit;
+# writes from other processes are picked up by polling
+_new_events = threading.Condition()
+
+def record_event(kind, order_period_id=None, guild_id=None, **payload):
+    """
+    Adds an event to the current transaction. The caller commits; the row is
+    inserted as part of the commit, so it has no id before then.
+
+    Args:
+        kind (str): Event type, e.g. 'order.saved'
+        order_period_id (int, optional): Order period the change belongs to
+        guild_id (int, optional): Guild the change belongs to; None for catalog changes
+        **payload: JSON-serialisable details of the change
+    """
+    from app import db
+
+    db.session.info.setdefault('pending_events', []).append(ChangeEvent(
+        kind=kind,
+        guild_id=guild_id,
+        order_period_id=order_period_id,
+        payload=json.dumps(payload, separators=(',', ':'), default=str)
+    ))
+
+@event.listens_for(Session, 'before_commit')
+def _insert_events(session):
+    from app import db
+
+    pending = session.info.pop('pending_events', None)
+    if not pending:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        # Held until COMMIT, so a later id cannot commit before this one.
+        # Bound explicitly, a plain SELECT could otherwise go to the replica
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': EVENT_LOCK_KEY},
+                        bind_arguments={'bind': db.engine})
+    session.add_all(pending)
+    session.info['events_recorded'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _notify_waiters(session):
+    if session.info.pop('events_recorded', False):
+        with _new_events:
+            _new_events.notify_all()
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_events(session):
+    session.info.pop('events_recorded', None)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _drop_pending_events(session, transaction):
+    # Only when the whole transaction rolled back; savepoints keep them
+    if transaction.parent is None:
+        session.info.pop('pending_events', None)
+
+def order_payload(order):
+    """
+    Returns the event payload describing an order and its items.
+    """
+    return {
+        'order_id': order.id,
+        'user_id': order.user_id,
+        'user_name': order.user_name,
+        'is_delivered': order.is_delivered,
+        'items': [[item.product_id, item.quantity] for item in order.items]
+    }
+
+def period_payload(period):
+    return {
+        'period_id': period.id,
+        'month': period.month,
+        'year': period.year,
+        'is_open': period.is_open
+    }
+
+def serialize_event(change_event):
+    return {
+        'id': change_event.id,
+        'kind': change_event.kind,
+        'guild_id': change_event.guild_id,
+        'order_period_id': change_event.order_period_id,
+        'created_at': change_event.created_at.isoformat(),
+        'data': json.loads(change_event.payload)
+    }
+
+def latest_event_id():
+    from app import db
+    return db.session.query(db.func.max(ChangeEvent.id)).scalar() or 0
+
+def get_events_after(cursor, limit=100):
+    """
+    Returns up to ``limit`` serialised events with an id greater than ``cursor``.
+    """
+    from app import db
+
+    events = (ChangeEvent.query
+              .filter(ChangeEvent.id > cursor)
+              .order_by(ChangeEvent.id)
+              .limit(limit)
+              .all())
+    result = [serialize_event(e) for e in events]
+
+    # Hand the connection back to the pool while the caller waits for more
+    db.session.close()
+    return result
+
+class EventBroadcaster:
+    """
+    Polls the change log on behalf of every stream in this process.
+
+    The poller thread keeps the most recent events in a buffer. Waiters whose
+    cursor falls inside the buffer are served from memory; a waiter that is
+    further behind (e.g. reconnecting after a long time) reads its backlog
+    from the database once and then joins the buffer.
+    """
+    def __init__(self, buffer_size=BROADCAST_BUFFER_SIZE, poll_interval=POLL_INTERVAL,
+                 idle_timeout=BROADCAST_IDLE_TIMEOUT):
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self._buffer = deque()
+        self._floor = None  # the buffer holds every event with floor < id <= head
+        self._head = None
+        self._waiters = 0
+        self._idle_since = time.monotonic()
+        self._thread = None
+
+    def _start(self):
+        # Called with _new_events held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="event-broadcaster", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self._poll()
+        except Exception:
+            logger.exception("Event broadcaster stopped")
+            with _new_events:
+                # Let the next waiter start a fresh poller
+                self._thread = None
+                self._floor = self._head = None
+                self._buffer.clear()
+
+    def _poll(self):
+        from app import app
+
+        while True:
+            with app.app_context():
+                if self._head is None:
+                    head = latest_event_id()
+                    with _new_events:
+                        self._floor = self._head = head
+                        _new_events.notify_all()
+                events = get_events_after(self._head, limit=500)
+
+            with _new_events:
+                for e in events:
+                    if len(self._buffer) >= self.buffer_size:
+                        self._floor = self._buffer.popleft()['id']
+                    self._buffer.append(e)
+                    self._head = e['id']
+                if events:
+                    _new_events.notify_all()
+
+                if not self._waiters and time.monotonic() - self._idle_since > self.idle_timeout:
+                    # Nobody is listening; the next waiter restarts from the current head
+                    self._thread = None
+                    self._buffer.clear()
+                    self._floor = self._head = None
+                    return
+
+                if len(events) < 500:
+                    # Commits in this process wake us early through _new_events
+                    _new_events.wait(self.poll_interval)
+
+    def wait(self, cursor, timeout, limit=100):
+        """
+        Returns up to ``limit`` events after ``cursor`` as soon as any exist, or
+        an empty list once ``timeout`` seconds have passed.
+        """
+        deadline = time.monotonic() + timeout
+        with _new_events:
+            self._waiters += 1
+            self._start()
+            try:
+                while True:
+                    if self._head is not None:
+                        if cursor < self._floor:
+                            break
+                        if cursor < self._head:
+                            return [e for e in self._buffer if e['id'] > cursor][:limit]
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if self._head is None:
+                            # The poller has not started yet; the database has the answer
+                            break
+                        return []
+                    _new_events.wait(remaining)
+            finally:
+                self._waiters -= 1
+                self._idle_since = time.monotonic()
+
+        # Too far behind for the buffer: catch up from the database
+        return get_events_after(cursor, limit)
+
+broadcaster = EventBroadcaster()
+
+def wait_for_events(cursor, timeout, limit=100):
+    """
+    Long-polls for events after ``cursor``, returning as soon as any exist
+    or an empty list once ``timeout`` seconds have passed.
+    """
+    return broadcaster.wait(cursor, timeout, limit)
+
+def visible_to(change, guild_id):
+    """
+    Tells whether a serialised event concerns ``guild_id``. Catalog changes
+    concern every guild.
+    """
+    return guild_id is None or change['guild_id'] is None or change['guild_id'] == guild_id
+
+def stream_events(cursor, guild_id=None, duration=STREAM_DURATION):
+    """
+    Yields the SSE-formatted event stream starting after ``cursor``, limited
+    to the events of ``guild_id`` if given.
+    """
+    # Tell the browser how quickly to reconnect once this response ends
+    yield "retry: 1000\n\n"
+
+    deadline = time.monotonic() + duration
+    last_sent = time.monotonic()
+    while time.monotonic() < deadline:
+        events = wait_for_events(cursor, min(KEEPALIVE_INTERVAL, deadline - time.monotonic()))
+        for e in events:
+            cursor = e['id']
+            if not visible_to(e, guild_id):
+                continue
+            yield f"id: {e['id']}\nevent: {e['kind']}\ndata: {json.dumps(e, separators=(',', ':'))}\n\n"
+            last_sent = time.monotonic()
+
+        if time.monotonic() - last_sent >= KEEPALIVE_INTERVAL:
+            # Comment lines keep proxies from closing an idle connection
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
@@ -0,0 +1,331 @@
+"""
+Full-text search over orders across every period.
+
+Each order is indexed as one document made of the user's name and id, the
+names of the products it contains and their descriptions, so a query like
+``alice coffee`` finds the orders where Alice ordered coffee. Every query
+term must match, as a word or word prefix.
+
+The index lives in the database and is kept in sync by triggers on
+``order``, ``order_item`` and ``product``, so writes from the web workers,
+the bot, background jobs and bulk deletes are all covered without
+application code:
+
+* on SQLite, an FTS5 table ``order_search`` ranked with bm25;
+* on Postgres, a table ``order_search`` of weighted ``tsvector`` documents
+  behind a GIN index, ranked with ``ts_rank_cd``.
+
+``ensure_search_index`` creates the index and its triggers when missing and
+fills it from the existing orders. ``python fulltext.py`` rebuilds it from
+scratch. On other backends, or a SQLite build without FTS5, searches fall
+back to unranked substring matching.
+"""
+import logging
+
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import selectinload, joinedload
+
+from models import Order, OrderItem, Product
+from product_search import tokenize
+from tenancy import resolve_guild
+
+logger = logging.getLogger(__name__)
+
+# Longer queries are cut to this many terms
+MAX_QUERY_TERMS = 8
+
+# Relative weight of each indexed column for SQLite's bm25
+# (user_name, user_id, product_names, product_descriptions)
+BM25_WEIGHTS = (10.0, 10.0, 4.0, 1.0)
+
+# Correlated subqueries giving an order's product names and descriptions
+_SQLITE_PRODUCT_NAMES = (
+    "(SELECT coalesce(group_concat(p.name, ' '), '') FROM order_item i "
+    "JOIN product p ON p.id = i.product_id WHERE i.order_id = order_search.rowid)"
+)
+_SQLITE_PRODUCT_DESCRIPTIONS = (
+    "(SELECT coalesce(group_concat(p.description, ' '), '') FROM order_item i "
+    "JOIN product p ON p.id = i.product_id WHERE i.order_id = order_search.rowid)"
+)
+_SQLITE_REFRESH_PRODUCTS = (
+    f"UPDATE order_search SET product_names = {_SQLITE_PRODUCT_NAMES}, "
+    f"product_descriptions = {_SQLITE_PRODUCT_DESCRIPTIONS} WHERE rowid {{target}};"
+)
+
+SQLITE_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS order_search USING fts5("
+    "user_name, user_id, product_names, product_descriptions, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+SQLITE_TRIGGERS = [
+    # An id reused after the orders table was recreated replaces the stale document
+    """CREATE TRIGGER IF NOT EXISTS order_search_insert AFTER INSERT ON "order" BEGIN
+        DELETE FROM order_search WHERE rowid = NEW.id;
+        INSERT INTO order_search (rowid, user_name, user_id, product_names, product_descriptions)
+        VALUES (NEW.id, NEW.user_name, NEW.user_id, '', '');
+        """ + _SQLITE_REFRESH_PRODUCTS.format(target="= NEW.id") + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS order_search_update AFTER UPDATE OF user_name, user_id ON "order" BEGIN
+        UPDATE order_search SET user_name = NEW.user_name, user_id = NEW.user_id WHERE rowid = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS order_search_delete AFTER DELETE ON "order" BEGIN
+        DELETE FROM order_search WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS order_item_search_insert AFTER INSERT ON order_item BEGIN
+        """ + _SQLITE_REFRESH_PRODUCTS.format(target="= NEW.order_id") + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS order_item_search_update AFTER UPDATE OF order_id, product_id ON order_item BEGIN
+        """ + _SQLITE_REFRESH_PRODUCTS.format(target="IN (OLD.order_id, NEW.order_id)") + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS order_item_search_delete AFTER DELETE ON order_item BEGIN
+        """ + _SQLITE_REFRESH_PRODUCTS.format(target="= OLD.order_id") + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF name, description ON product BEGIN
+        """ + _SQLITE_REFRESH_PRODUCTS.format(
+            target="IN (SELECT order_id FROM order_item WHERE product_id = NEW.id)") + """
+    END""",
+]
+
+SQLITE_BACKFILL = (
+    "INSERT INTO order_search (rowid, user_name, user_id, product_names, product_descriptions) "
+    "SELECT o.id, o.user_name, o.user_id, "
+    "(SELECT coalesce(group_concat(p.name, ' '), '') FROM order_item i "
+    "JOIN product p ON p.id = i.product_id WHERE i.order_id = o.id), "
+    "(SELECT coalesce(group_concat(p.description, ' '), '') FROM order_item i "
+    "JOIN product p ON p.id = i.product_id WHERE i.order_id = o.id) "
+    'FROM "order" o'
+)
+
+SQLITE_SEARCH = (
+    "SELECT o.id, bm25(order_search, {weights}) AS score "
+    'FROM order_search JOIN "order" o ON o.id = order_search.rowid '
+    "WHERE order_search MATCH :query AND o.guild_id = :guild_id "
+    "ORDER BY score, o.id DESC LIMIT :limit OFFSET :offset"
+).format(weights=", ".join(map(str, BM25_WEIGHTS)))
+
+POSTGRES_DDL = [
+    "CREATE TABLE IF NOT EXISTS order_search ("
+    "order_id integer PRIMARY KEY, document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_order_search_document ON order_search USING gin (document)",
+    # Names weigh more (A) than product names (B) and descriptions (C)
+    """CREATE OR REPLACE FUNCTION order_search_refresh(target integer) RETURNS void AS $$
+        INSERT INTO order_search (order_id, document)
+        SELECT o.id,
+            setweight(to_tsvector('simple', o.user_name || ' ' || o.user_id), 'A') ||
+            setweight(to_tsvector('simple', coalesce(string_agg(p.name, ' '), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(string_agg(p.description, ' '), '')), 'C')
+        FROM "order" o
+        LEFT JOIN order_item i ON i.order_id = o.id
+        LEFT JOIN product p ON p.id = i.product_id
+        WHERE o.id = target
+        GROUP BY o.id
+        ON CONFLICT (order_id) DO UPDATE SET document = EXCLUDED.document
+    $$ LANGUAGE sql""",
+    """CREATE OR REPLACE FUNCTION order_search_order_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM order_search WHERE order_id = OLD.id;
+            RETURN OLD;
+        END IF;
+        PERFORM order_search_refresh(NEW.id);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION order_search_item_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM order_search_refresh(OLD.order_id);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND (TG_OP = 'INSERT' OR NEW.order_id <> OLD.order_id) THEN
+            PERFORM order_search_refresh(NEW.order_id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION order_search_product_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM order_search_refresh(order_id) FROM order_item WHERE product_id = NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS order_search_order ON "order"',
+    """CREATE TRIGGER order_search_order AFTER INSERT OR UPDATE OF user_name, user_id OR DELETE ON "order"
+        FOR EACH ROW EXECUTE FUNCTION order_search_order_changed()""",
+    "DROP TRIGGER IF EXISTS order_search_item ON order_item",
+    """CREATE TRIGGER order_search_item AFTER INSERT OR UPDATE OF order_id, product_id OR DELETE ON order_item
+        FOR EACH ROW EXECUTE FUNCTION order_search_item_changed()""",
+    "DROP TRIGGER IF EXISTS order_search_product ON product",
+    """CREATE TRIGGER order_search_product AFTER UPDATE OF name, description ON product
+        FOR EACH ROW EXECUTE FUNCTION order_search_product_changed()""",
+]
+
+POSTGRES_BACKFILL = 'SELECT count(order_search_refresh(o.id)) FROM "order" o'
+
+POSTGRES_SEARCH = (
+    "SELECT o.id, ts_rank_cd(s.document, q.query) AS score "
+    'FROM order_search s JOIN "order" o ON o.id = s.order_id, '
+    "to_tsquery('simple', :query) AS q(query) "
+    "WHERE s.document @@ q.query AND o.guild_id = :guild_id "
+    "ORDER BY score DESC, o.id DESC LIMIT :limit OFFSET :offset"
+)
+
+# Set by ensure_search_index: 'sqlite', 'postgresql' or None (substring fallback)
+_backend = None
+
+def _dialect(db):
+    return db.engine.dialect.name
+
+def ensure_search_index(db):
+    """
+    Creates the search index and its triggers if needed, filling it from the
+    existing orders the first time. Needs an app context.
+
+    Returns:
+        str: The backend in use, or None if searches fall back to substring matching
+    """
+    global _backend
+
+    dialect = _dialect(db)
+    if dialect not in ('sqlite', 'postgresql'):
+        logger.info("No full-text index for %s, order search uses substring matching", dialect)
+        _backend = None
+        return None
+
+    existed = inspect(db.engine).has_table('order_search')
+    try:
+        with db.engine.begin() as connection:
+            if dialect == 'sqlite':
+                connection.execute(text(SQLITE_TABLE))
+                for statement in SQLITE_TRIGGERS:
+                    connection.execute(text(statement))
+                if not existed:
+                    connection.execute(text(SQLITE_BACKFILL))
+            else:
+                for statement in POSTGRES_DDL:
+                    connection.execute(text(statement))
+                if not existed:
+                    connection.execute(text(POSTGRES_BACKFILL))
+    except DBAPIError:
+        # Typically SQLite built without FTS5, or another process backfilling
+        # at the same time; in the latter case its index is as good as ours
+        if not inspect(db.engine).has_table('order_search'):
+            logger.warning("Could not create the order search index, using substring matching", exc_info=True)
+            _backend = None
+            return None
+
+    _backend = dialect
+    return _backend
+
+def rebuild_search_index(db):
+    """
+    Drops the search index and builds it again from the orders. Needs an app context.
+    """
+    if _dialect(db) in ('sqlite', 'postgresql'):
+        # The triggers stay; they only touch rows of the recreated table
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS order_search"))
+    return ensure_search_index(db)
+
+def _match_expression(terms, backend):
+    # Terms come from tokenize(), so they hold word characters only
+    if backend == 'sqlite':
+        return " ".join(f'"{term}"*' for term in terms)
+    return " & ".join(f"{term}:*" for term in terms)
+
+def search_orders(query, guild_id=None, limit=20, offset=0):
+    """
+    Searches a guild's orders of every period. Needs an app context.
+
+    Args:
+        query (str): Words to look for in user names and ids, product names and descriptions
+        guild_id (int, optional): Guild to search, defaults to the current one
+        limit (int): Maximum number of results
+        offset (int): Number of results to skip, for paging
+
+    Returns:
+        list: (Order, score) tuples, best match first
+    """
+    from app import db
+
+    terms = tokenize(query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    guild_id = resolve_guild(guild_id)
+
+    if _backend is None:
+        return _substring_search(terms, guild_id, limit, offset)
+
+    statement = SQLITE_SEARCH if _backend == 'sqlite' else POSTGRES_SEARCH
+    rows = db.session.execute(text(statement), {
+        'query': _match_expression(terms, _backend),
+        'guild_id': guild_id,
+        'limit': limit,
+        'offset': offset,
+    }).all()
+    if not rows:
+        return []
+
+    # bm25 is lower for better matches; scores are returned higher-is-better
+    scores = {order_id: (-score if _backend == 'sqlite' else score) for order_id, score in rows}
+    orders = {order.id: order for order in _load_orders(scores)}
+    return [(orders[order_id], round(float(scores[order_id]), 6)) for order_id, _ in rows if order_id in orders]
+
+def _load_orders(order_ids):
+    return (Order.query
+            .options(joinedload(Order.order_period),
+                     selectinload(Order.items).joinedload(OrderItem.product))
+            .filter(Order.id.in_(list(order_ids)))
+            .all())
+
+def _substring_search(terms, guild_id, limit, offset):
+    query = Order.query.filter(Order.guild_id == guild_id)
+    for term in terms:
+        pattern = f"%{term}%"
+        query = query.filter(
+            Order.user_name.ilike(pattern)
+            | Order.user_id.ilike(pattern)
+            | Order.items.any(OrderItem.product.has(
+                Product.name.ilike(pattern) | Product.description.ilike(pattern)))
+        )
+
+    orders = (query
+              .options(joinedload(Order.order_period),
+                       selectinload(Order.items).joinedload(OrderItem.product))
+              .order_by(Order.id.desc())
+              .limit(limit)
+              .offset(offset)
+              .all())
+    return [(order, 0.0) for order in orders]
+
+def serialize_search_result(order, score):
+    """
+    Converts a search hit to a JSON-serializable dictionary.
+    """
+    return {
+        'id': order.id,
+        'user_id': order.user_id,
+        'user_name': order.user_name,
+        'is_delivered': order.is_delivered,
+        'order_period': {
+            'id': order.order_period.id,
+            'month': order.order_period.month,
+            'year': order.order_period.year,
+        },
+        'items': [{
+            'product_id': item.product_id,
+            'product_name': item.product.name,
+            'quantity': item.quantity
+        } for item in order.items],
+        'updated_at': order.updated_at.isoformat() if order.updated_at else None,
+        'score': score,
+    }
+
+if __name__ == "__main__":
+    from app import app, db
+
+    with app.app_context():
+        backend = rebuild_search_index(db)
+        count = db.session.execute(text("SELECT count(*) FROM order_search")).scalar() if backend else 0
+        print(f"Order search index ({backend or 'unavailable'}): {count} orders")
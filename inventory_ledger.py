@@ -0,0 +1,392 @@
+"""
+Append-only inventory ledger.
+
+Every stock change is an InventoryMovement carrying a signed delta. The
+``inventory`` table keeps each product's running balance, updated with an
+atomic ``quantity = quantity + delta`` in the same transaction, so reading
+current stock stays a single-row lookup and concurrent writers cannot lose
+each other's changes.
+
+Checkpoints record a product's balance as of one of its movements. One is
+written every ``INVENTORY_CHECKPOINT_EVERY`` movements of a product and one
+for every product whenever an order period closes. Historical balances start
+from the nearest earlier checkpoint and add the movements recorded since.
+"""
+import os
+from datetime import datetime
+
+from sqlalchemy import func, update, exists, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from models import Inventory, InventoryMovement, InventoryCheckpoint
+
+MOVEMENT_KINDS = ('restock', 'reservation', 'delivery', 'adjustment')
+
+# Recorded once per product by ensure_opening_balances, never by users
+OPENING_KIND = 'opening'
+
+# Bounds how many movements a historical balance has to add up
+CHECKPOINT_EVERY = int(os.environ.get("INVENTORY_CHECKPOINT_EVERY", "100"))
+
+def serialize_movement(movement):
+    return {
+        'id': movement.id,
+        'guild_id': movement.guild_id,
+        'product_id': movement.product_id,
+        'kind': movement.kind,
+        'delta': movement.delta,
+        'order_id': movement.order_id,
+        'note': movement.note,
+        'created_at': movement.created_at.isoformat() if movement.created_at else None
+    }
+
+def _apply_delta(guild_id, product_id, delta):
+    """
+    Adds ``delta`` to the product's balance, creating its row if needed.
+    """
+    from app import db
+
+    balance_row = (Inventory.guild_id == guild_id) & (Inventory.product_id == product_id)
+    applied = db.session.execute(
+        update(Inventory)
+        .where(balance_row)
+        .values(quantity=Inventory.quantity + delta)
+    ).rowcount
+    if applied:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(Inventory(guild_id=guild_id, product_id=product_id, quantity=delta))
+    except IntegrityError:
+        # Another writer created the row first
+        db.session.execute(
+            update(Inventory)
+            .where(balance_row)
+            .values(quantity=Inventory.quantity + delta)
+        )
+
+def record_movement(guild_id, product_id, delta, kind, note=None, order_id=None):
+    """
+    Appends a movement and applies it to the product's balance. The caller commits.
+
+    Args:
+        guild_id (int): Guild whose stock moves
+        product_id (int): ID of the product
+        delta (int): Signed change in stock
+        kind (str): One of MOVEMENT_KINDS
+        note (str, optional): Free text reason
+        order_id (int, optional): Order the movement relates to
+
+    Returns:
+        InventoryMovement: The appended movement
+        int: The product's balance after the movement
+    """
+    from app import db
+
+    # Updating the balance first takes the product's row lock, so movement ids
+    # of a product are allocated in the order their transactions commit
+    _apply_delta(guild_id, product_id, delta)
+
+    movement = InventoryMovement(guild_id=guild_id, product_id=product_id, kind=kind, delta=delta,
+                                 note=note, order_id=order_id)
+    db.session.add(movement)
+    db.session.flush()
+
+    balance = db.session.query(Inventory.quantity).filter_by(guild_id=guild_id, product_id=product_id).scalar()
+
+    last_checkpoint = (db.session.query(func.max(InventoryCheckpoint.movement_id))
+                       .filter(InventoryCheckpoint.guild_id == guild_id,
+                               InventoryCheckpoint.product_id == product_id)
+                       .scalar() or 0)
+    due = (db.session.query(InventoryMovement.id)
+           .filter(InventoryMovement.guild_id == guild_id,
+                   InventoryMovement.product_id == product_id,
+                   InventoryMovement.id > last_checkpoint)
+           .order_by(InventoryMovement.id)
+           .offset(CHECKPOINT_EVERY - 1)
+           .limit(1)
+           .scalar())
+    if due is not None:
+        db.session.add(InventoryCheckpoint(guild_id=guild_id, product_id=product_id,
+                                           movement_id=movement.id, quantity=balance))
+
+    return movement, balance
+
+def set_stock(guild_id, product_id, quantity, note=None):
+    """
+    Records the adjustment that brings a product's balance to ``quantity``.
+    The caller commits.
+
+    Returns:
+        InventoryMovement: The adjustment, or None if the balance was already right
+        int: The product's balance
+    """
+    from app import db
+
+    current = (db.session.query(Inventory.quantity)
+               .filter_by(guild_id=guild_id, product_id=product_id)
+               .with_for_update()
+               .scalar())
+    if current is None:
+        # First time the product is stocked; the row itself is not a movement
+        _apply_delta(guild_id, product_id, 0)
+        current = 0
+    if quantity == current:
+        return None, current
+
+    return record_movement(guild_id, product_id, quantity - current, 'adjustment', note=note)
+
+def _upsert_deltas(guild_id, deltas):
+    """
+    Adds each product's delta to its balance, creating missing rows, in a
+    single INSERT ... ON CONFLICT statement where the backend has one.
+    """
+    from app import db
+
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(db.engine.dialect.name)
+    if dialect is None:
+        for product_id, delta in deltas.items():
+            _apply_delta(guild_id, product_id, delta)
+        return
+
+    statement = dialect.insert(Inventory).values([
+        {'guild_id': guild_id, 'product_id': product_id, 'quantity': delta}
+        for product_id, delta in deltas.items()
+    ])
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[Inventory.guild_id, Inventory.product_id],
+        set_={'quantity': Inventory.quantity + statement.excluded.quantity}
+    ))
+
+def set_stock_levels(guild_id, levels, note=None):
+    """
+    Records the adjustments that bring several products' balances to the
+    given quantities, e.g. after a stock count. The caller commits.
+
+    Args:
+        guild_id (int): Guild whose stock to set
+        levels (dict): product_id -> quantity
+        note (str, optional): Free text reason
+
+    Returns:
+        list: {'product_id', 'delta', 'quantity'} for each balance that changed
+    """
+    from app import db
+
+    current = dict(db.session.query(Inventory.product_id, Inventory.quantity)
+                   .filter(Inventory.guild_id == guild_id, Inventory.product_id.in_(levels))
+                   .with_for_update())
+
+    # Products seen for the first time get their row even when counted at 0
+    deltas = {product_id: quantity - (current.get(product_id) or 0)
+              for product_id, quantity in levels.items()}
+    deltas = {product_id: delta for product_id, delta in deltas.items()
+              if delta or product_id not in current}
+    if not deltas:
+        return []
+
+    # Balances first, as in record_movement, so movement ids follow commit order
+    _upsert_deltas(guild_id, deltas)
+
+    changed = [product_id for product_id, delta in deltas.items() if delta]
+    if not changed:
+        return []
+
+    db.session.add_all([
+        InventoryMovement(guild_id=guild_id, product_id=product_id, kind='adjustment',
+                          delta=deltas[product_id], note=note)
+        for product_id in changed
+    ])
+    db.session.flush()
+
+    balances = dict(db.session.query(Inventory.product_id, Inventory.quantity)
+                    .filter(Inventory.guild_id == guild_id, Inventory.product_id.in_(changed)))
+
+    # Checkpoint the products that reached CHECKPOINT_EVERY movements since their last one
+    last_checkpoints = (db.session.query(InventoryCheckpoint.product_id,
+                                         func.max(InventoryCheckpoint.movement_id).label('movement_id'))
+                        .filter(InventoryCheckpoint.guild_id == guild_id,
+                                InventoryCheckpoint.product_id.in_(changed))
+                        .group_by(InventoryCheckpoint.product_id)
+                        .subquery())
+    due = (db.session.query(InventoryMovement.product_id, func.max(InventoryMovement.id))
+           .outerjoin(last_checkpoints, last_checkpoints.c.product_id == InventoryMovement.product_id)
+           .filter(InventoryMovement.guild_id == guild_id,
+                   InventoryMovement.product_id.in_(changed),
+                   InventoryMovement.id > func.coalesce(last_checkpoints.c.movement_id, 0))
+           .group_by(InventoryMovement.product_id)
+           .having(func.count() >= CHECKPOINT_EVERY))
+    for product_id, movement_id in due:
+        db.session.add(InventoryCheckpoint(guild_id=guild_id, product_id=product_id,
+                                           movement_id=movement_id, quantity=balances[product_id]))
+
+    return [
+        {'product_id': product_id, 'delta': deltas[product_id], 'quantity': balances[product_id]}
+        for product_id in changed
+    ]
+
+def checkpoint_inventory(guild_id, order_period_id=None):
+    """
+    Writes a checkpoint of every product's current balance in a guild. The
+    caller commits.
+
+    Args:
+        guild_id (int): Guild whose stock to checkpoint
+        order_period_id (int, optional): Order period whose closing stock this is
+    """
+    from app import db
+
+    # Locking the balances waits for in-flight movements, so every balance
+    # covers exactly the movements up to its product's latest one
+    items = Inventory.query.filter_by(guild_id=guild_id).with_for_update().populate_existing().all()
+    last_movements = dict(db.session.query(InventoryMovement.product_id, func.max(InventoryMovement.id))
+                          .filter(InventoryMovement.guild_id == guild_id)
+                          .group_by(InventoryMovement.product_id))
+
+    for item in items:
+        db.session.add(InventoryCheckpoint(
+            guild_id=guild_id,
+            product_id=item.product_id,
+            movement_id=last_movements.get(item.product_id, 0),
+            quantity=item.quantity or 0,
+            order_period_id=order_period_id
+        ))
+
+def _last_movement_at(guild_id, at):
+    """
+    Returns the id of the guild's last movement recorded at or before ``at``.
+    """
+    from app import db
+
+    return (db.session.query(InventoryMovement.id)
+            .filter(InventoryMovement.guild_id == guild_id, InventoryMovement.created_at <= at)
+            .order_by(InventoryMovement.created_at.desc(), InventoryMovement.id.desc())
+            .limit(1)
+            .scalar() or 0)
+
+def stock_at(guild_id, product_id, at):
+    """
+    Returns a product's balance at a point in time.
+
+    Args:
+        guild_id (int): Guild whose stock to read
+        product_id (int): ID of the product
+        at (datetime): Point in time (UTC)
+
+    Returns:
+        int: The balance
+    """
+    from app import db
+
+    upto = _last_movement_at(guild_id, at)
+
+    checkpoint = (db.session.query(InventoryCheckpoint.movement_id, InventoryCheckpoint.quantity)
+                  .filter(InventoryCheckpoint.guild_id == guild_id,
+                          InventoryCheckpoint.product_id == product_id,
+                          InventoryCheckpoint.movement_id <= upto)
+                  .order_by(InventoryCheckpoint.movement_id.desc())
+                  .first())
+    base_id, base_quantity = checkpoint or (0, 0)
+
+    since = (db.session.query(func.coalesce(func.sum(InventoryMovement.delta), 0))
+             .filter(InventoryMovement.guild_id == guild_id,
+                     InventoryMovement.product_id == product_id,
+                     InventoryMovement.id > base_id,
+                     InventoryMovement.id <= upto)
+             .scalar())
+
+    return base_quantity + since
+
+def inventory_snapshot(guild_id, at):
+    """
+    Returns every product's balance in a guild at a point in time.
+
+    Args:
+        guild_id (int): Guild whose stock to read
+        at (datetime): Point in time (UTC)
+
+    Returns:
+        dict: product_id -> balance, for products with stock history by then
+    """
+    from app import db
+
+    upto = _last_movement_at(guild_id, at)
+
+    # Each product's latest checkpoint at or before the cut-off
+    latest = (db.session.query(InventoryCheckpoint.product_id,
+                               func.max(InventoryCheckpoint.movement_id).label('movement_id'))
+              .filter(InventoryCheckpoint.guild_id == guild_id,
+                      InventoryCheckpoint.movement_id <= upto)
+              .group_by(InventoryCheckpoint.product_id)
+              .subquery())
+
+    balances = dict(db.session.query(InventoryCheckpoint.product_id, InventoryCheckpoint.quantity)
+                    .join(latest, (latest.c.product_id == InventoryCheckpoint.product_id)
+                                  & (latest.c.movement_id == InventoryCheckpoint.movement_id))
+                    .filter(InventoryCheckpoint.guild_id == guild_id))
+
+    # Plus the movements recorded after it
+    since = (db.session.query(InventoryMovement.product_id, func.sum(InventoryMovement.delta))
+             .outerjoin(latest, latest.c.product_id == InventoryMovement.product_id)
+             .filter(InventoryMovement.guild_id == guild_id,
+                     InventoryMovement.id <= upto,
+                     InventoryMovement.id > func.coalesce(latest.c.movement_id, 0))
+             .group_by(InventoryMovement.product_id))
+    for product_id, delta in since:
+        balances[product_id] = balances.get(product_id, 0) + delta
+
+    return balances
+
+def period_stock(order_period_id):
+    """
+    Returns the balances recorded when an order period was last closed.
+
+    Returns:
+        dict: product_id -> balance, empty if the period was never closed
+    """
+    checkpoints = (InventoryCheckpoint.query
+                   .filter_by(order_period_id=order_period_id)
+                   .order_by(InventoryCheckpoint.id)
+                   .all())
+    return {c.product_id: c.quantity for c in checkpoints}
+
+def get_movements(guild_id, product_id, before=None, limit=50):
+    """
+    Returns a product's movements in a guild, newest first. Pass the smallest
+    id of a page as ``before`` to get the next one.
+    """
+    query = InventoryMovement.query.filter_by(guild_id=guild_id, product_id=product_id)
+    if before:
+        query = query.filter(InventoryMovement.id < before)
+    return query.order_by(InventoryMovement.id.desc()).limit(limit).all()
+
+def ensure_opening_balances():
+    """
+    Gives stock that predates the ledger an opening movement, so that
+    historical balances add up to the current ones.
+    """
+    from app import db
+
+    untracked = (select(Inventory.guild_id, Inventory.product_id, literal(OPENING_KIND), Inventory.quantity,
+                        literal('Opening balance'), literal(datetime.utcnow()))
+                 .where(Inventory.quantity != 0,
+                        ~exists().where((InventoryMovement.guild_id == Inventory.guild_id)
+                                        & (InventoryMovement.product_id == Inventory.product_id))))
+    columns = ['guild_id', 'product_id', 'kind', 'delta', 'note', 'created_at']
+
+    # Every process runs this at startup. The unique index on opening movements
+    # makes a second process's insert a no-op instead of doubling the stock
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(db.engine.dialect.name)
+    if dialect is not None:
+        db.session.execute(dialect.insert(InventoryMovement).from_select(columns, untracked)
+                           .on_conflict_do_nothing())
+    else:
+        for row in db.session.execute(untracked).all():
+            try:
+                with db.session.begin_nested():
+                    db.session.add(InventoryMovement(**dict(zip(columns, row))))
+            except IntegrityError:
+                pass
+    db.session.commit()
@@ -0,0 +1,512 @@
+"""
+Background jobs for operations too slow to run inside a request.
+
+A job is a row in the ``job`` table plus a handler registered with ``@job``.
+Submitting a job commits the row as ``queued`` and hands its id to a thread
+pool; the request returns 202 straight away and clients follow the job
+through ``/api/jobs/<id>``.
+
+Workers claim a job with a conditional UPDATE (queued -> running), so a job
+is never run twice even if several processes see it. Running jobs refresh a
+heartbeat; a monitor thread requeues jobs whose heartbeat went stale (their
+process died) and picks up queued jobs left behind by a restart. The web
+server starts it in main.py; other processes only once they submit a job. Cancellation is cooperative: handlers stop at their next progress
+report.
+"""
+import csv
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, update
+from sqlalchemy.orm import selectinload
+
+from models import Job, Product, Inventory, InventoryMovement, InventoryCheckpoint, OrderPeriod, Order, OrderItem, OrderAllocation
+from events import record_event
+from tenancy import resolve_guild
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# A running job whose heartbeat is older than this is assumed to be orphaned
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", "120"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_MONITOR_INTERVAL = 30.0
+EXPORT_DIR = os.environ.get("JOB_EXPORT_DIR", "exports")
+
+# Rows handled per transaction by batched handlers
+BATCH_SIZE = 500
+
+ACTIVE_STATUSES = ("queued", "running")
+
+_handlers = {}
+
+class JobCancelled(Exception):
+    """
+    Raised inside a handler when cancellation of its job was requested.
+    """
+
+class JobError(Exception):
+    """
+    Raised by a handler to fail its job with a user-facing message.
+    """
+
+def job(kind):
+    """
+    Registers a handler for jobs of ``kind``. The handler receives a
+    JobContext followed by the job's parameters as keyword arguments and
+    returns a JSON-serialisable result.
+    """
+    def decorator(handler):
+        _handlers[kind] = handler
+        return handler
+    return decorator
+
+def job_kinds():
+    return sorted(_handlers)
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def serialize_job(job_row):
+    return {
+        'id': job_row.id,
+        'kind': job_row.kind,
+        'params': json.loads(job_row.params or '{}'),
+        'status': job_row.status,
+        'progress': round(job_row.progress or 0.0, 4),
+        'message': job_row.message,
+        'result': json.loads(job_row.result) if job_row.result else None,
+        'error': job_row.error,
+        'cancel_requested': job_row.cancel_requested,
+        'attempts': job_row.attempts,
+        'created_at': job_row.created_at.isoformat() if job_row.created_at else None,
+        'started_at': job_row.started_at.isoformat() if job_row.started_at else None,
+        'finished_at': job_row.finished_at.isoformat() if job_row.finished_at else None
+    }
+
+class JobContext:
+    """
+    Handed to a running handler to report progress and observe cancellation.
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def progress(self, fraction, message=None):
+        """
+        Commits the handler's work so far, records progress and raises
+        JobCancelled if the job was cancelled in the meantime.
+        """
+        from app import db
+
+        values = {'progress': max(0.0, min(1.0, fraction)), 'heartbeat_at': datetime.utcnow()}
+        if message is not None:
+            values['message'] = message[:200]
+        db.session.execute(update(Job).where(Job.id == self.job_id).values(**values))
+        db.session.commit()
+
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        from app import db
+
+        cancelled = db.session.query(Job.cancel_requested).filter(Job.id == self.job_id).scalar()
+        if cancelled:
+            raise JobCancelled()
+
+class JobRunner:
+    """
+    Runs jobs on a thread pool and keeps the jobs table consistent across restarts.
+    """
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._monitor = None
+        self._scheduled = set()  # ids of jobs waiting in or running on this process's pool
+        self._running = set()  # ids of jobs executing in this process
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the monitor thread, which also recovers jobs left over from a
+        previous run. Safe to call more than once.
+        """
+        with self._lock:
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._monitor_loop, name="job-monitor", daemon=True)
+                self._monitor.start()
+
+    def submit(self, kind, guild_id=None, **params):
+        """
+        Queues a job and schedules it on the pool.
+
+        An identical job of the same guild that is still queued or running is
+        returned instead of starting a second one.
+
+        Args:
+            kind (str): Registered job kind
+            guild_id (int, optional): Guild the job belongs to, defaults to the current one
+            **params: JSON-serialisable arguments for the handler
+
+        Returns:
+            Job: The queued (or already active) job
+            str: Error message if any
+        """
+        from app import db
+
+        if kind not in _handlers:
+            return None, f"Unknown job kind '{kind}'"
+
+        guild_id = resolve_guild(guild_id)
+        encoded = json.dumps(params, sort_keys=True, separators=(',', ':'))
+        existing = Job.query.filter(
+            Job.guild_id == guild_id,
+            Job.kind == kind,
+            Job.params == encoded,
+            Job.status.in_(ACTIVE_STATUSES)
+        ).first()
+        if existing:
+            return existing, None
+
+        new_job = Job(guild_id=guild_id, kind=kind, params=encoded, status='queued')
+        db.session.add(new_job)
+        db.session.commit()
+
+        self._schedule(new_job.id)
+        return new_job, None
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation of a job. Queued jobs are cancelled at once;
+        running jobs stop at their next progress report.
+
+        Returns:
+            Job: The job
+            str: Error message if any
+        """
+        from app import db
+
+        job_row = Job.query.get(job_id)
+        if not job_row:
+            return None, "Job not found"
+        if job_row.status not in ACTIVE_STATUSES:
+            return None, f"Job already {job_row.status}"
+
+        db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == 'queued')
+            .values(status='cancelled', cancel_requested=True, finished_at=datetime.utcnow())
+        )
+        db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == 'running')
+            .values(cancel_requested=True)
+        )
+        db.session.commit()
+        db.session.refresh(job_row)
+
+        return job_row, None
+
+    def _schedule(self, job_id):
+        with self._lock:
+            if job_id in self._scheduled:
+                return
+            self._scheduled.add(job_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            self._executor.submit(self._execute, job_id)
+        self.start()
+
+    def _claim(self, job_id):
+        from app import db
+
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', worker=_worker_name(), started_at=now,
+                    heartbeat_at=now, attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        return claimed == 1
+
+    def _finish(self, job_id, status, result=None, error=None):
+        from app import db
+
+        db.session.rollback()
+        values = {'status': status, 'finished_at': datetime.utcnow(), 'error': error}
+        if status == 'succeeded':
+            values['progress'] = 1.0
+        if result is not None:
+            values['result'] = json.dumps(result, default=str)
+        db.session.execute(update(Job).where(Job.id == job_id, Job.status == 'running').values(**values))
+        db.session.commit()
+
+    def _execute(self, job_id):
+        try:
+            self._run_job(job_id)
+        finally:
+            with self._lock:
+                self._scheduled.discard(job_id)
+
+    def _run_job(self, job_id):
+        from app import app
+
+        with app.app_context():
+            try:
+                if not self._claim(job_id):
+                    # Cancelled, or another worker got to it first
+                    return
+            except Exception:
+                logger.exception("Could not claim job %s", job_id)
+                return
+
+            with self._lock:
+                self._running.add(job_id)
+
+            try:
+                job_row = Job.query.get(job_id)
+                handler = _handlers.get(job_row.kind)
+                if handler is None:
+                    raise JobError(f"Unknown job kind '{job_row.kind}'")
+
+                result = handler(JobContext(job_id), **json.loads(job_row.params or '{}'))
+                self._finish(job_id, 'succeeded', result=result)
+            except JobCancelled:
+                self._finish(job_id, 'cancelled')
+            except JobError as e:
+                self._finish(job_id, 'failed', error=str(e))
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                self._finish(job_id, 'failed', error=f"{type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
+
+    def recover(self):
+        """
+        Requeues running jobs whose process stopped sending heartbeats and
+        schedules every queued job. Needs an app context.
+        """
+        from app import db
+
+        stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_AFTER)
+        orphaned = Job.status == 'running', Job.heartbeat_at < stale
+
+        # Jobs that keep dying are given up on rather than retried forever
+        db.session.execute(
+            update(Job)
+            .where(*orphaned, Job.attempts >= JOB_MAX_ATTEMPTS)
+            .values(status='failed', error='Worker stopped responding', finished_at=datetime.utcnow())
+        )
+        db.session.execute(
+            update(Job)
+            .where(*orphaned, Job.attempts < JOB_MAX_ATTEMPTS)
+            .values(status='queued', worker=None)
+        )
+        db.session.commit()
+
+        queued = [job_id for job_id, in db.session.query(Job.id).filter(Job.status == 'queued').order_by(Job.id)]
+        for job_id in queued:
+            self._schedule(job_id)
+        return queued
+
+    def _heartbeat(self):
+        from app import db
+
+        with self._lock:
+            running = list(self._running)
+        if running:
+            db.session.execute(
+                update(Job).where(Job.id.in_(running)).values(heartbeat_at=datetime.utcnow())
+            )
+            db.session.commit()
+
+    def _monitor_loop(self):
+        from app import app
+
+        while True:
+            try:
+                with app.app_context():
+                    self._heartbeat()
+                    self.recover()
+            except Exception:
+                logger.exception("Job monitor iteration failed")
+            time.sleep(JOB_MONITOR_INTERVAL)
+
+# Shared by every request in this process
+job_runner = JobRunner()
+
+def submit_job(kind, guild_id=None, **params):
+    return job_runner.submit(kind, guild_id=guild_id, **params)
+
+def cancel_job(job_id):
+    return job_runner.cancel(job_id)
+
+def export_path(job_id):
+    return os.path.join(EXPORT_DIR, f"job-{job_id}.csv")
+
+def _period_totals(period_id):
+    """
+    Returns per-product totals for an order period.
+    """
+    from app import db
+
+    rows = (db.session.query(
+                Product.id,
+                Product.name,
+                func.sum(OrderItem.quantity),
+                func.count(OrderItem.order_id))
+            .join(OrderItem, OrderItem.product_id == Product.id)
+            .join(Order, Order.id == OrderItem.order_id)
+            .filter(Order.order_period_id == period_id)
+            .group_by(Product.id, Product.name)
+            .order_by(Product.name)
+            .all())
+
+    order_count, delivered = (db.session.query(
+                                  func.count(Order.id),
+                                  func.count(Order.id).filter(Order.is_delivered.is_(True)))
+                              .filter(Order.order_period_id == period_id)
+                              .one())
+
+    return {
+        'period_id': period_id,
+        'orders': order_count,
+        'delivered': delivered,
+        'products': [
+            {'product_id': pid, 'name': name, 'quantity': int(quantity or 0), 'orders': count}
+            for pid, name, quantity, count in rows
+        ]
+    }
+
+@job('purge_product')
+def purge_product(ctx, product_id):
+    """
+    Deletes a product together with its inventory and every order item that
+    references it, across all order periods. Order items are removed in
+    batches; if the job is cancelled, batches already removed stay removed.
+    """
+    from app import db
+
+    product = Product.query.get(product_id)
+    if not product:
+        raise JobError("Product not found")
+
+    total = OrderItem.query.filter_by(product_id=product_id).count()
+    deleted = 0
+
+    while True:
+        order_ids = [order_id for order_id, in db.session.query(OrderItem.order_id)
+                     .filter(OrderItem.product_id == product_id)
+                     .limit(BATCH_SIZE)]
+        if not order_ids:
+            break
+
+        deleted += (OrderItem.query
+                    .filter(OrderItem.product_id == product_id, OrderItem.order_id.in_(order_ids))
+                    .delete(synchronize_session=False))
+        ctx.progress(0.95 * deleted / max(total, 1), f"Removed {deleted} of {total} order items")
+
+    # Items added while the purge ran go in the same transaction as the product
+    OrderItem.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+    Inventory.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+    InventoryCheckpoint.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+    InventoryMovement.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+    OrderAllocation.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+
+    name = product.name
+    db.session.delete(product)
+    record_event('product.deleted', product_id=product_id, name=name)
+    db.session.commit()
+
+    return {'product_id': product_id, 'name': name, 'order_items_deleted': deleted}
+
+@job('recompute_totals')
+def recompute_totals(ctx, period_id):
+    """
+    Computes per-product quantities and delivery counts for an order period.
+    """
+    if not OrderPeriod.query.get(period_id):
+        raise JobError("Order period not found")
+
+    ctx.progress(0.1, "Aggregating orders")
+    return _period_totals(period_id)
+
+@job('close_period')
+def close_period(ctx, period_id):
+    """
+    Closes an order period and returns its final totals.
+    """
+    from utils import toggle_order_period
+
+    period = OrderPeriod.query.get(period_id)
+    if not period:
+        raise JobError("Order period not found")
+
+    if period.is_open:
+        period, error = toggle_order_period(period_id, guild_id=period.guild_id)
+        if error:
+            raise JobError(error)
+
+    ctx.progress(0.5, f"Order period {period.month}/{period.year} closed, computing totals")
+    return _period_totals(period_id)
+
+@job('export_period')
+def export_period(ctx, period_id):
+    """
+    Writes every order item of an order period to a CSV file.
+    """
+    from app import db
+
+    period = OrderPeriod.query.get(period_id)
+    if not period:
+        raise JobError("Order period not found")
+
+    month, year = period.month, period.year
+    total = Order.query.filter_by(order_period_id=period_id).count()
+    path = export_path(ctx.job_id)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+
+    exported = rows = 0
+    last_id = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['order_id', 'user_id', 'user_name', 'is_delivered',
+                         'product_id', 'product_name', 'quantity'])
+
+        # Keyset pagination keeps every batch a cheap index range scan
+        while True:
+            batch = (Order.query
+                     .options(selectinload(Order.items).selectinload(OrderItem.product))
+                     .filter(Order.order_period_id == period_id, Order.id > last_id)
+                     .order_by(Order.id)
+                     .limit(BATCH_SIZE)
+                     .all())
+            if not batch:
+                break
+
+            for order in batch:
+                for item in order.items:
+                    writer.writerow([order.id, order.user_id, order.user_name, order.is_delivered,
+                                     item.product_id, item.product.name, item.quantity])
+                    rows += 1
+
+            exported += len(batch)
+            last_id = batch[-1].id
+            db.session.expunge_all()
+            ctx.progress(exported / max(total, 1), f"Exported {exported} of {total} orders")
+
+    return {
+        'period_id': period_id,
+        'month': month,
+        'year': year,
+        'orders': exported,
+        'rows': rows,
+        'filename': f"orders-{year}-{month:02d}.csv"
+    }
@@ -1,4 +1,9 @@
 from app import app
+from jobs import job_runner
+
+# Only the web server resumes jobs interrupted by a restart; the bot, the
+# benchmarks and scripts that import app start the runner when they submit a job
+job_runner.start()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
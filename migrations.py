@@ -0,0 +1,162 @@
+"""
+In-place upgrades of databases created by earlier versions of the app.
+
+``db.create_all()`` creates missing tables but never alters existing ones,
+so ``upgrade_database`` runs right after it at startup, before anything
+queries the tables, and brings older schemas up to date:
+
+- guild scoping: order periods, orders, inventory, the inventory ledger and
+  background jobs gained a ``guild_id``. Existing rows are assigned to
+  ``DEFAULT_GUILD_ID``, the inventory primary key becomes (guild_id,
+  product_id) and month/year is unique per guild instead of globally. Change
+  events, except catalog ones, are assigned to the default guild too;
+- indexes added to existing tables since they were created.
+
+Every step checks the live schema first, so running it again does nothing.
+Processes starting together (web workers, the bot) are serialised with an
+advisory lock on Postgres and a write transaction on SQLite.
+"""
+import logging
+
+from sqlalchemy import MetaData, Table, inspect, literal, select, text
+from sqlalchemy.schema import CreateTable, DropTable
+
+from tenancy import DEFAULT_GUILD_ID
+
+logger = logging.getLogger(__name__)
+
+# Tables whose rows all belong to a guild
+GUILD_TABLES = ('order_period', 'order', 'inventory', 'inventory_movement', 'inventory_checkpoint', 'job')
+
+# Tables where guild_id is optional, with the rows that stay without one
+OPTIONAL_GUILD_TABLES = {
+    'change_event': "kind LIKE 'product.%'",  # Catalog changes concern every guild
+}
+
+# Indexes replaced by guild-leading ones, left behind on Postgres
+OBSOLETE_INDEXES = (
+    'ix_inventory_movement_product_id_id',
+    'ix_inventory_movement_created_at',
+    'ix_inventory_checkpoint_product_id_movement_id',
+)
+
+# Arbitrary key of the Postgres advisory lock held while upgrading
+LOCK_KEY = 7301
+
+def _pending(db, inspector):
+    """
+    Returns the tables lacking guild_id and the indexes missing from existing tables.
+    """
+    tables = set(inspector.get_table_names())
+    missing_columns = [name for name in (*GUILD_TABLES, *OPTIONAL_GUILD_TABLES)
+                       if name in tables
+                       and 'guild_id' not in {c['name'] for c in inspector.get_columns(name)}]
+
+    missing_indexes = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing_indexes.extend(index for index in table.indexes if index.name not in existing)
+    return missing_columns, missing_indexes
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+def _rebuild_sqlite_table(db, connection, name):
+    # SQLite cannot change a primary key, a table constraint or add a NOT NULL
+    # column without a default, so the table is copied into one built from the model
+    table = db.metadata.tables[name]
+    scratch = MetaData()
+    for other in db.metadata.sorted_tables:
+        other.to_metadata(scratch)
+    rebuilt = table.to_metadata(scratch, name=f"{name}_upgrade")
+    old = Table(name, MetaData(), autoload_with=connection)
+
+    copied = [column.name for column in rebuilt.columns if column.name in old.c]
+    connection.execute(CreateTable(rebuilt))
+    connection.execute(rebuilt.insert().from_select(
+        copied + ['guild_id'],
+        select(*[old.c[column] for column in copied], literal(DEFAULT_GUILD_ID))
+    ))
+    connection.execute(DropTable(old))
+    connection.execute(text(f"ALTER TABLE {_quote(connection, rebuilt.name)} RENAME TO {_quote(connection, name)}"))
+
+def _add_postgres_guild_column(connection, name):
+    table = _quote(connection, name)
+    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN guild_id BIGINT"))
+    connection.execute(text(f"UPDATE {table} SET guild_id = :guild_id"), {'guild_id': DEFAULT_GUILD_ID})
+    connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN guild_id SET NOT NULL"))
+
+    inspector = inspect(connection)
+    if name == 'inventory':
+        primary_key = inspector.get_pk_constraint(name)['name']
+        connection.execute(text(f"ALTER TABLE inventory DROP CONSTRAINT {_quote(connection, primary_key)}, "
+                                "ADD PRIMARY KEY (guild_id, product_id)"))
+    elif name == 'order_period':
+        for constraint in inspector.get_unique_constraints(name):
+            if set(constraint['column_names']) == {'month', 'year'}:
+                connection.execute(text(f"ALTER TABLE order_period DROP CONSTRAINT "
+                                        f"{_quote(connection, constraint['name'])}"))
+        connection.execute(text("ALTER TABLE order_period "
+                                "ADD CONSTRAINT unique_guild_month_year UNIQUE (guild_id, month, year)"))
+
+def _add_optional_guild_column(connection, name, shared):
+    table = _quote(connection, name)
+    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN guild_id BIGINT"))
+    connection.execute(text(f"UPDATE {table} SET guild_id = :guild_id WHERE NOT ({shared})"),
+                       {'guild_id': DEFAULT_GUILD_ID})
+
+def _upgrade(db, connection):
+    dialect = connection.dialect.name
+    missing_columns, _ = _pending(db, inspect(connection))
+
+    for name in missing_columns:
+        logger.info("Adding guild_id to %s, existing rows go to guild %s", name, DEFAULT_GUILD_ID)
+        if name in OPTIONAL_GUILD_TABLES:
+            _add_optional_guild_column(connection, name, OPTIONAL_GUILD_TABLES[name])
+        elif dialect == 'sqlite':
+            _rebuild_sqlite_table(db, connection, name)
+        else:
+            _add_postgres_guild_column(connection, name)
+
+    if dialect == 'postgresql':
+        for index in OBSOLETE_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index}"))
+
+    # Checked again, rebuilt tables lost their indexes
+    _, missing_indexes = _pending(db, inspect(connection))
+    for index in missing_indexes:
+        logger.info("Creating index %s", index.name)
+        index.create(connection)
+
+def upgrade_database(db):
+    """
+    Upgrades the schema of an existing database to the current models.
+    Needs an app context and must run after ``db.create_all()``.
+
+    Returns:
+        bool: Whether anything was changed
+    """
+    missing_columns, missing_indexes = _pending(db, inspect(db.engine))
+    if not missing_columns and not missing_indexes:
+        return False
+
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # Rebuilt tables are dropped while other tables still point at them.
+            # Only takes effect outside a transaction, so it comes first
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            # Takes the write lock now, so a second process waits here and then finds nothing to do
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+        elif connection.dialect.name == 'postgresql':
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': LOCK_KEY})
+        try:
+            _upgrade(db, connection)
+            connection.commit()
+        finally:
+            if connection.dialect.name == 'sqlite':
+                # The connection goes back to the pool
+                connection.rollback()
+                connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+    return True
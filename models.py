@@ -14,8 +14,9 @@ class Product(db.Model):
 
 class Inventory(db.Model):
     """
-    Tracks the current inventory level for each product.
+    Tracks the current inventory level for each product in a guild.
     """
+    guild_id = db.Column(db.BigInteger, primary_key=True)  # Discord guild (tenant)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
     quantity = db.Column(db.Integer, default=0)
     
@@ -25,12 +26,59 @@ class Inventory(db.Model):
     def __repr__(self):
         return f"<Inventory {self.product.name}: {self.quantity}>"
 
+class InventoryMovement(db.Model):
+    """
+    A signed change to a product's stock. Movements are only ever appended;
+    the running total of a product's movements is its stock level.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # restock, reservation, delivery, adjustment, opening
+    delta = db.Column(db.Integer, nullable=False)  # Positive adds stock, negative removes it
+    order_id = db.Column(db.Integer)  # Not a foreign key, the ledger outlives deleted orders
+    note = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Range scans of one product's movements after a checkpoint
+        db.Index('ix_inventory_movement_guild_product_id', 'guild_id', 'product_id', 'id'),
+        db.Index('ix_inventory_movement_guild_created_at', 'guild_id', 'created_at'),
+        # At most one opening balance per product, however many processes start at once
+        db.Index('uq_inventory_movement_opening', 'guild_id', 'product_id', unique=True,
+                 sqlite_where=db.text("kind = 'opening'"), postgresql_where=db.text("kind = 'opening'")),
+    )
+    
+    def __repr__(self):
+        return f"<InventoryMovement {self.id} {self.kind} {self.delta:+d} for product {self.product_id}>"
+
+class InventoryCheckpoint(db.Model):
+    """
+    A product's stock level as of a given movement, so that historical
+    balances only need the movements recorded since.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    movement_id = db.Column(db.Integer, nullable=False)  # Last movement included in quantity
+    quantity = db.Column(db.Integer, nullable=False)
+    order_period_id = db.Column(db.Integer, index=True)  # Set for the snapshot taken when a period closes
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_inventory_checkpoint_guild_product_movement', 'guild_id', 'product_id', 'movement_id'),
+    )
+    
+    def __repr__(self):
+        return f"<InventoryCheckpoint product {self.product_id} @ {self.movement_id}: {self.quantity}>"
+
 class OrderPeriod(db.Model):
     """
     Represents a month during which orders can be placed.
-    Only one order period can be open at a time.
+    Only one order period per guild can be open at a time.
     """
     id = db.Column(db.Integer, primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)  # Discord guild (tenant)
     month = db.Column(db.Integer, nullable=False)  # 1-12
     year = db.Column(db.Integer, nullable=False)
     is_open = db.Column(db.Boolean, default=False)
@@ -40,7 +88,9 @@ class OrderPeriod(db.Model):
     orders = db.relationship('Order', backref='order_period', cascade="all, delete-orphan")
     
     __table_args__ = (
-        db.UniqueConstraint('month', 'year', name='unique_month_year'),
+        db.UniqueConstraint('guild_id', 'month', 'year', name='unique_guild_month_year'),
+        # Finding a guild's open period
+        db.Index('ix_order_period_guild_open', 'guild_id', 'is_open'),
     )
     
     def __repr__(self):
@@ -53,6 +103,7 @@ class Order(db.Model):
     A user can only have one order per order period.
     """
     id = db.Column(db.Integer, primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)  # Same as the order period's
     user_id = db.Column(db.String(100), nullable=False)  # Could be Discord ID or other identifier
     user_name = db.Column(db.String(100), nullable=False)  # Display name
     order_period_id = db.Column(db.Integer, db.ForeignKey('order_period.id'), nullable=False)
@@ -65,6 +116,10 @@ class Order(db.Model):
     
     __table_args__ = (
         db.UniqueConstraint('user_id', 'order_period_id', name='unique_user_period'),
+        db.Index('ix_order_guild_period', 'guild_id', 'order_period_id'),
+        db.Index('ix_order_guild_user', 'guild_id', 'user_id'),
+        # A user's history, newest first, paginated on (created_at, id)
+        db.Index('ix_order_user_guild_created', 'user_id', 'guild_id', 'created_at', 'id'),
     )
     
     def __repr__(self):
@@ -84,3 +139,92 @@ class OrderItem(db.Model):
     
     def __repr__(self):
         return f"<OrderItem {self.product.name}: {self.quantity}>"
+
+class OrderAllocation(db.Model):
+    """
+    The quantity of a product set aside for an order when its period's
+    demand exceeded stock. Rewritten as a whole each time the period is allocated.
+    """
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id', ondelete='CASCADE'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)
+    order_period_id = db.Column(db.Integer, nullable=False)
+    requested = db.Column(db.Integer, nullable=False)
+    allocated = db.Column(db.Integer, nullable=False)
+    policy = db.Column(db.String(20), nullable=False)  # proportional, first_come, capped
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_order_allocation_guild_period', 'guild_id', 'order_period_id'),
+    )
+    
+    def __repr__(self):
+        return f"<OrderAllocation order {self.order_id} product {self.product_id}: {self.allocated}/{self.requested}>"
+
+class ChangeEvent(db.Model):
+    """
+    An append-only record of a change to orders, inventory, periods or products.
+    The id doubles as the offset consumers resume from.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # e.g. 'order.saved', 'inventory.updated'
+    guild_id = db.Column(db.BigInteger)  # None for catalog changes, which concern every guild
+    order_period_id = db.Column(db.Integer, index=True)  # Not a foreign key, events outlive deleted rows
+    payload = db.Column(db.Text, nullable=False)  # Compact JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Latest catalog event (guild_id IS NULL), see picklist.py
+        db.Index('ix_change_event_guild_id', 'guild_id', 'id'),
+    )
+    
+    def __repr__(self):
+        return f"<ChangeEvent {self.id} {self.kind}>"
+
+class Job(db.Model):
+    """
+    A long-running operation executed in the background by the job runner.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)  # Guild that submitted it
+    kind = db.Column(db.String(50), nullable=False)  # e.g. 'purge_product', 'export_period'
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, succeeded, failed, cancelled
+    progress = db.Column(db.Float, default=0.0)  # 0.0 - 1.0
+    message = db.Column(db.String(200))  # Latest progress message
+    result = db.Column(db.Text)  # JSON returned by the handler
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, default=False)
+    attempts = db.Column(db.Integer, default=0)
+    worker = db.Column(db.String(100))  # host:pid of the process running it
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # Refreshed while running; stale jobs are requeued
+    
+    __table_args__ = (
+        # A guild's jobs, newest first
+        db.Index('ix_job_guild_id', 'guild_id', 'id'),
+    )
+    
+    def __repr__(self):
+        return f"<Job {self.id} {self.kind} ({self.status})>"
+
+class PinnedBoard(db.Model):
+    """
+    A bot message pinned in a channel and kept up to date with the guild's
+    inventory or the product catalog.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    guild_id = db.Column(db.BigInteger, nullable=False)
+    channel_id = db.Column(db.BigInteger, nullable=False)
+    message_id = db.Column(db.BigInteger, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # inventory, catalog
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('channel_id', 'kind', name='unique_channel_board'),
+    )
+    
+    def __repr__(self):
+        return f"<PinnedBoard {self.kind} in channel {self.channel_id}>"
@@ -0,0 +1,142 @@
+"""
+Pick lists for delivery day.
+
+A period's pick list groups every undelivered order line by product, with
+the users and quantities to pick for each. When the period has been
+allocated (see allocation.py), the allocated quantity is picked instead of
+the requested one.
+
+The list is read with one aggregate query, sorted by product, and grouped
+in a single pass over the rows. It is cached per period and reused until the
+change feed shows a newer event for the period (an order saved, deleted,
+delivered, or the period allocated) or for the catalog (a product renamed or
+deleted). Checking that costs one indexed ``max(id)`` query.
+"""
+import csv
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import and_, false, func, select
+
+from models import Product, Order, OrderItem, OrderAllocation, ChangeEvent
+
+# Periods whose pick list is kept in memory, per process
+CACHE_SIZE = int(os.environ.get("PICKLIST_CACHE_SIZE", "32"))
+
+CSV_COLUMNS = ['product_id', 'product_name', 'order_id', 'user_id', 'user_name', 'requested', 'quantity']
+
+_cache = OrderedDict()  # period id -> pick list
+_cache_lock = threading.Lock()
+
+def picklist_version(period_id):
+    """
+    Returns the ids of the latest events for the period and for the catalog.
+    """
+    from app import db
+
+    period_events = select(func.max(ChangeEvent.id)).where(ChangeEvent.order_period_id == period_id)
+    catalog_events = select(func.max(ChangeEvent.id)).where(ChangeEvent.guild_id.is_(None))
+    return tuple(db.session.execute(
+        select(period_events.scalar_subquery(), catalog_events.scalar_subquery())
+    ).one())
+
+def build_picklist(period):
+    """
+    Reads a period's pick list from the database.
+
+    Returns:
+        dict: The period, totals, and one entry per product with its lines
+    """
+    from app import db
+
+    rows = db.session.execute(
+        select(OrderItem.product_id, Product.name, Order.id, Order.user_id, Order.user_name,
+               func.sum(OrderItem.quantity), OrderAllocation.allocated)
+        .join(Order, Order.id == OrderItem.order_id)
+        .join(Product, Product.id == OrderItem.product_id)
+        .outerjoin(OrderAllocation, and_(OrderAllocation.order_id == OrderItem.order_id,
+                                         OrderAllocation.product_id == OrderItem.product_id))
+        .where(Order.guild_id == period.guild_id, Order.order_period_id == period.id,
+               Order.is_delivered == false())
+        .group_by(OrderItem.product_id, Product.name, Order.id, Order.user_id, Order.user_name,
+                  OrderAllocation.allocated)
+        .order_by(Product.name, OrderItem.product_id, Order.user_name, Order.id)
+    )
+
+    products = []
+    order_ids = set()
+    units = 0
+    current = None
+    for product_id, name, order_id, user_id, user_name, requested, allocated in rows:
+        if current is None or current['product_id'] != product_id:
+            current = {'product_id': product_id, 'product_name': name, 'requested': 0, 'quantity': 0, 'lines': []}
+            products.append(current)
+
+        quantity = requested if allocated is None else allocated
+        current['lines'].append({
+            'order_id': order_id,
+            'user_id': user_id,
+            'user_name': user_name,
+            'requested': requested,
+            'quantity': quantity,
+        })
+        current['requested'] += requested
+        current['quantity'] += quantity
+        order_ids.add(order_id)
+        units += quantity
+
+    return {
+        'period_id': period.id,
+        'month': period.month,
+        'year': period.year,
+        'orders': len(order_ids),
+        'units': units,
+        'products': products,
+    }
+
+def get_picklist(period):
+    """
+    Returns a period's pick list, from the cache while it is current.
+    The result is shared between callers and must not be modified.
+    """
+    # Read before the rows, so a change landing in between only causes a rebuild next time
+    version = picklist_version(period.id)
+
+    with _cache_lock:
+        cached = _cache.get(period.id)
+        if cached is not None and cached['version'] == version:
+            _cache.move_to_end(period.id)
+            return cached
+
+    picklist = build_picklist(period)
+    picklist['version'] = version
+
+    with _cache_lock:
+        _cache[period.id] = picklist
+        _cache.move_to_end(period.id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return picklist
+
+def picklist_csv(picklist):
+    """
+    Yields a pick list as CSV text, one line per order line.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(CSV_COLUMNS)
+    yield flush()
+    for product in picklist['products']:
+        for line in product['lines']:
+            writer.writerow([product['product_id'], product['product_name'], line['order_id'],
+                             line['user_id'], line['user_name'], line['requested'], line['quantity']])
+        yield flush()
@@ -0,0 +1,295 @@
+"""
+In-memory search index over the product catalog.
+
+Products are matched on their name and description by whole token, by token
+prefix and, when a token matches nothing, by trigram similarity to known
+tokens so that typos still match. The index is rebuilt lazily. A transaction in this
+process that changed a Product marks it stale once it commits, or rolls
+back, since the index may have been rebuilt from its uncommitted rows.
+Catalog changes made by other processes show up as a newer catalog event in
+the change log, checked at most every ``CATALOG_CHECK_INTERVAL`` seconds.
+The index is also refreshed every ``ttl`` seconds regardless.
+"""
+import heapq
+import re
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, object_session
+
+from models import ChangeEvent, Product
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Limits the number of distinct tokens a one or two letter prefix expands to
+MAX_PREFIX_EXPANSION = 200
+
+# Minimum trigram similarity for a misspelled token to match
+FUZZY_THRESHOLD = 0.45
+
+# Match weights, from strongest to weakest
+NAME_TOKEN, NAME_PREFIX, DESC_TOKEN, DESC_PREFIX = 3.0, 2.0, 1.0, 0.5
+EXACT_NAME_BONUS, NAME_PREFIX_BONUS = 10.0, 5.0
+
+# Seconds between checks of the change log for catalog changes by other processes
+CATALOG_CHECK_INTERVAL = 1.0
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or "").lower())
+
+def trigrams(text):
+    text = f"  {(text or '').lower()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class ProductSearchIndex:
+    """
+    Token, prefix and trigram index over product names and descriptions.
+    """
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self._built_at = None
+        self._checked_at = None
+        self._catalog_version = None
+        self._docs = {}
+        self._names = []
+        self._name_postings = {}
+        self._desc_postings = {}
+        self._tokens = []
+        self._token_grams = {}
+        self._gram_counts = {}
+
+    def invalidate(self):
+        self._built_at = None
+
+    def is_stale(self):
+        return self._built_at is None or time.monotonic() - self._built_at > self.ttl
+
+    def _catalog_changed(self, db):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < CATALOG_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        return self._latest_catalog_event(db) != self._catalog_version
+
+    def _latest_catalog_event(self, db):
+        # Catalog events are the ones without a guild
+        return db.session.query(func.max(ChangeEvent.id)).filter(ChangeEvent.guild_id.is_(None)).scalar()
+
+    def ensure_fresh(self):
+        """
+        Rebuilds the index from the database if it is stale or the catalog
+        changed since it was built. Needs an app context.
+        """
+        from app import db
+
+        if self.is_stale() or self._catalog_changed(db):
+            # Read first, so a change committing during the rebuild is seen next time
+            version = self._latest_catalog_event(db)
+            rows = db.session.query(Product.id, Product.name, Product.description).all()
+            self.build(rows)
+            self._catalog_version = version
+
+    def build(self, rows):
+        """
+        Replaces the index contents with ``rows`` of (id, name, description).
+        """
+        docs = {}
+        names = []
+        name_postings = {}
+        desc_postings = {}
+
+        for product_id, name, description in rows:
+            docs[product_id] = (name, description or "")
+            names.append((name.lower(), product_id))
+            for token in tokenize(name):
+                name_postings.setdefault(token, set()).add(product_id)
+            for token in tokenize(description):
+                desc_postings.setdefault(token, set()).add(product_id)
+
+        # Trigrams are indexed per distinct token, which keeps fuzzy lookups
+        # proportional to the vocabulary rather than the catalog size
+        tokens = sorted(name_postings.keys() | desc_postings.keys())
+        token_grams = {}
+        gram_counts = {}
+        for token in tokens:
+            grams = trigrams(token)
+            gram_counts[token] = len(grams)
+            for gram in grams:
+                token_grams.setdefault(gram, []).append(token)
+
+        # Swap everything in at once so concurrent readers never see a partial index
+        self._docs = docs
+        self._names = sorted(names)
+        self._name_postings = name_postings
+        self._desc_postings = desc_postings
+        self._tokens = tokens
+        self._token_grams = token_grams
+        self._gram_counts = gram_counts
+        self._built_at = time.monotonic()
+
+    def get(self, product_id):
+        """
+        Returns (name, description) for an indexed product, or None.
+        """
+        return self._docs.get(product_id)
+
+    def _expand(self, prefix):
+        tokens = self._tokens
+        start = bisect_left(tokens, prefix)
+        expanded = []
+        for i in range(start, min(start + MAX_PREFIX_EXPANSION, len(tokens))):
+            if not tokens[i].startswith(prefix):
+                break
+            if tokens[i] != prefix:
+                expanded.append(tokens[i])
+        return expanded
+
+    def _corrections(self, token):
+        """
+        Returns vocabulary tokens similar to a misspelled ``token`` with their
+        trigram (Dice) similarity.
+        """
+        query_grams = trigrams(token)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._token_grams.get(gram, ()))
+
+        corrections = []
+        for candidate, count in shared.items():
+            similarity = 2.0 * count / (len(query_grams) + self._gram_counts[candidate])
+            if similarity >= FUZZY_THRESHOLD:
+                corrections.append((candidate, similarity))
+        return corrections
+
+    def _match_token(self, token):
+        """
+        Returns {product_id: score} for a single query token.
+        """
+        expanded = self._expand(token)
+        empty = ()
+
+        # Apply the weakest matches first so stronger ones overwrite them
+        matched = dict.fromkeys(set().union(*(self._desc_postings.get(t, empty) for t in expanded)), DESC_PREFIX)
+        matched.update(dict.fromkeys(self._desc_postings.get(token, empty), DESC_TOKEN))
+        matched.update(dict.fromkeys(set().union(*(self._name_postings.get(t, empty) for t in expanded)), NAME_PREFIX))
+        matched.update(dict.fromkeys(self._name_postings.get(token, empty), NAME_TOKEN))
+
+        # Fall back to similarly spelled tokens only when nothing matched exactly
+        if not matched:
+            for candidate, similarity in sorted(self._corrections(token), key=lambda c: c[1]):
+                matched.update(dict.fromkeys(self._desc_postings.get(candidate, empty), DESC_TOKEN * similarity))
+                matched.update(dict.fromkeys(self._name_postings.get(candidate, empty), NAME_TOKEN * similarity))
+
+        return matched
+
+    def search(self, query, limit=10):
+        """
+        Returns up to ``limit`` matches as (product_id, name, description, score),
+        best first.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        # Every query token has to match for a product to stay in the results
+        scores = self._match_token(tokens[0])
+        for token in tokens[1:]:
+            if not scores:
+                break
+            matched = self._match_token(token)
+            scores = {pid: scores[pid] + matched[pid] for pid in scores.keys() & matched.keys()}
+
+        if not scores:
+            return []
+
+        # Names starting with the whole query rank first, found by bisecting the sorted names
+        query_lower = query.strip().lower()
+        names = self._names
+        for i in range(bisect_left(names, (query_lower,)), len(names)):
+            name, product_id = names[i]
+            if not name.startswith(query_lower):
+                break
+            if product_id in scores:
+                scores[product_id] += EXACT_NAME_BONUS if name == query_lower else NAME_PREFIX_BONUS
+
+        top = heapq.nlargest(limit, scores, key=scores.__getitem__)
+        top.sort(key=lambda pid: (-scores[pid], self._docs[pid][0]))
+        return [(pid, *self._docs[pid], round(scores[pid], 3)) for pid in top]
+
+    def _name_matches(self, token):
+        # Products with a name token equal to or starting with ``token``
+        empty = ()
+        return set(self._name_postings.get(token, empty)).union(
+            *(self._name_postings.get(t, empty) for t in self._expand(token)))
+
+    def resolve(self, text):
+        """
+        Returns the id of the product ``text`` designates without doubt, or
+        None: the product named exactly ``text``, or else the only product
+        whose name has every word of ``text`` as a word or word prefix.
+        Descriptions and misspellings are not considered; see suggest().
+        """
+        text_lower = text.strip().lower()
+        names = self._names
+        i = bisect_left(names, (text_lower,))
+        if i < len(names) and names[i][0] == text_lower:
+            return names[i][1]
+
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+        candidates = self._name_matches(tokens[0])
+        for token in tokens[1:]:
+            candidates &= self._name_matches(token)
+        return next(iter(candidates)) if len(candidates) == 1 else None
+
+    def suggest(self, text, limit=5):
+        """
+        Returns the names of the products best matching ``text``, typos included.
+        """
+        return [name for _, name, _, _ in self.search(text, limit)]
+
+# Shared by the web app and the bot
+product_index = ProductSearchIndex()
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+@event.listens_for(Product, 'after_delete')
+def _note_product_change(mapper, connection, target):
+    # Flushed but not committed yet, other sessions cannot see it
+    session = object_session(target)
+    if session is not None:
+        session.info['products_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    if session.info.pop('products_changed', False):
+        product_index.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def _invalidate_after_rollback(session):
+    # The index may have been rebuilt from the rolled back rows
+    if session.info.get('products_changed'):
+        product_index.invalidate()
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_product_changes(session, transaction):
+    # Kept through savepoint rollbacks, the outer transaction may still commit them
+    if transaction.parent is None:
+        session.info.pop('products_changed', None)
+
+def search_products(query, limit=10):
+    """
+    Searches the product catalog.
+
+    Args:
+        query (str): Free text matched against product names and descriptions
+        limit (int): Maximum number of results
+
+    Returns:
+        list: Tuples of (product_id, name, description, score), best first
+    """
+    product_index.ensure_fresh()
+    return product_index.search(query, limit)
@@ -0,0 +1,270 @@
+"""
+Opt-in profiling of single web requests and bot commands.
+
+Nothing is installed unless ``PROFILE_TOKEN`` is set. With it set:
+
+* a request carrying ``X-Profile: <token>`` or ``?_profile=<token>`` is run
+  under cProfile, and every SQL statement it executes is recorded with its
+  duration;
+* a bot administrator can run ``!profile`` to have their next commands
+  profiled the same way.
+
+Each profile is written to ``PROFILE_DIR`` (default ``profiles``) as a
+``.prof`` file, which ``python -m pstats`` and snakeviz can read, and a
+``.json`` summary. Only the newest ``PROFILE_KEEP`` profiles are kept. They
+are listed at ``/admin/profiles``, which asks for the same token.
+
+Only one profile runs at a time per process; a request asking for a second
+one runs unprofiled and gets ``X-Profile-Skipped``.
+
+A bot command profile is less precise. cProfile follows a thread, not a
+task, so the function statistics cover everything the event loop ran while
+the command was in progress: other users' commands and the gateway
+included. The SQL list, kept in a context variable, only holds the
+command's own statements. Statements run in other threads, such as the
+order write coalescer, are not in it.
+"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import request, session as http_session
+from sqlalchemy import event
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+
+# Bounds the size of one profile's summary
+MAX_SQL_STATEMENTS = 1000
+MAX_STATEMENT_LENGTH = 2000
+TOP_FUNCTIONS = 40
+
+_NAME_PATTERN = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9]{3}-[a-z]+-[A-Za-z0-9_.-]*$')
+
+# Python allows one active profiler per process
+_profiler_lock = threading.Lock()
+
+_current = ContextVar("profile", default=None)
+
+def enabled():
+    return bool(PROFILE_TOKEN)
+
+def token_matches(candidate):
+    """
+    Compares ``candidate`` to PROFILE_TOKEN in constant time.
+    """
+    return enabled() and bool(candidate) and hmac.compare_digest(candidate.encode(), PROFILE_TOKEN.encode())
+
+class Profile:
+    """
+    One profiled request or command.
+    """
+    def __init__(self, kind, label):
+        self.kind = kind
+        self.label = label
+        self.statements = []
+        self.dropped_statements = 0
+        self._profiler = cProfile.Profile()
+        self._token = None
+        self._started = None
+        self.duration = None
+
+    def start(self):
+        """
+        Starts profiling the current thread.
+
+        Returns:
+            bool: False if another profile is already running in this process
+        """
+        if not _profiler_lock.acquire(blocking=False):
+            return False
+
+        self._token = _current.set(self)
+        self._started = time.perf_counter()
+        self._profiler.enable()
+        return True
+
+    def finish(self):
+        """
+        Stops profiling without writing the result; see save().
+        """
+        try:
+            self._profiler.disable()
+            self.duration = time.perf_counter() - self._started
+            _current.reset(self._token)
+        finally:
+            _profiler_lock.release()
+
+    def save(self):
+        """
+        Writes a finished profile to PROFILE_DIR. Blocks on file I/O.
+
+        Returns:
+            str: The profile's name
+        """
+        return _write_profile(self, self.duration)
+
+    def stop(self):
+        """
+        Stops profiling and writes the result.
+
+        Returns:
+            str: The profile's name
+        """
+        self.finish()
+        return self.save()
+
+    def record_statement(self, statement, parameters, duration):
+        if len(self.statements) >= MAX_SQL_STATEMENTS:
+            self.dropped_statements += 1
+            return
+        self.statements.append({
+            'statement': statement[:MAX_STATEMENT_LENGTH],
+            'parameters': repr(parameters)[:200],
+            'ms': round(duration * 1000, 3),
+        })
+
+def _slug(label):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_')[:60]
+
+def _write_profile(profile, duration):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    now = time.time()
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+    name = f"{stamp}-{profile.kind}-{_slug(profile.label)}"
+
+    stats_text = io.StringIO()
+    stats = pstats.Stats(profile._profiler, stream=stats_text)
+    stats.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+    summary = {
+        'name': name,
+        'kind': profile.kind,
+        'label': profile.label,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now)),
+        'duration_ms': round(duration * 1000, 3),
+        'sql_count': len(profile.statements) + profile.dropped_statements,
+        'sql_ms': round(sum(s['ms'] for s in profile.statements), 3),
+        'sql': profile.statements,
+        'stats': stats_text.getvalue(),
+    }
+    with open(os.path.join(PROFILE_DIR, name + '.json'), 'w') as f:
+        json.dump(summary, f)
+
+    _rotate()
+    return name
+
+def _rotate():
+    # Names start with a UTC timestamp, so they sort oldest first
+    names = list_profiles()
+    for name in names[PROFILE_KEEP:]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name + suffix))
+            except FileNotFoundError:
+                pass
+
+def list_profiles():
+    """
+    Returns the names of the stored profiles, newest first.
+    """
+    try:
+        files = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((f[:-5] for f in files if f.endswith('.json')), reverse=True)
+
+def profile_path(name, suffix):
+    """
+    Returns the path of a stored profile file, or None for names that are not
+    profiles (so a request cannot escape the directory).
+    """
+    if not _NAME_PATTERN.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name + suffix)
+    return path if os.path.exists(path) else None
+
+def load_profile(name):
+    path = profile_path(name, '.json')
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def request_is_admin():
+    """
+    Tells whether the current request may see the stored profiles. A valid
+    token (``X-Profile`` header or ``?token=``) is remembered in the session.
+    """
+    if not enabled():
+        return False
+    if token_matches(request.headers.get('X-Profile') or request.args.get('token')):
+        http_session['profile_admin'] = True
+    return http_session.get('profile_admin', False)
+
+def install_sql_capture(engine):
+    """
+    Records statements run on ``engine`` into the active profile. Does
+    nothing unless profiling is enabled.
+    """
+    if not enabled():
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        profile = _current.get()
+        if profile is not None and conn.info.get('profile_started'):
+            started = conn.info['profile_started'].pop()
+            profile.record_statement(statement, parameters, time.perf_counter() - started)
+
+def init_profiling(app):
+    """
+    Lets requests carrying the profile token be profiled.
+    """
+    if not enabled():
+        return
+
+    # The profile is kept on the request rather than on g, which the
+    # sub-requests of a batch share with their parent
+    @app.before_request
+    def start_request_profile():
+        candidate = request.headers.get('X-Profile') or request.args.get('_profile')
+        if not token_matches(candidate):
+            return
+
+        profile = Profile('request', f"{request.method} {request.path}")
+        if profile.start():
+            request.environ['profiling.profile'] = profile
+        else:
+            request.environ['profiling.skipped'] = True
+
+    @app.after_request
+    def finish_request_profile(response):
+        profile = request.environ.pop('profiling.profile', None)
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile.stop()
+        elif request.environ.pop('profiling.skipped', False):
+            response.headers['X-Profile-Skipped'] = 'another profile is running'
+        return response
+
+    @app.teardown_request
+    def abandon_request_profile(exc):
+        # after_request does not run when the response could not be built
+        profile = request.environ.pop('profiling.profile', None)
+        if profile is not None:
+            profile.stop()
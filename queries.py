@@ -0,0 +1,100 @@
+"""
+Prebuilt statements for the hot lookups of the data layer.
+
+``Model.query.filter_by(...)`` builds a new Query on every call, and
+SQLAlchemy then walks it to compute its cache key before it can reuse the
+compiled SQL. The statements below are built once at import time with bound
+parameters in place of the values: their cache key is computed once and
+memoised, so a call only binds parameters and runs the cached SQL. On
+Postgres, psycopg 3 (the driver db_engine.py selects) sees the same SQL text
+on every call and prepares it server-side after ``PG_PREPARE_THRESHOLD``
+executions on a connection.
+
+Each function returns ORM objects like the query it replaces and works in
+the caller's session, so replica routing and the identity map behave as
+before. ``python benchmarks/query_statements.py`` compares both per call.
+"""
+from sqlalchemy import bindparam, select, true
+
+from models import Product, Inventory, OrderPeriod, Order
+
+_current_period = (select(OrderPeriod)
+                   .where(OrderPeriod.guild_id == bindparam('guild_id'), OrderPeriod.is_open == true())
+                   .limit(1))
+
+_period = (select(OrderPeriod)
+           .where(OrderPeriod.guild_id == bindparam('guild_id'), OrderPeriod.id == bindparam('period_id'))
+           .limit(1))
+
+_period_by_month = (select(OrderPeriod)
+                    .where(OrderPeriod.guild_id == bindparam('guild_id'),
+                           OrderPeriod.month == bindparam('month'),
+                           OrderPeriod.year == bindparam('year'))
+                    .limit(1))
+
+_period_orders = select(Order).where(Order.guild_id == bindparam('guild_id'),
+                                     Order.order_period_id == bindparam('period_id'))
+
+_order = (select(Order)
+          .where(Order.guild_id == bindparam('guild_id'), Order.id == bindparam('order_id'))
+          .limit(1))
+
+_user_order = (select(Order)
+               .where(Order.user_id == bindparam('user_id'), Order.order_period_id == bindparam('period_id'))
+               .limit(1))
+
+_inventory = select(Inventory).where(Inventory.guild_id == bindparam('guild_id'))
+
+_inventory_item = (select(Inventory)
+                   .where(Inventory.guild_id == bindparam('guild_id'),
+                          Inventory.product_id == bindparam('product_id'))
+                   .limit(1))
+
+_product_by_name = select(Product).where(Product.name == bindparam('name')).limit(1)
+
+def _first(statement, **params):
+    from app import db
+    return db.session.execute(statement, params).scalars().first()
+
+def _all(statement, **params):
+    from app import db
+    return db.session.execute(statement, params).scalars().all()
+
+def current_period(guild_id):
+    """
+    Returns the guild's open order period, or None.
+    """
+    return _first(_current_period, guild_id=guild_id)
+
+def period(guild_id, period_id):
+    return _first(_period, guild_id=guild_id, period_id=period_id)
+
+def period_by_month(guild_id, month, year):
+    return _first(_period_by_month, guild_id=guild_id, month=month, year=year)
+
+def period_orders(guild_id, period_id):
+    """
+    Returns every order of a period.
+    """
+    return _all(_period_orders, guild_id=guild_id, period_id=period_id)
+
+def order(guild_id, order_id):
+    return _first(_order, guild_id=guild_id, order_id=order_id)
+
+def user_order(user_id, period_id):
+    """
+    Returns a user's order in a period, or None. A user has at most one.
+    """
+    return _first(_user_order, user_id=user_id, period_id=period_id)
+
+def inventory(guild_id):
+    """
+    Returns the guild's inventory rows.
+    """
+    return _all(_inventory, guild_id=guild_id)
+
+def inventory_item(guild_id, product_id):
+    return _first(_inventory_item, guild_id=guild_id, product_id=product_id)
+
+def product_by_name(name):
+    return _first(_product_by_name, name=name)
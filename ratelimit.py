@@ -0,0 +1,348 @@
+"""
+Rate limiting and backpressure for the write endpoints.
+
+Each write view is tagged with a limit name (``@rate_limited('orders')``).
+The HTML form views share the more generous ``forms`` limit instead of the
+API's: they are posted by people clicking through the pages, and a refusal
+is flashed on the page they are sent back to rather than returned as a bare
+error.
+Every client gets a token bucket per limit name: ``RATE_LIMIT_<NAME>`` sets
+its size and refill period as ``requests/seconds`` (e.g. ``30/60``), and a
+client that runs out gets a 429 with ``Retry-After``. Clients are told apart
+by their address, taken from ``X-Forwarded-For`` when
+``RATE_LIMIT_TRUST_PROXY=1``.
+
+Buckets live in process memory by default, so each gunicorn worker counts
+on its own. Pointing ``RATE_LIMIT_STORAGE`` at a SQLite file shares them
+between every process on the host.
+
+Independently of the buckets, at most ``WRITE_CONCURRENCY`` write requests
+per process run at once. Further writes queue for up to
+``WRITE_QUEUE_TIMEOUT`` seconds and are then shed with a 503, so a burst
+cannot take every database connection away from the bot and the pages.
+
+``RATE_LIMIT_ENABLED=0`` turns both off.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import request, jsonify, make_response, flash, redirect, url_for
+
+DEFAULT_LIMITS = {
+    'default': '60/60',
+    'orders': '30/60',
+    'order_periods': '10/60',
+    'inventory': '120/60',
+    'products': '30/60',
+    'jobs': '10/60',
+    'forms': '120/60',
+}
+
+# Memory buckets are swept of idle clients once there are this many
+MAX_MEMORY_BUCKETS = 10000
+
+def enabled():
+    return os.environ.get("RATE_LIMIT_ENABLED", "1") != "0"
+
+def parse_rate(value):
+    """
+    Parses ``requests/seconds`` into a bucket size and a refill rate per second.
+    """
+    requests, _, seconds = value.partition('/')
+    capacity = int(requests)
+    seconds = float(seconds or 60)
+    if capacity < 1 or seconds <= 0:
+        raise ValueError(f"Invalid rate limit: {value}")
+    return capacity, capacity / seconds
+
+def limit_for(name):
+    """
+    Returns (capacity, refill rate per second) for a limit name.
+    """
+    default = DEFAULT_LIMITS.get(name, DEFAULT_LIMITS['default'])
+    return parse_rate(os.environ.get(f"RATE_LIMIT_{name.upper()}", default))
+
+def client_key():
+    """
+    Identifies the client of the current request.
+    """
+    if os.environ.get("RATE_LIMIT_TRUST_PROXY") == "1":
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+def _refill(tokens, updated, now, capacity, rate):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+class MemoryBuckets:
+    """
+    Token buckets held by this process.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """
+        Takes a token from ``key``'s bucket.
+
+        Returns:
+            bool: Whether a token was available
+            float: Seconds until one will be, if not
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = _refill(tokens, updated, now, capacity, rate)
+
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                allowed, retry_after = True, 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (1 - tokens) / rate
+
+            if len(self._buckets) > MAX_MEMORY_BUCKETS:
+                self._sweep(now, capacity, rate)
+
+        return allowed, retry_after
+
+    def _sweep(self, now, capacity, rate):
+        # A bucket that has refilled completely is the same as no bucket
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if _refill(tokens, updated, now, capacity, rate) >= capacity:
+                del self._buckets[key]
+
+class SQLiteBuckets:
+    """
+    Token buckets in a SQLite file, shared by every process that opens it.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit mode; transactions are opened explicitly below
+            connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, rate):
+        # Wall clock, since the buckets are compared across processes
+        now = time.time()
+        connection = self._connection()
+
+        # BEGIN IMMEDIATE takes the write lock up front, so the read and the
+        # update below cannot interleave with another process
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = _refill(tokens, updated, now, capacity, rate)
+
+            if tokens >= 1:
+                allowed, retry_after, tokens = True, 0.0, tokens - 1
+            else:
+                allowed, retry_after = False, (1 - tokens) / rate
+
+            connection.execute("INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)",
+                               (key, tokens, now))
+
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                # Buckets idle for an hour have long refilled
+                connection.execute("DELETE FROM bucket WHERE updated < ?", (now - 3600,))
+
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return allowed, retry_after
+
+class WriteGate:
+    """
+    Caps how many write requests run at once in this process.
+    """
+    def __init__(self, limit, queue_timeout):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self.waited = 0
+
+    def enter(self):
+        """
+        Waits up to ``queue_timeout`` seconds for a slot.
+
+        Returns:
+            bool: Whether a slot was obtained; if so, call leave() afterwards
+        """
+        if self._slots.acquire(blocking=False):
+            waited = False
+        else:
+            with self._lock:
+                self.queued += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.queued -= 1
+            if not acquired:
+                with self._lock:
+                    self.shed += 1
+                return False
+            waited = True
+
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if waited:
+                self.waited += 1
+        return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'queue_timeout': self.queue_timeout,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'queued': self.queued,
+                'waited': self.waited,
+                'shed': self.shed,
+            }
+
+class RateLimiter:
+    """
+    Per-client token buckets plus the write concurrency gate.
+    """
+    def __init__(self, storage=None, concurrency=8, queue_timeout=2.0):
+        self.buckets = SQLiteBuckets(storage) if storage else MemoryBuckets()
+        self.gate = WriteGate(concurrency, queue_timeout)
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def _count(self, name, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(name, {'allowed': 0, 'limited': 0, 'errors': 0})
+            counts[outcome] += 1
+
+    def hit(self, name, client):
+        """
+        Spends one of ``client``'s requests under limit ``name``.
+
+        Returns:
+            bool: Whether the request may proceed
+            float: Seconds the client should wait, if not
+        """
+        capacity, rate = limit_for(name)
+        try:
+            allowed, retry_after = self.buckets.take(f"{name}:{client}", capacity, rate)
+        except sqlite3.Error:
+            # A broken shared store must not take the write endpoints down with it
+            self._count(name, 'errors')
+            return True, 0.0
+
+        self._count(name, 'allowed' if allowed else 'limited')
+        return allowed, retry_after
+
+    def metrics(self):
+        """
+        Returns this process's counters and the configured limits.
+        """
+        with self._lock:
+            counts = {name: dict(c) for name, c in self._counts.items()}
+
+        limits = {}
+        for name in sorted(set(DEFAULT_LIMITS) | set(counts)):
+            capacity, rate = limit_for(name)
+            limits[name] = {
+                'capacity': capacity,
+                'per_seconds': round(capacity / rate, 3),
+                **counts.get(name, {'allowed': 0, 'limited': 0, 'errors': 0})
+            }
+
+        return {
+            'enabled': enabled(),
+            'backend': self.buckets.name,
+            'pid': os.getpid(),
+            'limits': limits,
+            'write_concurrency': self.gate.metrics(),
+        }
+
+limiter = RateLimiter(
+    storage=os.environ.get("RATE_LIMIT_STORAGE") or None,
+    concurrency=int(os.environ.get("WRITE_CONCURRENCY", "8")),
+    queue_timeout=float(os.environ.get("WRITE_QUEUE_TIMEOUT", "2")),
+)
+
+def _rejected(message, status, retry_after):
+    if request.path.startswith('/api/'):
+        response = jsonify({'error': message, 'retry_after': retry_after})
+    else:
+        response = make_response(message)
+        response.mimetype = 'text/plain'
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limited(name, redirect_to=None):
+    """
+    Applies limit ``name`` and the write concurrency cap to a view.
+
+    Args:
+        name (str): Limit name, see DEFAULT_LIMITS
+        redirect_to (str, optional): Endpoint a refused form post is redirected
+            to, with the reason flashed, instead of getting an error response
+    """
+    def reject(message, status, retry_after):
+        if redirect_to:
+            flash(f"{message} (retry in {retry_after}s)", 'danger')
+            return redirect(url_for(redirect_to))
+        return _rejected(message, status, retry_after)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return view(*args, **kwargs)
+
+            allowed, retry_after = limiter.hit(name, client_key())
+            if not allowed:
+                return reject('Too many requests, please slow down', 429, max(1, math.ceil(retry_after)))
+
+            if not limiter.gate.enter():
+                return reject('The server is busy, please retry shortly', 503, 1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limiter.gate.leave()
+        return wrapper
+    return decorator
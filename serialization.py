@@ -0,0 +1,136 @@
+"""
+Response encoding for the API: JSON by default, MessagePack on request.
+
+Every API view answers with ``jsonify``, which goes through the app's JSON
+provider. ``NegotiatingJSONProvider`` replaces it and picks the encoding
+from the ``Accept`` header: clients that send ``Accept: application/msgpack``
+(or ``application/x-msgpack``) and do not prefer JSON get MessagePack, and
+everyone else gets the same JSON as before.
+
+MessagePack responses are also column-oriented: every list of objects with
+the same keys is sent as one array per key instead of one map per row, e.g. ::
+
+    [{"product_id": 1, "quantity": 3}, {"product_id": 2, "quantity": 5}]
+
+becomes ::
+
+    {"length": 2, "columns": {"product_id": [1, 2], "quantity": [3, 5]}}
+
+A field holding a list of objects in every row (like an order's items) is
+flattened into one nested table, with ``offsets`` giving where each row's
+entries start: row ``i`` owns entries ``offsets[i]:offsets[i + 1]``.
+``from_columns`` turns a decoded payload back into rows.
+"""
+import msgpack
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+def wants_msgpack():
+    """
+    Tells whether the current request prefers MessagePack over JSON.
+    """
+    if not has_request_context():
+        return False
+    accept = request.accept_mimetypes
+    best = max(accept[mimetype] for mimetype in MSGPACK_MIMETYPES)
+    # On a tie (e.g. */*) JSON wins, so existing clients see no change
+    return best > 0 and best > accept['application/json']
+
+def _is_table(rows):
+    # Only lists of objects sharing the same keys, so that decoding is exact
+    if not rows or not isinstance(rows[0], dict):
+        return False
+    keys = rows[0].keys()
+    return all(isinstance(row, dict) and row.keys() == keys for row in rows)
+
+def _convert(value):
+    if isinstance(value, dict):
+        return {key: _convert(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if _is_table(value):
+            return to_columns(value)
+        return [_convert(item) for item in value]
+    return value
+
+def _column(values):
+    # Lists of objects in every row become one nested table
+    if all(isinstance(v, list) for v in values):
+        flat = [entry for v in values for entry in v]
+        if _is_table(flat):
+            offsets = [0]
+            for v in values:
+                offsets.append(offsets[-1] + len(v))
+            nested = to_columns(flat)
+            nested['offsets'] = offsets
+            return nested
+
+    # Scalars, the common case, are kept as they are
+    if any(isinstance(v, (dict, list)) for v in values):
+        return [_convert(v) for v in values]
+    return values
+
+def to_columns(rows):
+    """
+    Converts a list of dicts with the same keys into parallel arrays, one per key.
+    """
+    return {
+        'length': len(rows),
+        'columns': {key: _column([row[key] for row in rows]) for key in rows[0]},
+    }
+
+def _is_columns(value):
+    return isinstance(value, dict) and set(value) in ({'length', 'columns'}, {'length', 'columns', 'offsets'})
+
+def _rows(table):
+    columns = {}
+    for key, column in table['columns'].items():
+        if _is_columns(column):
+            entries = _rows(column)
+            offsets = column['offsets']
+            columns[key] = [entries[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        else:
+            columns[key] = [from_columns(value) for value in column]
+    if not columns:
+        return [{} for _ in range(table['length'])]
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+def from_columns(value):
+    """
+    Reverses to_columns on a decoded payload, for Python consumers and tests.
+    """
+    if _is_columns(value):
+        return _rows(value)
+    if isinstance(value, dict):
+        return {key: from_columns(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_columns(item) for item in value]
+    return value
+
+def packb(obj, default=DefaultJSONProvider.default):
+    """
+    Encodes a JSON-serialisable object as column-oriented MessagePack.
+    """
+    return msgpack.packb(_convert(obj), default=default, use_bin_type=True)
+
+def unpackb(data):
+    """
+    Decodes a MessagePack response body back into the JSON shape.
+    """
+    return from_columns(msgpack.unpackb(data, raw=False))
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider whose responses switch to MessagePack when the client asks for it.
+    """
+    def response(self, *args, **kwargs):
+        if not wants_msgpack():
+            response = super().response(*args, **kwargs)
+        else:
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(packb(obj, default=self.default),
+                                                mimetype=MSGPACK_MIMETYPES[0])
+        # Caches must keep the two encodings apart
+        response.vary.add('Accept')
+        return response
@@ -52,8 +52,296 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
     });
+    
+    // Subscribe to server-pushed changes on pages that opt in
+    startLiveUpdates();
 });
 
+// Live updates
+//
+// Pages rendered with a live cursor open an EventSource on /api/events/stream
+// and patch themselves from each change event instead of being reloaded.
+// The stream is closed while the tab is hidden and resumed from the last
+// event seen once it is visible again.
+
+const LIVE_ACTIVITY_LIMIT = 20;
+
+function startLiveUpdates() {
+    const body = document.body;
+    if (!body.dataset.liveUrl || !window.EventSource) {
+        return;
+    }
+    
+    let cursor = parseInt(body.dataset.liveCursor) || 0;
+    let source = null;
+    
+    function connect() {
+        source = new EventSource(`${body.dataset.liveUrl}?after=${cursor}`);
+        source.onopen = () => setLiveStatus('live');
+        source.onerror = () => setLiveStatus('reconnecting');
+        
+        LIVE_EVENT_KINDS.forEach(kind => {
+            source.addEventListener(kind, event => {
+                const change = JSON.parse(event.data);
+                if (change.id <= cursor) {
+                    return;
+                }
+                cursor = change.id;
+                applyChange(change);
+            });
+        });
+    }
+    
+    document.addEventListener('visibilitychange', () => {
+        if (document.hidden && source) {
+            source.close();
+            source = null;
+            setLiveStatus('paused');
+        } else if (!document.hidden && !source) {
+            connect();
+        }
+    });
+    
+    connect();
+}
+
+const LIVE_EVENT_KINDS = [
+    'order.saved', 'order.deleted', 'order.delivery',
+    'inventory.updated', 'inventory.counted',
+    'period.created', 'period.updated',
+    'product.created', 'product.updated', 'product.deleted'
+];
+
+function setLiveStatus(status) {
+    const badge = document.getElementById('liveStatus');
+    if (badge) {
+        badge.textContent = status;
+    }
+}
+
+function applyChange(change) {
+    patchActivityFeed(change);
+    patchOrders(change);
+    patchInventory(change);
+}
+
+function flashRow(row) {
+    row.classList.remove('live-updated');
+    // Force a reflow so the animation restarts on repeated updates
+    void row.offsetWidth;
+    row.classList.add('live-updated');
+}
+
+// Home page: recent activity feed
+
+function describeChange(change) {
+    const data = change.data;
+    switch (change.kind) {
+        case 'order.saved':
+            return `${data.user_name} saved an order (${data.items.length} products)`;
+        case 'order.deleted':
+            return `Order #${data.order_id} was deleted`;
+        case 'order.delivery':
+            return `Order #${data.order_id} marked as ${data.is_delivered ? 'delivered' : 'not delivered'}`;
+        case 'inventory.updated':
+            return `Stock of product #${data.product_id} set to ${data.quantity}`;
+        case 'inventory.counted':
+            return `Stock count saved (${data.items.length} products changed)`;
+        case 'period.created':
+            return `Order period ${data.month}/${data.year} created`;
+        case 'period.updated':
+            return `Order period ${data.month}/${data.year} ${data.is_open ? 'opened' : 'closed'}`;
+        case 'product.created':
+            return `Product "${data.name}" added`;
+        case 'product.updated':
+            return `Product "${data.name}" updated`;
+        case 'product.deleted':
+            return `Product "${data.name}" deleted`;
+        default:
+            return change.kind;
+    }
+}
+
+function patchActivityFeed(change) {
+    const feed = document.getElementById('liveActivity');
+    if (!feed) {
+        return;
+    }
+    
+    const placeholder = feed.querySelector('[data-placeholder]');
+    if (placeholder) {
+        placeholder.remove();
+    }
+    
+    const item = document.createElement('li');
+    item.className = 'list-group-item live-updated';
+    
+    const text = document.createElement('div');
+    text.textContent = describeChange(change);
+    const time = document.createElement('small');
+    time.className = 'text-muted';
+    time.textContent = new Date(change.created_at).toLocaleString();
+    
+    item.append(text, time);
+    feed.prepend(item);
+    
+    while (feed.children.length > LIVE_ACTIVITY_LIMIT) {
+        feed.lastElementChild.remove();
+    }
+}
+
+// Orders page
+
+function patchOrders(change) {
+    const container = document.getElementById('liveOrders');
+    if (!container) {
+        return;
+    }
+    
+    if (change.kind.startsWith('product.')) {
+        // Product names appear in every row and in the order form
+        location.reload();
+        return;
+    }
+    
+    if (change.order_period_id !== parseInt(container.dataset.periodId)) {
+        return;
+    }
+    
+    if (change.kind === 'period.updated') {
+        if (change.data.is_open !== (container.dataset.periodOpen === 'true')) {
+            // Opening or closing changes which actions are available
+            location.reload();
+        }
+        return;
+    }
+    
+    const data = change.data;
+    const row = container.querySelector(`tr[data-order-id="${data.order_id}"]`);
+    
+    if (change.kind === 'order.deleted') {
+        if (row) {
+            row.remove();
+        }
+    } else if (change.kind === 'order.delivery') {
+        if (row) {
+            setOrderDelivered(row, data.is_delivered);
+            flashRow(row);
+        }
+    } else if (change.kind === 'order.saved') {
+        const target = row || createOrderRow(container, data.order_id);
+        if (!target) {
+            // First order of the period: the table is not on the page yet
+            location.reload();
+            return;
+        }
+        fillOrderRow(target, data);
+        flashRow(target);
+    }
+}
+
+function createOrderRow(container, orderId) {
+    const template = document.getElementById('orderRowTemplate');
+    const tbody = container.querySelector('tbody');
+    if (!template || !tbody) {
+        return null;
+    }
+    
+    const row = template.content.querySelector('tr').cloneNode(true);
+    row.dataset.orderId = orderId;
+    // The template is rendered for order 0; point its forms at the new order
+    row.querySelectorAll('form').forEach(form => {
+        form.action = form.getAttribute('action').replace('/0/', `/${orderId}/`);
+    });
+    
+    tbody.appendChild(row);
+    return row;
+}
+
+function fillOrderRow(row, data) {
+    const productNames = JSON.parse(document.getElementById('liveProductNames').textContent);
+    
+    row.dataset.userId = data.user_id;
+    row.dataset.userName = data.user_name;
+    row.querySelector('[data-field="user_name"]').textContent = data.user_name;
+    
+    const items = row.querySelector('[data-field="items"]');
+    items.replaceChildren(...data.items.map(([productId, quantity]) => {
+        const item = document.createElement('li');
+        item.textContent = `${productNames[productId] || `Product #${productId}`}: ${quantity}`;
+        return item;
+    }));
+    
+    setOrderDelivered(row, data.is_delivered);
+}
+
+function setOrderDelivered(row, isDelivered) {
+    const status = row.querySelector('[data-field="status"]');
+    const badge = document.createElement('span');
+    badge.className = isDelivered ? 'badge bg-success' : 'badge bg-warning text-dark';
+    badge.textContent = isDelivered ? 'Delivered' : 'Not Delivered';
+    status.replaceChildren(badge);
+    
+    const button = row.querySelector('[data-field="delivery-button"]');
+    button.className = `btn btn-sm ${isDelivered ? 'btn-outline-warning' : 'btn-outline-success'}`;
+    const icon = document.createElement('i');
+    icon.className = `fas ${isDelivered ? 'fa-times' : 'fa-check'}`;
+    button.replaceChildren(icon, isDelivered ? ' Mark as Not Delivered' : ' Mark as Delivered');
+}
+
+// Inventory page
+
+function patchInventory(change) {
+    const container = document.getElementById('liveInventory');
+    if (!container) {
+        return;
+    }
+    
+    if (change.kind.startsWith('product.')) {
+        location.reload();
+        return;
+    }
+    
+    let levels;
+    if (change.kind === 'inventory.updated') {
+        levels = [change.data];
+    } else if (change.kind === 'inventory.counted') {
+        levels = change.data.items;
+    } else {
+        return;
+    }
+    
+    const rows = levels.map(level => container.querySelector(`tr[data-inventory-product-id="${level.product_id}"]`));
+    if (rows.includes(null)) {
+        // A product entered the inventory for the first time
+        location.reload();
+        return;
+    }
+    
+    levels.forEach((level, index) => {
+        const row = rows[index];
+        row.dataset.quantity = level.quantity;
+        row.querySelector('[data-field="quantity"]').textContent = level.quantity;
+        flashRow(row);
+        patchStockGrid(level);
+    });
+}
+
+function patchStockGrid(level) {
+    const input = document.querySelector(`#stockGrid input[data-product-id="${level.product_id}"]`);
+    if (!input) {
+        return;
+    }
+    
+    // Cells being edited keep the user's value
+    if (input.value === input.dataset.original) {
+        input.value = level.quantity;
+    }
+    input.dataset.original = level.quantity;
+    // Lets the grid recount its unsaved cells
+    input.dispatchEvent(new Event('input'));
+}
+
 // Custom utility to simplify jQuery-like selector contains functionality
 HTMLCollection.prototype.forEach = Array.prototype.forEach;
 NodeList.prototype.forEach = Array.prototype.forEach;
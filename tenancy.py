@@ -0,0 +1,77 @@
+"""
+Guild (tenant) scoping.
+
+Order periods, orders and inventory belong to a Discord guild, and every
+query on them filters by the guild first. The guild in effect is resolved
+in this order:
+
+1. an explicit ``with use_guild(...)`` block (the bot wraps each command in
+   the guild it was sent from);
+2. in a web request, ``?guild_id=`` (remembered in the session for later
+   pages) or the ``X-Guild-ID`` header;
+3. ``DEFAULT_GUILD_ID``, which also serves direct messages to the bot and
+   data created before guilds existed.
+
+The product catalog is shared by all guilds.
+"""
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import has_request_context, request, session as http_session
+
+DEFAULT_GUILD_ID = int(os.environ.get("DEFAULT_GUILD_ID", "0"))
+
+_guild_id = ContextVar("guild_id", default=None)
+
+@contextmanager
+def use_guild(guild_id):
+    """
+    Scopes queries in this block to ``guild_id``.
+    """
+    token = _guild_id.set(guild_id)
+    try:
+        yield
+    finally:
+        _guild_id.reset(token)
+
+def guild_of(ctx):
+    """
+    Returns the guild id for a Discord command context, or the default guild
+    for direct messages.
+    """
+    guild = getattr(ctx, 'guild', None)
+    return guild.id if guild is not None else DEFAULT_GUILD_ID
+
+def remember_request_guild():
+    """
+    Stores ``?guild_id=`` in the session so that links between pages keep it.
+    """
+    guild_id = request.args.get('guild_id', type=int)
+    if guild_id is not None:
+        http_session['guild_id'] = guild_id
+
+def current_guild_id():
+    """
+    Returns the id of the guild in effect.
+    """
+    guild_id = _guild_id.get()
+    if guild_id is not None:
+        return guild_id
+
+    if has_request_context():
+        guild_id = request.args.get('guild_id', type=int)
+        if guild_id is None:
+            guild_id = request.headers.get('X-Guild-ID', type=int)
+        if guild_id is None:
+            guild_id = http_session.get('guild_id')
+        if guild_id is not None:
+            return guild_id
+
+    return DEFAULT_GUILD_ID
+
+def resolve_guild(guild_id=None):
+    """
+    Returns ``guild_id`` if given, otherwise the guild currently in effect.
+    """
+    return current_guild_id() if guild_id is None else guild_id
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The app builds its engine on import, so the database is chosen before that
+_database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{_database.name}")
+
+# Imported before any other module of the app, which all import it
+import app as application  # noqa: E402
+
+@pytest.fixture
+def app():
+    return application.app
+
+@pytest.fixture
+def db(app):
+    db = application.db
+    with app.app_context():
+        yield db
+        db.session.remove()
@@ -0,0 +1,30 @@
+import numpy as np
+
+from allocation import solve
+
+def allocate(demand, product_ids, stock, policy, cap=None):
+    return solve(np.array(demand), np.array(product_ids), stock, policy, cap).tolist()
+
+def test_proportional_allocates_exactly_the_supply():
+    allocated = allocate([7, 5, 3, 9], [1, 1, 1, 1], {1: 10}, 'proportional')
+
+    assert sum(allocated) == 10
+    assert all(0 <= a <= d for a, d in zip(allocated, [7, 5, 3, 9]))
+
+def test_proportional_ties_go_to_earlier_orders():
+    assert allocate([1, 1, 1], [1, 1, 1], {1: 2}, 'proportional') == [1, 1, 0]
+    assert allocate([2, 2, 2, 2], [1, 1, 1, 1], {1: 5}, 'proportional') == [2, 1, 1, 1]
+
+def test_products_that_fit_in_stock_are_allocated_in_full():
+    for policy, cap in (('proportional', None), ('first_come', None), ('capped', 2)):
+        assert allocate([4, 3], [1, 1], {1: 10}, policy, cap) == [4, 3]
+
+def test_first_come_exhausts_stock_in_arrival_order():
+    allocated = allocate([4, 4, 4, 2], [1, 2, 1, 1], {1: 6, 2: 1}, 'first_come')
+
+    assert allocated == [4, 1, 2, 0]
+
+def test_capped_caps_short_products_only():
+    allocated = allocate([10, 2, 10, 3], [1, 1, 2, 2], {1: 6, 2: 20}, 'capped', cap=4)
+
+    assert allocated == [4, 2, 10, 3]
@@ -0,0 +1,40 @@
+from events import record_event, get_events_after, latest_event_id
+
+def test_event_committed_last_gets_the_higher_id(app, db):
+    cursor = latest_event_id()
+    db.session.remove()
+
+    # Recorded first, committed last
+    with app.app_context():
+        record_event('test.first')
+        db.session.flush()
+
+        with app.app_context():
+            record_event('test.second')
+            db.session.commit()
+            seen = get_events_after(cursor)
+            db.session.remove()
+
+        db.session.commit()
+
+    assert [e['kind'] for e in seen] == ['test.second']
+    # A consumer that already moved its cursor past 'test.second' still gets 'test.first'
+    later = get_events_after(seen[-1]['id'])
+    assert [e['kind'] for e in later] == ['test.first']
+
+def test_rolled_back_events_are_not_inserted(db):
+    cursor = latest_event_id()
+    record_event('test.rolled_back')
+    db.session.rollback()
+    db.session.commit()
+
+    assert get_events_after(cursor) == []
+
+def test_savepoint_rollback_keeps_earlier_events(db):
+    cursor = latest_event_id()
+    record_event('test.kept')
+    with db.session.begin_nested() as savepoint:
+        savepoint.rollback()
+    db.session.commit()
+
+    assert [e['kind'] for e in get_events_after(cursor)] == ['test.kept']
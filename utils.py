@@ -1,49 +1,200 @@
+import base64
+from datetime import datetime
 from models import Product, Inventory, OrderPeriod, Order, OrderItem
-from sqlalchemy import desc
+from flask import g, has_app_context
+from sqlalchemy import desc, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+from events import record_event, order_payload, period_payload
+from inventory_ledger import MOVEMENT_KINDS, record_movement, set_stock, set_stock_levels, checkpoint_inventory
+from tenancy import resolve_guild
+import queries
 
-def get_current_inventory():
+# Every function below works within one guild: the one passed as guild_id, or
+# the guild currently in effect (see tenancy.py).
+
+def get_current_inventory(guild_id=None):
     """
     Returns the current inventory for all products.
     """
-    return Inventory.query.all()
+    return queries.inventory(resolve_guild(guild_id))
 
-def get_current_order_period():
+def get_current_order_period(guild_id=None):
     """
     Returns the currently open order period, or None if no period is open.
+    
+    The answer is cached for the rest of the app context (one request, a
+    batch of sub-requests or one bot command) until a period is opened or
+    closed through this module.
     """
-    return OrderPeriod.query.filter_by(is_open=True).first()
+    guild_id = resolve_guild(guild_id)
+    
+    if not has_app_context():
+        return queries.current_period(guild_id)
+    
+    cache = g.setdefault('current_periods', {})
+    if guild_id not in cache:
+        cache[guild_id] = queries.current_period(guild_id)
+    return cache[guild_id]
+
+def _forget_current_periods():
+    if has_app_context():
+        g.pop('current_periods', None)
 
-def get_orders_for_period(period_id):
+def get_order_period(period_id, guild_id=None):
+    """
+    Returns an order period of the guild, or None.
+    """
+    return queries.period(resolve_guild(guild_id), period_id)
+
+def get_order_period_by_month(month, year, guild_id=None):
+    """
+    Returns the guild's order period for a month, or None.
+    """
+    return queries.period_by_month(resolve_guild(guild_id), month, year)
+
+def get_orders_for_period(period_id, guild_id=None):
     """
     Returns all orders for a specific order period.
     """
-    return Order.query.filter_by(order_period_id=period_id).all()
+    return queries.period_orders(resolve_guild(guild_id), period_id)
 
-def add_order(user_id, user_name, items):
+def get_order(order_id, guild_id=None):
     """
-    Adds or updates an order for the current order period.
+    Returns an order of the guild, or None.
+    """
+    return queries.order(resolve_guild(guild_id), order_id)
+
+def encode_order_cursor(order):
+    """
+    Returns an opaque pagination cursor pointing just after ``order``.
+    """
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_order_cursor(cursor):
+    """
+    Reads a cursor made by encode_order_cursor.
+    
+    Returns:
+        tuple: (created_at, order id) of the last order already seen
+        str: Error message if any
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.split('|')
+        return (datetime.fromisoformat(created_at), int(order_id)), None
+    except (ValueError, UnicodeDecodeError):
+        return None, "Invalid cursor"
+
+def get_user_orders(user_id, guild_id=None, limit=20, after=None):
+    """
+    Returns a page of a user's orders across every period, newest first.
+    
+    Pages are read by keyset on the (user_id, guild_id, created_at, id) index,
+    so each one costs the same however long the history and however many
+    other orders there are. Items and their products are loaded up front.
+    
+    Args:
+        user_id (str): The user whose orders to return
+        guild_id (int, optional): Guild, defaults to the current one
+        limit (int): Maximum number of orders
+        after (tuple, optional): Decoded cursor of the previous page
+        
+    Returns:
+        list: The orders
+        str: Cursor of the next page, or None on the last page
+    """
+    query = (Order.query
+             .options(selectinload(Order.items).joinedload(OrderItem.product),
+                      joinedload(Order.order_period))
+             .filter_by(user_id=user_id, guild_id=resolve_guild(guild_id)))
+    
+    if after is not None:
+        query = query.filter(tuple_(Order.created_at, Order.id) < tuple_(*after))
+    
+    # One extra row tells whether there is a next page
+    orders = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit + 1).all()
+    
+    if len(orders) > limit:
+        return orders[:limit], encode_order_cursor(orders[limit - 1])
+    return orders, None
+
+def normalize_order_items(items):
+    """
+    Validates an order's items without touching the database. Quantities of
+    the same product are added up and zero quantities are dropped.
     
     Args:
-        user_id (str): Unique identifier for the user
-        user_name (str): Display name for the user
         items (list): List of dicts with product_id and quantity
         
     Returns:
-        Order: The created or updated order
+        list: Dicts with product_id and quantity, one per product
         str: Error message if any
     """
-    current_period = get_current_order_period()
+    if not isinstance(items, list):
+        return None, "Items must be a list"
     
-    if not current_period:
-        return None, "No open order period available"
+    quantities = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            return None, f"Item {index} must be an object"
+        
+        product_id = item.get('product_id')
+        quantity = item.get('quantity')
+        
+        if not isinstance(product_id, int) or isinstance(product_id, bool) or product_id < 1:
+            return None, f"Item {index}: product_id must be a positive integer"
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            return None, f"Item {index}: quantity must be an integer"
+        if quantity < 0:
+            return None, f"Item {index}: quantity cannot be negative"
+        
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
     
-    # Check if user already has an order for this period
+    normalized = [
+        {'product_id': product_id, 'quantity': quantity}
+        for product_id, quantity in quantities.items()
+        if quantity > 0
+    ]
+    if not normalized:
+        return None, "The order has no items with a quantity above 0"
+    
+    return normalized, None
+
+def unknown_product_ids(product_ids):
+    """
+    Returns the ids that are not in the product catalog, sorted.
+    
+    Always checked against the database with a single IN query: the
+    in-process product index may still list a product that was just deleted.
+    """
     from app import db
     
-    existing_order = Order.query.filter_by(
-        user_id=user_id, 
-        order_period_id=current_period.id
-    ).first()
+    candidates = set(product_ids)
+    if not candidates:
+        return []
+    
+    known = {row[0] for row in db.session.query(Product.id).filter(Product.id.in_(candidates))}
+    return sorted(candidates - known)
+
+def write_order(period, user_id, user_name, items):
+    """
+    Replaces a user's order in a period with ``items``. The caller has
+    validated the items (see normalize_order_items) and commits.
+    
+    Args:
+        period (OrderPeriod): Open order period to write to
+        user_id (str): Unique identifier for the user
+        user_name (str): Display name for the user
+        items (list): Normalized list of dicts with product_id and quantity
+        
+    Returns:
+        Order: The created or updated order
+    """
+    from app import db
+    
+    # Check if user already has an order for this period
+    existing_order = queries.user_order(user_id, period.id)
     
     if existing_order:
         # Delete existing order items
@@ -52,37 +203,69 @@ def add_order(user_id, user_name, items):
     else:
         # Create new order
         order = Order(
+            guild_id=period.guild_id,
             user_id=user_id,
             user_name=user_name,
-            order_period_id=current_period.id
+            order_period_id=period.id
         )
         db.session.add(order)
         db.session.flush()  # To get the order.id
     
-    # Add order items
-    for item in items:
-        product_id = item.get('product_id')
-        quantity = item.get('quantity')
+    # Add order items, one per product after normalization
+    db.session.add_all([
+        OrderItem(order_id=order.id, product_id=item['product_id'], quantity=item['quantity'])
+        for item in items
+    ])
+    
+    db.session.flush()
+    record_event('order.saved', order.order_period_id, period.guild_id, **order_payload(order))
+    
+    return order
+
+def add_order(user_id, user_name, items, guild_id=None):
+    """
+    Adds or updates an order for the current order period.
+    
+    Args:
+        user_id (str): Unique identifier for the user
+        user_name (str): Display name for the user
+        items (list): List of dicts with product_id and quantity
+        guild_id (int, optional): Guild to order in
         
-        if product_id and quantity and quantity > 0:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=product_id,
-                quantity=quantity
-            )
-            db.session.add(order_item)
+    Returns:
+        Order: The created or updated order
+        str: Error message if any
+    """
+    # Reject bad input before anything is written
+    items, error = normalize_order_items(items)
+    if error:
+        return None, error
+    
+    unknown = unknown_product_ids([item['product_id'] for item in items])
+    if unknown:
+        return None, f"Products not found: {', '.join(map(str, unknown))}"
+    
+    guild_id = resolve_guild(guild_id)
+    current_period = get_current_order_period(guild_id)
+    
+    if not current_period:
+        return None, "No open order period available"
+    
+    from app import db
     
+    order = write_order(current_period, user_id, user_name, items)
     db.session.commit()
     
     return order, None
 
-def delete_order(order_id, user_id=None):
+def delete_order(order_id, user_id=None, guild_id=None):
     """
     Deletes an order from the current order period.
     
     Args:
         order_id (int): ID of the order to delete
         user_id (str, optional): If provided, checks if order belongs to this user
+        guild_id (int, optional): Guild the order belongs to
         
     Returns:
         bool: True if order was deleted, False otherwise
@@ -90,7 +273,8 @@ def delete_order(order_id, user_id=None):
     """
     from app import db
     
-    current_period = get_current_order_period()
+    guild_id = resolve_guild(guild_id)
+    current_period = get_current_order_period(guild_id)
     
     if not current_period:
         return False, "No open order period available"
@@ -108,17 +292,19 @@ def delete_order(order_id, user_id=None):
     # Delete order items first
     OrderItem.query.filter_by(order_id=order.id).delete()
     db.session.delete(order)
+    record_event('order.deleted', order.order_period_id, guild_id, order_id=order.id, user_id=order.user_id)
     db.session.commit()
     
     return True, None
 
-def create_order_period(month, year):
+def create_order_period(month, year, guild_id=None):
     """
     Creates a new order period and opens it.
     
     Args:
         month (int): Month (1-12)
         year (int): Year (e.g., 2023)
+        guild_id (int, optional): Guild the period belongs to
         
     Returns:
         OrderPeriod: The created order period
@@ -129,29 +315,37 @@ def create_order_period(month, year):
     if not month or not year or month < 1 or month > 12:
         return None, "Invalid month or year"
     
+    guild_id = resolve_guild(guild_id)
+    
     # Check if this period already exists
-    existing = OrderPeriod.query.filter_by(month=month, year=year).first()
+    existing = get_order_period_by_month(month, year, guild_id)
     if existing:
         return None, "This order period already exists"
     
-    # Close all currently open periods
-    open_periods = OrderPeriod.query.filter_by(is_open=True).all()
+    # Close the guild's currently open periods
+    open_periods = OrderPeriod.query.filter_by(guild_id=guild_id, is_open=True).all()
     for period in open_periods:
         period.is_open = False
+        checkpoint_inventory(guild_id, order_period_id=period.id)
+        record_event('period.updated', period.id, guild_id, **period_payload(period))
     
     # Create new period
-    new_period = OrderPeriod(month=month, year=year, is_open=True)
+    new_period = OrderPeriod(guild_id=guild_id, month=month, year=year, is_open=True)
     db.session.add(new_period)
+    db.session.flush()
+    record_event('period.created', new_period.id, guild_id, **period_payload(new_period))
     db.session.commit()
+    _forget_current_periods()
     
     return new_period, None
 
-def toggle_order_period(period_id):
+def toggle_order_period(period_id, guild_id=None):
     """
     Toggles an order period between open and closed.
     
     Args:
         period_id (int): ID of the order period to toggle
+        guild_id (int, optional): Guild the period belongs to
         
     Returns:
         OrderPeriod: The toggled order period
@@ -159,34 +353,41 @@ def toggle_order_period(period_id):
     """
     from app import db
     
-    period = OrderPeriod.query.get(period_id)
+    guild_id = resolve_guild(guild_id)
+    period = get_order_period(period_id, guild_id)
     
     if not period:
         return None, "Order period not found"
     
     if period.is_open:
-        # Close this period
+        # Close this period, keeping a snapshot of stock as it closed
         period.is_open = False
+        checkpoint_inventory(guild_id, order_period_id=period.id)
     else:
-        # Close all open periods
-        open_periods = OrderPeriod.query.filter_by(is_open=True).all()
+        # Close the guild's open periods
+        open_periods = OrderPeriod.query.filter_by(guild_id=guild_id, is_open=True).all()
         for p in open_periods:
             p.is_open = False
+            checkpoint_inventory(guild_id, order_period_id=p.id)
+            record_event('period.updated', p.id, guild_id, **period_payload(p))
         
         # Open this period
         period.is_open = True
     
+    record_event('period.updated', period.id, guild_id, **period_payload(period))
     db.session.commit()
+    _forget_current_periods()
     
     return period, None
 
-def update_inventory(product_id, quantity):
+def update_inventory(product_id, quantity, guild_id=None):
     """
     Updates the inventory for a product.
     
     Args:
         product_id (int): ID of the product
         quantity (int): New quantity
+        guild_id (int, optional): Guild whose stock to update
         
     Returns:
         Inventory: The updated inventory item
@@ -202,24 +403,120 @@ def update_inventory(product_id, quantity):
     if not product:
         return None, "Product not found"
     
-    inventory_item = Inventory.query.filter_by(product_id=product_id).first()
-    
-    if inventory_item:
-        inventory_item.quantity = quantity
-    else:
-        inventory_item = Inventory(product_id=product_id, quantity=quantity)
-        db.session.add(inventory_item)
+    guild_id = resolve_guild(guild_id)
     
+    # Recorded as an adjustment in the ledger
+    movement, balance = set_stock(guild_id, product_id, quantity)
+    if movement:
+        record_event('inventory.updated', guild_id=guild_id, product_id=product_id, quantity=balance,
+                     delta=movement.delta, movement=movement.kind)
     db.session.commit()
     
+    inventory_item = queries.inventory_item(guild_id, product_id)
+    
     return inventory_item, None
 
-def toggle_delivery_status(order_id):
+def set_inventory_levels(items, note=None, guild_id=None):
+    """
+    Sets the inventory of many products at once, in one transaction.
+    
+    Args:
+        items (list): List of dicts with product_id and quantity
+        note (str, optional): Free text reason recorded with each adjustment
+        guild_id (int, optional): Guild whose stock to update
+        
+    Returns:
+        list: {'product_id', 'delta', 'quantity'} for each product whose stock changed
+        str: Error message if any
+    """
+    from app import db
+    
+    levels = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            return None, f"Item {index} must be an object"
+        
+        product_id = item.get('product_id')
+        quantity = item.get('quantity')
+        
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            return None, f"Item {index}: product_id must be an integer"
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            return None, f"Item {index}: quantity must be an integer"
+        if quantity < 0:
+            return None, f"Item {index}: quantity cannot be negative"
+        if product_id in levels:
+            return None, f"Item {index}: product {product_id} is listed more than once"
+        
+        levels[product_id] = quantity
+    
+    if not levels:
+        return [], None
+    
+    unknown = unknown_product_ids(levels)
+    if unknown:
+        return None, f"Products not found: {', '.join(map(str, unknown))}"
+    
+    guild_id = resolve_guild(guild_id)
+    
+    changes = set_stock_levels(guild_id, levels, note=note)
+    if changes:
+        record_event('inventory.counted', guild_id=guild_id, items=changes)
+    db.session.commit()
+    
+    return changes, None
+
+def adjust_inventory(product_id, delta, kind, note=None, order_id=None, guild_id=None):
+    """
+    Records a stock movement for a product.
+    
+    Args:
+        product_id (int): ID of the product
+        delta (int): Signed change in stock
+        kind (str): restock, reservation, delivery or adjustment
+        note (str, optional): Reason for the movement
+        order_id (int, optional): Order the movement relates to
+        guild_id (int, optional): Guild whose stock moves
+        
+    Returns:
+        InventoryMovement: The recorded movement
+        str: Error message if any
+    """
+    from app import db
+    
+    if kind not in MOVEMENT_KINDS:
+        return None, f"Movement kind must be one of: {', '.join(MOVEMENT_KINDS)}"
+    
+    if not delta:
+        return None, "Delta must be a non-zero integer"
+    
+    if kind == 'restock' and delta < 0:
+        return None, "A restock must add stock"
+    
+    product = Product.query.get(product_id)
+    if not product:
+        return None, "Product not found"
+    
+    guild_id = resolve_guild(guild_id)
+    movement, balance = record_movement(guild_id, product_id, delta, kind, note=note, order_id=order_id)
+    
+    if balance < 0:
+        db.session.rollback()
+        return None, f"Insufficient stock: {balance - delta} available"
+    
+    record_event('inventory.updated', guild_id=guild_id, product_id=product_id, quantity=balance,
+                 delta=delta, movement=kind)
+    db.session.commit()
+    
+    return movement, None
+
+def toggle_delivery_status(order_id, guild_id=None):
     """
     Toggles the delivery status of an order.
     
     Args:
         order_id (int): ID of the order to toggle
+        guild_id (int, optional): Guild the order belongs to
         
     Returns:
         Order: The updated order
@@ -227,13 +524,14 @@ def toggle_delivery_status(order_id):
     """
     from app import db
     
-    order = Order.query.get(order_id)
+    order = get_order(order_id, guild_id)
     
     if not order:
         return None, "Order not found"
     
     # Toggle the delivery status
     order.is_delivered = not order.is_delivered
+    record_event('order.delivery', order.order_period_id, order.guild_id, order_id=order.id, is_delivered=order.is_delivered)
     db.session.commit()
     
     return order, None
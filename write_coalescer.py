@@ -0,0 +1,243 @@
+"""
+Group commit for order writes.
+
+When an order period opens, many users place their orders at once, and each
+``add_order`` pays for its own commit: on SQLite every commit queues for the
+file's write lock, on Postgres every commit waits for its own WAL flush.
+
+With ``ORDER_WRITE_COALESCING=1`` order writes from the web workers and the
+bot are handed to one writer thread per process instead. The thread waits up
+to ``ORDER_COALESCE_WINDOW_MS`` after the first write of a batch for others
+to arrive (at most ``ORDER_COALESCE_MAX_BATCH``), keeps only the last write
+of each user, since a later order replaces an earlier one, and commits the
+batch in one transaction. Every caller still gets its own result: invalid
+writes fail on their own, and if the batch commit fails each write is
+retried in a transaction of its own.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from tenancy import resolve_guild
+
+logger = logging.getLogger(__name__)
+
+COALESCE_WINDOW = float(os.environ.get("ORDER_COALESCE_WINDOW_MS", "5")) / 1000
+MAX_BATCH = int(os.environ.get("ORDER_COALESCE_MAX_BATCH", "64"))
+
+def coalescing_enabled():
+    return os.environ.get("ORDER_WRITE_COALESCING", "0") == "1"
+
+class OrderWrite:
+    """
+    One queued add_order call and the callers waiting for its outcome.
+    """
+    __slots__ = ('guild_id', 'user_id', 'user_name', 'items', 'futures')
+
+    def __init__(self, guild_id, user_id, user_name, items):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.items = items
+        self.futures = [Future()]
+
+    @property
+    def key(self):
+        return (self.guild_id, self.user_id)
+
+    def finish(self, order_id, error=None):
+        for future in self.futures:
+            future.set_result((order_id, error))
+
+    def fail(self, exc):
+        for future in self.futures:
+            future.set_exception(exc)
+
+class WriteCoalescer:
+    """
+    Collects order writes into batches committed by a single thread.
+    """
+    def __init__(self, window=COALESCE_WINDOW, max_batch=MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.writes = 0
+
+    def submit(self, guild_id, user_id, user_name, items):
+        """
+        Queues an order write.
+
+        Returns:
+            Future: Resolves to (order id, error message)
+        """
+        write = OrderWrite(guild_id, user_id, user_name, items)
+        self._queue.put(write)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="order-writer", daemon=True)
+                self._thread.start()
+        return write.futures[0]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._commit_batch(batch)
+            except Exception as exc:
+                logger.exception("Order write batch failed")
+                for write in batch:
+                    if not write.futures[0].done():
+                        write.fail(exc)
+
+    def _commit_batch(self, batch):
+        from app import app, db
+        from utils import normalize_order_items, unknown_product_ids, get_current_order_period, write_order, add_order
+
+        with app.app_context():
+            # Validate first, so that merging never lets a bad write replace a good one
+            valid = []
+            for write in batch:
+                items, error = normalize_order_items(write.items)
+                if error:
+                    write.finish(None, error)
+                else:
+                    write.items = items
+                    valid.append(write)
+
+            unknown = set(unknown_product_ids({item['product_id'] for write in valid for item in write.items}))
+
+            merged = {}
+            for write in valid:
+                missing = sorted({item['product_id'] for item in write.items} & unknown)
+                if missing:
+                    write.finish(None, f"Products not found: {', '.join(map(str, missing))}")
+                    continue
+
+                # A later order from the same user replaces the earlier one anyway
+                earlier = merged.pop(write.key, None)
+                if earlier is not None:
+                    write.futures.extend(earlier.futures)
+                merged[write.key] = write
+
+            periods = {}
+            ready = []
+            for write in merged.values():
+                if write.guild_id not in periods:
+                    periods[write.guild_id] = get_current_order_period(write.guild_id)
+                if periods[write.guild_id] is None:
+                    write.finish(None, "No open order period available")
+                else:
+                    ready.append(write)
+
+            if not ready:
+                return
+
+            try:
+                orders = [
+                    write_order(periods[write.guild_id], write.user_id, write.user_name, write.items)
+                    for write in ready
+                ]
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                logger.warning("Group commit of %d orders failed, retrying one by one", len(ready), exc_info=True)
+                self._commit_one_by_one(ready, add_order)
+                return
+
+            self.batches += 1
+            self.writes += len(ready)
+            for write, order in zip(ready, orders):
+                write.finish(order.id)
+
+    def _commit_one_by_one(self, writes, add_order):
+        from app import db
+
+        for write in writes:
+            try:
+                order, error = add_order(write.user_id, write.user_name, write.items, guild_id=write.guild_id)
+            except Exception as exc:
+                db.session.rollback()
+                write.fail(exc)
+            else:
+                write.finish(order.id if order else None, error)
+
+order_writer = WriteCoalescer()
+
+def _submit(user_id, user_name, items, guild_id):
+    """
+    Hands a write to the writer thread. Returns its future, or None when the
+    write must run in the caller's session instead.
+    """
+    from app import db
+
+    # A batch transaction must contain the write, so it cannot go to the writer thread
+    if not coalescing_enabled() or db.session.info.get("hold_commits"):
+        return None
+
+    guild_id = resolve_guild(guild_id)
+
+    # Ends the caller's transaction: its connection goes back to the pool while
+    # waiting, and the writer's commit is visible to the read below
+    db.session.commit()
+
+    return order_writer.submit(guild_id, user_id, user_name, items)
+
+def _load(order_id, error):
+    from models import Order
+    from app import db
+
+    if error:
+        return None, error
+
+    # The writer thread's objects belong to its own session
+    return db.session.get(Order, order_id, populate_existing=True), None
+
+def coalesced_add_order(user_id, user_name, items, guild_id=None):
+    """
+    Adds or updates an order like utils.add_order, through the group-commit
+    writer when ORDER_WRITE_COALESCING is on. Blocks until the write is
+    committed, so it is meant for the web workers' threads.
+
+    Returns:
+        Order: The created or updated order, loaded in the caller's session
+        str: Error message if any
+    """
+    from utils import add_order
+
+    future = _submit(user_id, user_name, items, guild_id)
+    if future is None:
+        return add_order(user_id, user_name, items, guild_id=guild_id)
+    return _load(*future.result())
+
+async def coalesced_add_order_async(user_id, user_name, items, guild_id=None):
+    """
+    Same as coalesced_add_order for the bot: waits for the writer thread
+    without blocking the event loop, so other commands keep running.
+
+    Returns:
+        Order: The created or updated order, loaded in the caller's session
+        str: Error message if any
+    """
+    from utils import add_order
+
+    future = _submit(user_id, user_name, items, guild_id)
+    if future is None:
+        return add_order(user_id, user_name, items, guild_id=guild_id)
+    return _load(*await asyncio.wrap_future(future))